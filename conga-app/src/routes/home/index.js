@@ -8,6 +8,43 @@ import TableEnd from "../../components/TableEnd";
 
 const WS_ADDRESS = "ws://localhost:8000/ws";
 
+// Applies the JSON Patch operations (add, remove, replace) sent by the server
+const applyPatch = (document, patch) => {
+  let root = JSON.parse(JSON.stringify(document === undefined ? null : document));
+
+  patch.forEach(({ op, path, value }) => {
+    if (path === "") {
+      root = value;
+      return;
+    }
+
+    const keys = path
+      .split("/")
+      .slice(1)
+      .map((key) => key.replace(/~1/g, "/").replace(/~0/g, "~"));
+    const last = keys.pop();
+    const target = keys.reduce((parent, key) => parent[key], root);
+
+    if (Array.isArray(target)) {
+      const index = last === "-" ? target.length : parseInt(last, 10);
+
+      if (op === "add") {
+        target.splice(index, 0, value);
+      } else if (op === "remove") {
+        target.splice(index, 1);
+      } else {
+        target[index] = value;
+      }
+    } else if (op === "remove") {
+      delete target[last];
+    } else {
+      target[last] = value;
+    }
+  });
+
+  return root;
+};
+
 export default class Home extends Component {
   state = {
     game: null,
@@ -18,6 +55,11 @@ export default class Home extends Component {
 
   webSocket = null;
 
+  // Latest game state and version, patches are applied on them as soon as they arrive
+  game = null;
+
+  gameVersion = null;
+
   send = (action, action_params = {}) =>
     this.webSocket.send(JSON.stringify({ action, action_params }));
 
@@ -75,9 +117,28 @@ export default class Home extends Component {
 
   wsOnMessage = (event) => {
     console.log("Receiving message");
-    const game = JSON.parse(event.data).game;
-    console.log("Game status", game);
-    this.setState({ game });
+    const message = JSON.parse(event.data);
+
+    if (message.error) {
+      console.log("Server error", message.error);
+      return;
+    }
+
+    if (message.game) {
+      // Full state, on connection or after asking for a resync
+      this.game = message.game;
+      this.gameVersion = message.version;
+    } else if (message.version === this.gameVersion + 1) {
+      this.game = applyPatch(this.game, message.patch);
+      this.gameVersion = message.version;
+    } else {
+      // Missed some changes, ask for the full state
+      this.send("resync");
+      return;
+    }
+
+    console.log("Game status", this.game);
+    this.setState({ game: this.game });
   };
 
   componentWillMount() {
@@ -0,0 +1,71 @@
+"""Compares the hand-written codec with dataclass_json on 2, 4 and 8 player games
+
+    poetry run python benchmarks/codec.py
+"""
+import json
+import timeit
+
+from conga.codec import decode_game, dump_game, encode_game, orjson
+from conga.game import Game
+
+
+def played_game(n_players: int, turns: int = 10) -> Game:
+    game = Game()
+    for i in range(n_players):
+        game.dispatch("add_player", {"name": f"player_{i}"})
+
+    game.dispatch("start_match", {})
+    for i in range(turns):
+        if game.status != 1:
+            break
+
+        game.dispatch("player_turn_pick", {})
+        game.dispatch("player_turn_throw", {"card_id": i % 8})
+        if game.players[game.match_next_player].can_finish:
+            game.dispatch("player_finish_attempt", {"player_finishes": False})
+
+    return game
+
+
+def bench(function, number: int) -> float:
+    """Best time per call, in microseconds"""
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    print(f"JSON backend: {'orjson' if orjson is not None else 'json'}\n")
+    print(f"{'players':>8} {'operation':<28} {'dataclass_json':>15} {'codec':>10} {'speedup':>8}")
+
+    for n_players in [2, 4, 8]:
+        game = played_game(n_players)
+        data = game.to_dict()
+        compact = encode_game(game, wire_version=2)
+
+        rows = [
+            ("to_dict", lambda: game.to_dict(), lambda: encode_game(game)),
+            ("to_dict + dumps", lambda: json.dumps(game.to_dict()), lambda: dump_game(game)),
+            (
+                "to_dict + dumps (wire v2)",
+                lambda: json.dumps(game.to_dict()),
+                lambda: dump_game(game, wire_version=2),
+            ),
+            ("from_dict", lambda: Game.from_dict(data), lambda: decode_game(data)),
+            ("from_dict (wire v2)", lambda: Game.from_dict(data), lambda: decode_game(compact)),
+        ]
+
+        for name, current, codec in rows:
+            current_time, codec_time = bench(current, 50), bench(codec, 50)
+            print(
+                f"{n_players:>8} {name:<28} {current_time:>13.1f}us {codec_time:>8.1f}us "
+                f"{current_time / codec_time:>7.1f}x"
+            )
+
+    print()
+    for n_players in [2, 4, 8]:
+        game = played_game(n_players)
+        sizes = [len(json.dumps(game.to_dict())), len(dump_game(game, wire_version=2))]
+        print(f"{n_players} players state size: {sizes[0]} bytes, {sizes[1]} bytes (wire v2)")
+
+
+if __name__ == "__main__":
+    main()
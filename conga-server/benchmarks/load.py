@@ -0,0 +1,415 @@
+"""Load test: simulated players playing many tables at once against a server
+
+    poetry run python benchmarks/load.py --tables 100 --players 4       # starts a local server
+    poetry run python benchmarks/load.py --tables 100 --workers 4       # cluster of 4 processes
+    poetry run python benchmarks/load.py --url ws://localhost:8000 --server-pid 1234
+
+Every table is a room with `--players` websocket clients. Clients join the room (`add_player`),
+the first one starts the matches, and every client plays its turns (`player_turn_pick`,
+`player_turn_throw` and `player_finish_attempt`) after `--think-ms`, throwing the highest card
+out of its games. Finished games go on in a new room.
+
+Reported:
+
+* Latency of every action: from sending it until its client receives the state it changed
+  (p50, p99 and max)
+* Messages per second received by all the clients
+* Memory of the server (RSS of its processes) when the clients connect, after every table joined
+  and at the end
+
+Clients speak JSON (applying the patches to their views) or, with `--binary`, the binary protocol
+(see `conga.wire`). Clients run in this process: with many tables, run them on another machine
+(`--url`) so they don't compete with the server for the CPU. Set `CONGA_*` variables to configure
+a local server.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from conga import wire
+from conga.patch import apply_patch_in_place
+
+try:
+    import websockets
+except ImportError:  # pragma: no cover
+    websockets = None
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+LOBBY, STARTED, SHOWCASE, FINISHED = 0, 1, 2, 3
+
+
+@dataclass
+class Stats:
+    """Measures of every client, in seconds"""
+
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    messages: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    games: int = 0
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+#
+# Server processes
+#
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, workers: int) -> subprocess.Popen:
+    """Starts `conga.app:app` with uvicorn, saving games and slow action reports to a temporary
+    directory. Several workers run in cluster mode"""
+    directory = tempfile.mkdtemp(prefix="conga-load-")
+
+    env = dict(os.environ)
+    env.setdefault("CONGA_DATA_DIR", os.path.join(directory, "games"))
+    env.setdefault("CONGA_PROFILE_DIR", os.path.join(directory, "profiles"))
+    env.setdefault("CONGA_LOG_LEVEL", "WARNING")
+
+    if workers > 1:
+        env.setdefault("CONGA_CLUSTER_DIR", os.path.join(directory, "cluster"))
+        env.setdefault("CONGA_CLUSTER_SIZE", str(workers))
+
+    command = [sys.executable, "-m", "uvicorn", "conga.app:app", "--port", str(port)]
+    command += ["--log-level", "warning", "--workers", str(workers)]
+
+    return subprocess.Popen(command, env=env)
+
+
+async def wait_for_server(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(f"{url}/ws/load-ping"):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+
+            await asyncio.sleep(0.2)
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def server_rss(pid: Optional[int]) -> Optional[int]:
+    """Resident memory of a process and its children, in bytes (None if it can't be read, it's
+    read from `/proc`)"""
+    if pid is None:
+        return None
+
+    total = 0
+    for process in [pid] + _children(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            if process == pid:
+                return None
+
+    return total
+
+
+def _raise_file_limit():
+    # Every client is a socket
+    if resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+#
+# Clients
+#
+def next_action(game: dict, name: str, leader: bool, players: int) -> Optional[tuple]:
+    """Action of a client from its view of the game, if it has one to take"""
+    names = [player["name"] for player in game["players"]]
+    status = game["status"]
+
+    if status == LOBBY:
+        return ("start_match", {}) if leader and len(names) == players else None
+    if status == SHOWCASE:
+        return ("start_match", {}) if leader else None
+    if status != STARTED or name not in names or names[game["match_next_player"]] != name:
+        return None
+
+    player = game["players"][names.index(name)]
+    if player.get("can_finish") and not player["finish_next_turn"]:
+        return "player_finish_attempt", {"player_finishes": True}
+
+    hand = player["hand"]
+    if len(hand) == 7:
+        return "player_turn_pick", {"pick_discard_pile": False}
+
+    # The highest card out of the games of the hand
+    in_games = [card for cand in player["hand_candidates"] for card in cand]
+    loose = [ix for ix, card in enumerate(hand) if card not in in_games]
+    card_id = max(loose or range(len(hand)), key=lambda ix: hand[ix]["number"])
+
+    return "player_turn_throw", {"card_id": card_id}
+
+
+class Client:
+    """A player of a table, playing until `stop` is set"""
+
+    def __init__(self, args: argparse.Namespace, table: int, seat: int, stats: Stats):
+        self.args = args
+        self.table = table
+        self.name = f"player_{seat}"
+        self.leader = seat == 0
+        self.stats = stats
+
+        self.game: Optional[dict] = None
+        self.version = -1
+        # Action waiting for its state: name, version when sent and time
+        self.pending: Optional[tuple] = None
+
+    async def send(self, websocket, action: str, params: dict):
+        if self.args.binary:
+            await websocket.send(wire.encode_action(action, params))
+        else:
+            await websocket.send(json.dumps({"action": action, "action_params": params}))
+
+    def receive(self, data) -> dict:
+        message = wire.decode_message(data) if self.args.binary else json.loads(data)
+        self.stats.messages += 1
+
+        if "game" in message:
+            self.game = message["game"]
+        elif "patch" in message:
+            self.game = apply_patch_in_place(self.game, message["patch"])
+
+        self.version = message["version"]
+        return message
+
+    async def play(self, room_id: str, stop: asyncio.Event) -> bool:
+        """Plays a game in a room. Returns whether the game finished"""
+        subprotocols = [wire.BINARY_SUBPROTOCOL] if self.args.binary else None
+        url = f"{self.args.url}/ws/{room_id}"
+
+        async with websockets.connect(url, subprotocols=subprotocols, max_size=None) as websocket:
+            self.receive(await websocket.recv())
+            self.pending = ("add_player", self.version, time.perf_counter())
+            await self.send(websocket, "add_player", {"name": self.name})
+
+            while not stop.is_set():
+                try:
+                    message = self.receive(await asyncio.wait_for(websocket.recv(), 10))
+                except asyncio.TimeoutError:
+                    # Lost an update, or nothing to do while others think
+                    if self.pending is not None:
+                        self.stats.timeouts += 1
+                        self.pending = None
+                        await self.send(websocket, "resync", {})
+                    continue
+
+                if self.pending is not None:
+                    action, version, start = self.pending
+                    if "error" in message:
+                        self.stats.errors += 1
+                        self.pending = None
+                    elif self.version > version:
+                        self.stats.latencies[action].append(time.perf_counter() - start)
+                        self.pending = None
+
+                if self.game["status"] == FINISHED:
+                    self.stats.games += self.leader
+                    return True
+
+                move = next_action(self.game, self.name, self.leader, self.args.players)
+                if move is None or self.pending is not None:
+                    continue
+
+                if self.args.think_ms:
+                    await asyncio.sleep(self.args.think_ms / 1000)
+
+                self.pending = (move[0], self.version, time.perf_counter())
+                await self.send(websocket, *move)
+
+        return False
+
+    async def run(self, stop: asyncio.Event):
+        for game in range(10 ** 9):
+            room_id = f"{self.args.room_prefix}-{self.table}-{game}"
+            if not await self.play(room_id, stop):
+                return
+
+
+async def run_load(args: argparse.Namespace, pid: Optional[int]) -> dict:
+    stats, stop = Stats(), asyncio.Event()
+    memory = {"start": server_rss(pid)}
+
+    # Tables join over `--ramp` seconds
+    tasks = []
+    for table in range(args.tables):
+        for seat in range(args.players):
+            client = Client(args, table, seat, stats)
+            tasks.append(asyncio.ensure_future(client.run(stop)))
+
+        await asyncio.sleep(args.ramp / args.tables)
+
+    memory["joined"] = server_rss(pid)
+
+    # Measures start once every table is playing
+    stats.latencies.clear()
+    stats.messages = 0
+    start = time.perf_counter()
+
+    await asyncio.sleep(args.duration)
+    stop.set()
+
+    elapsed = time.perf_counter() - start
+    memory["end"] = server_rss(pid)
+
+    # Clients that failed before the end (lost connections, server errors)
+    failures = [task for task in tasks if task.done() and task.exception() is not None]
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies = [latency for values in stats.latencies.values() for latency in values]
+    return {
+        "tables": args.tables,
+        "players": args.players,
+        "clients": len(tasks),
+        "binary": args.binary,
+        "think_ms": args.think_ms,
+        "seconds": elapsed,
+        "actions": {
+            action: {
+                "count": len(values),
+                "p50_ms": percentile(values, 0.5) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+            for action, values in sorted(stats.latencies.items())
+        },
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "actions_per_second": len(latencies) / elapsed,
+        "messages_per_second": stats.messages / elapsed,
+        "games": stats.games,
+        "errors": stats.errors,
+        "timeouts": stats.timeouts,
+        "failed_clients": len(failures),
+        "memory": memory,
+    }
+
+
+def _mb(size: Optional[int]) -> str:
+    return f"{size / 2 ** 20:.1f}MB" if size is not None else "n/a"
+
+
+def report(results: dict):
+    print(
+        f"{results['tables']} tables of {results['players']} players "
+        f"({'binary' if results['binary'] else 'JSON'}, {results['think_ms']}ms to think), "
+        f"{results['seconds']:.1f}s\n"
+    )
+
+    print(f"{'action':<24} {'count':>8} {'p50':>10} {'p99':>10} {'max':>10}")
+    for action, values in results["actions"].items():
+        print(
+            f"{action:<24} {values['count']:>8} {values['p50_ms']:>8.1f}ms "
+            f"{values['p99_ms']:>8.1f}ms {values['max_ms']:>8.1f}ms"
+        )
+
+    if results["p50_ms"] is not None:
+        print(f"{'all':<24} {'':>8} {results['p50_ms']:>8.1f}ms {results['p99_ms']:>8.1f}ms")
+
+    memory = results["memory"]
+    growth = (
+        _mb(memory["end"] - memory["start"])
+        if memory["start"] is not None and memory["end"] is not None
+        else "n/a"
+    )
+
+    print(
+        f"\n{results['actions_per_second']:.0f} actions/s, "
+        f"{results['messages_per_second']:.0f} messages/s, {results['games']} games finished"
+    )
+    print(
+        f"Server memory: {_mb(memory['start'])} at start, {_mb(memory['joined'])} with every "
+        f"table, {_mb(memory['end'])} at the end ({growth} growth)"
+    )
+
+    problems = ["errors", "timeouts", "failed_clients"]
+    if any(results[problem] for problem in problems):
+        print(", ".join(f"{results[problem]} {problem.replace('_', ' ')}" for problem in problems))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tables", type=int, default=50)
+    parser.add_argument("--players", type=int, default=4, help="Players per table")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure")
+    parser.add_argument("--ramp", type=float, default=2, help="Seconds to start every table")
+    parser.add_argument("--think-ms", type=float, default=100, help="Time to think every move")
+    parser.add_argument("--binary", action="store_true", help="Use the binary protocol")
+    parser.add_argument("--url", help="Server to test (default: start one)")
+    parser.add_argument("--server-pid", type=int, help="Process of the server, for its memory")
+    parser.add_argument("--workers", type=int, default=1, help="Processes of the local server")
+    parser.add_argument("--room-prefix", default=f"load-{os.getpid()}")
+    parser.add_argument("--output", help="Save the results as JSON to this file")
+
+    args = parser.parse_args(argv)
+
+    if websockets is None:
+        print("The load test needs the websockets package", file=sys.stderr)
+        return 1
+
+    _raise_file_limit()
+
+    server = None
+    if args.url is None:
+        port = _free_port()
+        server = start_server(port, args.workers)
+        args.url = f"ws://127.0.0.1:{port}"
+        args.server_pid = server.pid
+
+    try:
+        asyncio.run(wait_for_server(args.url))
+        results = asyncio.run(run_load(args, args.server_pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""Benchmarks of the server hot paths, with fixed seeds, compared with a saved baseline
+
+    poetry run python benchmarks/suite.py --save           # run and save the baseline
+    poetry run python benchmarks/suite.py                  # run and compare with the baseline
+    poetry run python benchmarks/suite.py -k game --threshold 0.1
+
+Times are the best of a few rounds, per call. A benchmark slower than the baseline by more than
+the threshold (a ratio, 0.2 is 20% slower) is flagged as a regression, and the exit code is 1.
+Baselines depend on the machine, so compare runs on the same one.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from conga.card import Card, Joker, Suit, build_deck
+from conga.codec import decode_game, encode_game
+from conga.game import Game
+from conga.meld_table import set_meld_table
+from conga.player import _best_melds, _check_flush, _check_same_of_a_kind, check_cards_values
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# name -> (generator yielding the callable to time, calls per round). Code after the `yield` runs
+# when the benchmark is done
+BENCHMARKS: Dict[str, Tuple[Callable[[argparse.Namespace], Iterator[Callable]], int]] = {}
+
+
+def benchmark(number: int):
+    def register(function):
+        BENCHMARKS[function.__name__] = (function, number)
+        return function
+
+    return register
+
+
+JOKER = Card(suit=Joker.joker, number=0)
+
+
+def _cards(suit: Suit, numbers: List[int]) -> List[Card]:
+    return [Card(suit=suit, number=number) for number in numbers]
+
+
+def _random_hands(n_hands: int, seed: int = 0) -> List[List[Card]]:
+    rng = random.Random(seed)
+    deck = build_deck() * 2
+
+    return [rng.sample(deck, 8) for _ in range(n_hands)]
+
+
+def _played_game(n_players: int, turns: int, seed: int = 0) -> Game:
+    game = Game()
+    game.rng = rng = random.Random(seed)
+    for ix in range(n_players):
+        game.dispatch("add_player", {"name": f"player_{ix}"})
+
+    game.dispatch("start_match", {})
+    for _ in range(turns):
+        game.dispatch("player_turn_pick", {"pick_discard_pile": False})
+        game.dispatch("player_turn_throw", {"card_id": rng.randrange(8)})
+
+    return game
+
+
+#
+# Hand evaluator
+#
+@benchmark(number=200)
+def check_flush_jokers(args):
+    # Long runs with gaps and two jokers have the most flush candidates
+    hands = [
+        _cards(Suit.cups, [1, 2, 3, 4, 5, 6]) + [JOKER, JOKER],
+        _cards(Suit.gold, [1, 2, 4, 5, 7, 8]) + [JOKER, JOKER],
+        _cards(Suit.sword, [3, 5, 7, 9, 11, 12]) + [JOKER, JOKER],
+    ]
+
+    def run():
+        for hand in hands:
+            _check_flush(hand)
+
+    yield run
+
+
+@benchmark(number=200)
+def check_same_of_a_kind_jokers(args):
+    # The same number of every suit of two decks, and two jokers
+    hands = [
+        [Card(suit=suit, number=7) for suit in Suit] * 2,
+        [Card(suit=suit, number=7) for suit in Suit] + _cards(Suit.cups, [7, 7]) + [JOKER, JOKER],
+    ]
+
+    def run():
+        for hand in hands:
+            _check_same_of_a_kind(hand)
+
+    yield run
+
+
+@benchmark(number=3)
+def check_cards_values_cold(args):
+    hands = _random_hands(200)
+
+    def run():
+        _best_melds.cache_clear()
+        for hand in hands:
+            check_cards_values(hand)
+
+    yield run
+
+
+@benchmark(number=20)
+def check_cards_values_cached(args):
+    hands = _random_hands(200)
+    for hand in hands:
+        check_cards_values(hand)
+
+    def run():
+        for hand in hands:
+            check_cards_values(hand)
+
+    yield run
+
+
+#
+# Game state transitions
+#
+@benchmark(number=5)
+def match_cycle(args):
+    """A 4 players match: dealing, 40 turns and the showcase"""
+
+    def run():
+        game = _played_game(4, turns=40)
+        game.dispatch("player_finish_attempt", {"player_finishes": True})
+
+    yield run
+
+
+@benchmark(number=5)
+def match_cycle_8_players(args):
+    def run():
+        game = _played_game(8, turns=40)
+        game.dispatch("player_finish_attempt", {"player_finishes": True})
+
+    yield run
+
+
+#
+# Serialization
+#
+@benchmark(number=20)
+def game_to_dict(args):
+    game = _played_game(8, turns=10)
+    yield game.to_dict
+
+
+@benchmark(number=20)
+def game_from_dict(args):
+    data = _played_game(8, turns=10).to_dict()
+    yield lambda: Game.from_dict(data)
+
+
+@benchmark(number=500)
+def codec_encode_game(args):
+    game = _played_game(8, turns=10)
+    yield lambda: encode_game(game)
+
+
+@benchmark(number=500)
+def codec_decode_game(args):
+    data = _played_game(8, turns=10).to_dict()
+    yield lambda: decode_game(data)
+
+
+#
+# Websocket fan-out
+#
+@benchmark(number=20)
+def websocket_fanout(args):
+    """Time from an action until every socket of the room received its patch, through the app
+    with a test client. Every call adds a player to a lobby watched by `--clients` sockets"""
+    os.environ.setdefault("CONGA_DATA_DIR", tempfile.mkdtemp(prefix="conga-bench-"))
+
+    from fastapi.testclient import TestClient
+
+    from conga.app import app
+
+    client = TestClient(app)
+    stack = contextlib.ExitStack()
+    rounds = iter(range(10 ** 9))
+    state = {}
+
+    def connect():
+        # A new room every round, so the lobby doesn't grow
+        stack.close()
+        room_id = f"bench-{next(rounds)}"
+        state["driver"] = stack.enter_context(client.websocket_connect(f"/ws/{room_id}"))
+        state["clients"] = [
+            stack.enter_context(client.websocket_connect(f"/ws/{room_id}"))
+            for _ in range(args.clients)
+        ]
+        for ws in state["clients"]:
+            ws.receive_json()
+        state["players"] = 0
+
+    def run():
+        if state.get("players", 8) >= 8:
+            connect()
+
+        state["players"] += 1
+        state["driver"].send_json(
+            {"action": "add_player", "action_params": {"name": f"player_{state['players']}"}}
+        )
+        for ws in state["clients"]:
+            ws.receive_json()
+
+    with client, stack:
+        yield run
+
+
+def run_benchmark(name: str, args: argparse.Namespace) -> float:
+    """Best time per call of a benchmark, in microseconds"""
+    setup, number = BENCHMARKS[name]
+
+    with contextlib.contextmanager(setup)(args) as function:
+        function()
+
+        best = float("inf")
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+
+            best = min(best, (time.perf_counter() - start) / number)
+
+    return best * 1e6
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], threshold: float
+) -> List[Tuple[str, float]]:
+    """Benchmarks slower than the baseline by more than `threshold`, with their ratio"""
+    return [
+        (name, results[name] / baseline[name])
+        for name in results
+        if name in baseline and results[name] > baseline[name] * (1 + threshold)
+    ]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=16, help="Sockets of the fan-out room")
+    parser.add_argument("-k", dest="filter", default="", help="Only run benchmarks matching it")
+
+    args = parser.parse_args(argv)
+
+    # Evaluate hands without a precomputed table
+    set_meld_table(None)
+
+    # The app logs every connection
+    logging.getLogger("conga").setLevel(logging.WARNING)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    print(f"{'benchmark':<30} {'time':>12} {'baseline':>12} {'ratio':>7}")
+
+    for name in BENCHMARKS:
+        if args.filter not in name:
+            continue
+
+        results[name] = run_benchmark(name, args)
+
+        line = f"{name:<30} {results[name]:>10.1f}us"
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f" {baseline[name]:>10.1f}us {ratio:>6.2f}x"
+            if ratio > 1 + args.threshold:
+                line += "  REGRESSION"
+
+        print(line)
+
+    if args.save:
+        # Benchmarks that didn't run keep their previous baseline
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": {**baseline, **results},
+                },
+                f,
+                indent=2,
+            )
+        print(f"\nSaved baseline to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks are more than {args.threshold:.0%} slower")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
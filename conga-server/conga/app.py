@@ -1,72 +1,342 @@
-import json
+import asyncio
+import hmac
+import itertools
+import logging
+import multiprocessing
+import os
 import pprint
-import traceback
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional
 
 from fastapi import FastAPI, WebSocket
-from starlette.websockets import WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 
-from conga.game import Game
+from conga import wire
+from conga.bots import BOT_PREFIX, BotEngine, is_bot, next_move
+from conga.cluster import Node, UnixSocketBackplane
+from conga.game import VALID_ACTIONS
+from conga.metrics import ACTION_ERRORS, ACTION_SECONDS, BROADCAST_SECONDS, REGISTRY
+from conga.offload import ActionRunner
+from conga.persistence import GameStore
+from conga.profiling import ActionProfiler
+from conga.rooms import DEFAULT_ROOM_ID, Room, RoomError, RoomRegistry
+
+#
+# Set `CONGA_LOG_LEVEL=DEBUG` to log every message and game state. States are only formatted if
+# debug logging is enabled
+#
+logging.basicConfig(level=os.environ.get("CONGA_LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-game = Game()
+store = GameStore(directory=os.environ.get("CONGA_DATA_DIR", "games"))
+rooms = RoomRegistry(max_rooms=500, idle_timeout=30 * 60, store=store)
+profiler = ActionProfiler.from_env()
+
+# Heavy actions run off the event loop (see `conga.offload`)
+runner = ActionRunner.from_env()
+
+#
+# Bots decide in the default thread pool, or in `CONGA_BOT_WORKERS` processes, within
+# `CONGA_BOT_BUDGET_MS` per move
+#
+bot_workers = int(os.environ.get("CONGA_BOT_WORKERS", 0))
+bot_executor = (
+    ProcessPoolExecutor(bot_workers, mp_context=multiprocessing.get_context("spawn"))
+    if bot_workers
+    else None
+)
+bots = BotEngine(bot_executor, budget=float(os.environ.get("CONGA_BOT_BUDGET_MS", 20)) / 1000)
+
+#
+# Scale-out mode (see `conga.cluster`): set `CONGA_CLUSTER_DIR` and `CONGA_CLUSTER_SIZE` to the
+# number of workers
+#
+node: Optional[Node] = None
+
+
+valid_actions = VALID_ACTIONS
+
+
+def _broadcasters_metric(key: str):
+    return lambda: sum(room.broadcaster.metrics()[key] for room in rooms.rooms.values())
+
+
+REGISTRY.gauge("conga_rooms", "Rooms hosted by this process", lambda: len(rooms))
+REGISTRY.gauge(
+    "conga_sockets",
+    "Sockets connected to the rooms",
+    lambda: sum(len(room.sockets) for room in rooms.rooms.values()),
+)
+REGISTRY.gauge(
+    "conga_send_queue_depth", "Messages waiting to be sent", _broadcasters_metric("queue_depth")
+)
+REGISTRY.gauge(
+    "conga_lagging_sockets", "Sockets with a full send queue", _broadcasters_metric("lagging")
+)
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("startup")
+async def join_cluster():
+    global node
+
+    cluster_dir = os.environ.get("CONGA_CLUSTER_DIR")
+    if cluster_dir:
+        size = int(os.environ.get("CONGA_CLUSTER_SIZE", 1))
+        backplane = UnixSocketBackplane(cluster_dir)
+        node = Node(await backplane.claim(size), backplane, rooms, connect, handle_message)
+        await node.start(expected_nodes=size)
 
 
-valid_actions = [
-    "add_player",
-    "start_match",
-    "player_turn_pick",
-    "player_turn_throw",
-    "player_finish_attempt",
-]
+@app.on_event("shutdown")
+async def flush_store():
+    await store.flush()
 
-sockets = []
+    if node is not None:
+        await node.stop()
 
+    if bot_executor is not None:
+        bot_executor.shutdown(wait=False)
 
-# with open("game.json") as f:
-#     game_json = json.load(f)
-#     game = game.from_dict(game_json)
+    runner.shutdown()
+
+
+def broadcast_state(room: Room):
+    """Sends the changes of the game state to every socket in the room. Must be called holding the
+    room lock"""
+    with BROADCAST_SECONDS.time():
+        messages = room.update_state()
+        if messages is None:
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Room %s state:\n%s", room.room_id, pprint.pformat(room.state))
+
+        for player_name, message in messages.items():
+            websockets = [
+                socket
+                for socket in room.sockets
+                if room.viewers.get(socket) == player_name and socket not in room.binary
+            ]
+            room.broadcaster.publish(message, partial(room.snapshot, player_name), websockets)
+
+        # Binary sockets receive the whole view of every version
+        for socket in room.binary:
+            snapshot = partial(room.binary_snapshot, room.viewers.get(socket))
+            room.broadcaster.publish_frame(snapshot(), snapshot, [socket])
+
+
+def send(room: Room, websocket, message: dict):
+    """Sends a full view or error message to a socket, in its protocol"""
+    if websocket in room.binary:
+        room.broadcaster.send_text(websocket, wire.encode_message(message))
+    else:
+        room.broadcaster.send(websocket, message)
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+async def default_room_endpoint(websocket: WebSocket):
+    await websocket_endpoint(websocket, DEFAULT_ROOM_ID)
 
-    sockets.append(websocket)
 
-    print(f"Added new socket connection. Total: {len(sockets)}")
+async def connect(room: Room, websocket):
+    """Subscribes an accepted socket to its room and sends it the game"""
+    logger.info(
+        "Added new socket connection to room %s. Total: %d", room.room_id, len(room.sockets)
+    )
 
-    while True:
-        try:
-            data = await websocket.receive_json()
-            print(f"Received message {data}")
+    async with room.lock:
+        room.broadcaster.subscribe(websocket)
+        send(room, websocket, room.snapshot())
+
+    # Bots stop playing when everybody leaves, and go on when somebody comes back
+    schedule_bots(room)
+
+
+async def apply_action(room: Room, action: str, params: dict):
+    """Applies an action to the game of a room, broadcasts the changes and logs it. Must be called
+    holding the room lock"""
+    action_label = action if action in valid_actions else "other"
+
+    # Shuffles are seeded, so the action can be replayed from the log
+    seed, action_seed = store.prepare(room.room_id, room.game, action)
+
+    # Profiled actions are applied inline, so they are profiled in this thread
+    inline = profiler.enabled
+
+    try:
+        with ACTION_SECONDS.time(action_label), profiler.profile(
+            room.room_id, action_label, params, room.state, action_seed
+        ):
+            room.game = await runner.dispatch(room.game, action, params, inline)
+    except Exception:
+        ACTION_ERRORS.inc(action_label)
+        raise
 
-            game.update_players_state()
+    broadcast_state(room)
 
-            if "action" in data and data["action"] in valid_actions:
-                action = getattr(game, data["action"])
-                params = data["action_params"] if "action_params" in data else {}
-                action(**params)
+    if action in valid_actions:
+        store.record(room.room_id, action, params, room.state, seed)
 
-            if data["action"] in ["player_turn_throw", "start_match"]:
-                for player in game.players:
-                    player.update_state()
-                    player.sort_cards()
 
-            pprint.pprint(game.to_dict())
+def schedule_bots(room: Room):
+    """Plays the turns of the bots of a room in the background, if it's the turn of one"""
+    if room.sockets and next_move(room.game) and (room.bots_task is None or room.bots_task.done()):
+        room.bots_task = asyncio.ensure_future(play_bots(room))
 
-            with open("game.json", "w") as f:
-                json.dump(game.to_dict(), f)
 
-            for i, socket in enumerate(sockets):
-                await socket.send_json({"game": game.to_dict()})
+async def play_bots(room: Room):
+    """Plays bot turns until it's the turn of a human, or everybody leaves the room. The room is
+    locked while a bot decides, so the game doesn't change meanwhile"""
+    while room.sockets:
+        async with room.lock:
+            try:
+                move = await bots.move(room.game)
+                if move is None:
+                    return
 
-        except WebSocketDisconnect as ex:
-            print(f"Socket diconnected, removing it: {ex}")
-            sockets.remove(websocket)
-            break
+                await apply_action(room, *move)
+            except Exception as ex:
+                logger.exception("Unexpected bot error (%s): %s", ex.__class__.__name__, ex)
 
+                # The failed action might have changed the game
+                broadcast_state(room)
+                store.snapshot(room.room_id, room.state)
+                return
+
+
+async def handle_message(room: Room, websocket, data: dict):
+    """Applies a message of a socket to its room"""
+    logger.debug("Received message %s", data)
+
+    try:
+        #
+        # Clients that missed a version ask for the full state
+        #
+        if data.get("action") == "resync":
+            async with room.lock:
+                send(room, websocket, room.snapshot(room.viewers.get(websocket)))
+            return
+
+        #
+        # Admins can profile the next actions (see `conga.profiling`)
+        #
+        if data.get("action") == "profile":
+            params = data.get("action_params", {})
+            admin_token = os.environ.get("CONGA_ADMIN_TOKEN")
+
+            if admin_token and params.get("token") == admin_token:
+                profiler.enable(int(params.get("actions", 100)))
+            else:
+                logger.warning("Ignoring profile message without a valid admin token")
+            return
+
+        #
+        # Bots join as players named after `BOT_PREFIX`, played by the server
+        #
+        if data.get("action") == "add_bot":
+            async with room.lock:
+                room.touch()
+                names = {player.name for player in room.game.players}
+                bot_names = (f"{BOT_PREFIX}{ix}" for ix in itertools.count(1))
+
+                name = next(name for name in bot_names if name not in names)
+                await apply_action(room, "add_player", {"name": name})
+            return
+
+        params = data["action_params"] if "action_params" in data else {}
+        if data["action"] == "add_player" and is_bot(params.get("name", "")):
+            raise ValueError(f"Player names can't start with {BOT_PREFIX!r}")
+
+        async with room.lock:
+            room.touch()
+
+            #
+            # Players reconnect with the token they got when they were added
+            #
+            if data["action"] == "add_player" and "token" in params:
+                name = params["name"]
+                if not hmac.compare_digest(room.tokens.get(name, ""), params["token"]):
+                    raise ValueError(f"Invalid token for player {name!r}")
+
+                room.viewers[websocket] = name
+                send(room, websocket, room.snapshot(name))
+                return
+
+            n_players = len(room.game.players)
+            await apply_action(room, data["action"], params)
+
+            #
+            # The socket sees the game as this player from now on, only if it added it (names of
+            # players that already joined are ignored by the game)
+            #
+            if data["action"] == "add_player" and len(room.game.players) > n_players:
+                name = params["name"]
+                room.tokens[name] = secrets.token_urlsafe(16)
+                room.viewers[websocket] = name
+                send(room, websocket, {**room.snapshot(name), "token": room.tokens[name]})
+
+        schedule_bots(room)
+
+    except Exception as ex:
+        await report_error(room, websocket, ex)
+
+
+async def report_error(room: Room, websocket, ex: Exception):
+    logger.exception("Unexpected error (%s): %s", ex.__class__.__name__, ex)
+
+    async with room.lock:
+        broadcast_state(room)
+        send(room, websocket, {"error": str(ex), "version": room.version})
+
+        # The failed action might have changed the game
+        store.snapshot(room.room_id, room.state)
+
+
+@app.websocket("/ws/{room_id}")
+async def websocket_endpoint(websocket: WebSocket, room_id: str):
+    #
+    # In scale-out mode, rooms owned by other nodes are relayed to them
+    #
+    if node is not None and not node.is_local(room_id):
+        await node.serve_remote(room_id, websocket)
+        return
+
+    try:
+        room = await rooms.join(room_id, websocket)
+    except RoomError as ex:
+        logger.warning("Rejecting socket connection: %s", ex)
+        await websocket.close(code=1008)
+        return
+
+    # Clients asking for the binary protocol use it, the others JSON (see `conga.wire`)
+    subprotocol = wire.negotiate(websocket)
+    if subprotocol is not None:
+        room.binary.add(websocket)
+
+    await websocket.accept(subprotocol=subprotocol)
+    await connect(room, websocket)
+
+    while True:
+        try:
+            data = await wire.receive_message(websocket, websocket in room.binary)
         except Exception as ex:
-            print(f"Unexpected error ({ex.__class__.__name__}): {ex}")
-            print(traceback.format_exc())
-            await websocket.send_json({"game": game.to_dict(), "error": str(ex)})
+            if wire.is_disconnected(websocket, ex):
+                logger.info("Socket disconnected, removing it: %s", ex)
+                rooms.leave(room, websocket)
+                break
+
+            # Invalid messages didn't change the game, they are only reported to their socket
+            logger.warning("Invalid message (%s): %s", ex.__class__.__name__, ex)
+            send(room, websocket, {"error": f"Invalid message: {ex}", "version": room.version})
+            continue
+
+        await handle_message(room, websocket, data)
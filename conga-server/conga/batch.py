@@ -0,0 +1,200 @@
+"""Batch hand evaluation with NumPy, for simulations and analysis.
+
+Hands are rows of an integer array of card codes (see `Card.code`). `evaluate_hands` returns the
+score of every hand and, for every card, the game it belongs to, the same as calling
+`check_cards_values` on every hand.
+
+Most hands are evaluated for the whole batch at once from their card histograms. Without jokers,
+a card can only be part of the same-of-a-kind of its number (when there are three or more cards
+of it) or of the flush of its run of consecutive numbers (three or more cards of its suit). When
+no card can be part of both, games don't compete for cards and the best games are every
+same-of-a-kind and every run, whole. The other hands (jokers, cards in both kinds of games,
+repeated cards in a run or runs too long for a single flush) are searched once per distinct hand,
+with the cached search of the player module.
+
+Requires the `analysis` extra (`numpy`).
+"""
+from typing import Tuple
+
+import numpy as np
+
+from conga.card import JOKER_CODE, N_CARD_CODES, Suit
+from conga.meld_table import SUIT_PERMUTATIONS
+from conga.player import _best_melds
+
+N_SUITS = len(Suit) + 1
+N_NUMBERS = 13
+MAX_FLUSH_LENGTH = 6
+
+PERMUTATIONS = np.array(SUIT_PERMUTATIONS, dtype=np.int64)
+
+
+def card_histograms(hands: np.ndarray) -> np.ndarray:
+    """Number of cards of every code in every hand, as an array of shape (N, number of codes)"""
+    n_hands = hands.shape[0]
+    offsets = np.arange(n_hands)[:, None] * N_CARD_CODES
+
+    return np.bincount((hands + offsets).ravel(), minlength=n_hands * N_CARD_CODES).reshape(
+        n_hands, N_CARD_CODES
+    )
+
+
+def may_have_games(hands: np.ndarray) -> np.ndarray:
+    """Whether every hand might have a game. False means it certainly has none
+
+    * A same-of-a-kind needs two cards of a number and a joker, or three cards of a number
+    * Every flush starts with three consecutive numbers of a suit, or two of them and a joker
+      (`5, 6, J`, `5, J, 7`, or `11, J, 12`)
+    """
+    histograms = card_histograms(hands)
+    jokers = histograms[:, JOKER_CODE]
+
+    # Cards by (N, suit, number)
+    suits = histograms[:, : N_SUITS * N_NUMBERS].reshape(-1, N_SUITS, N_NUMBERS)[:, 1:]
+    numbers = suits.sum(axis=1)
+
+    same_of_a_kind = ((numbers >= 3) | ((numbers >= 2) & (jokers[:, None] >= 1))).any(axis=1)
+
+    # Cards present in every window of three numbers of a suit, from 1 to 12
+    present = np.pad((suits[:, :, 1:] > 0).astype(np.int8), ((0, 0), (0, 0), (0, 2)))
+    windows = present[:, :, :-2] + present[:, :, 1:-1] + present[:, :, 2:]
+    flush = ((windows >= 3) | ((windows >= 2) & (jokers[:, None, None] >= 1))).any(axis=(1, 2))
+
+    return same_of_a_kind | flush
+
+
+def _canonical_permutations(hands: np.ndarray) -> np.ndarray:
+    """Suit permutation of every hand (without jokers) to its suit-normalized hand, the same as
+    `canonical_hand`, as an array of shape (N, number of suits)"""
+    suits, numbers = np.divmod(hands, N_NUMBERS)
+
+    # Hands sorted after every permutation, of shape (N, permutations, cards per hand)
+    permuted = np.sort(PERMUTATIONS[:, suits].transpose(1, 0, 2) * N_NUMBERS + numbers[:, None], 2)
+
+    # Lowest permuted hand (lexicographic, column by column), the first permutation on ties
+    lowest = np.ones(permuted.shape[:2], dtype=bool)
+    for column in np.moveaxis(permuted, 2, 0):
+        column = np.where(lowest, column, N_CARD_CODES)
+        lowest &= column == column.min(axis=1, keepdims=True)
+
+    return PERMUTATIONS[lowest.argmax(axis=1)]
+
+
+def _evaluate_disjoint(hands: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Scores and games masks of the hands whose games can't share cards, and whether every hand
+    was evaluated. The other hands are scored as if they had no games"""
+    rows = np.arange(len(hands))[:, None]
+    jokers = hands == JOKER_CODE
+    suits, numbers = np.divmod(np.where(jokers, 0, hands), N_NUMBERS)
+
+    # Cards by (N, suit, number). There's no suit 0, so jokers are looked up there as no card
+    cards = card_histograms(hands)[:, : N_SUITS * N_NUMBERS].reshape(-1, N_SUITS, N_NUMBERS)
+    present = np.pad(cards > 0, ((0, 0), (0, 0), (0, 1)))
+
+    # Consecutive cards of the suit up to (left) and from (right) every number
+    left = np.zeros(present.shape, dtype=np.int64)
+    right = np.zeros(present.shape, dtype=np.int64)
+    for number in range(1, N_NUMBERS):
+        left[:, :, number] = (left[:, :, number - 1] + 1) * present[:, :, number]
+        right[:, :, -number - 1] = (right[:, :, -number] + 1) * present[:, :, -number - 1]
+
+    card_lefts = left[rows, suits, numbers]
+    card_runs = card_lefts + right[rows, suits, numbers] - 1
+    number_counts = cards.sum(axis=1)
+
+    in_flush = card_runs >= 3
+    in_same_of_a_kind = number_counts[rows, numbers] >= 3
+
+    evaluated = ~(
+        jokers
+        | (in_flush & in_same_of_a_kind)
+        | (in_flush & (cards[rows, suits, numbers] > 1))
+        | (card_runs > MAX_FLUSH_LENGTH)
+    ).any(axis=1)
+
+    in_game = in_flush | in_same_of_a_kind
+    scores = np.where(in_game, 0, numbers).sum(axis=1)
+
+    # Games are ordered by their lowest card once the suits are normalized (see
+    # `_search_candidates`), which only needs the permutations of the hands with several games
+    permutations = np.broadcast_to(PERMUTATIONS[0], (len(hands), N_SUITS)).copy()
+    n_games = ((left[:, :, :-1] == 1) & (right[:, :, :-1] >= 3)).sum(axis=(1, 2)) + (
+        number_counts >= 3
+    ).sum(axis=1)
+
+    several = np.flatnonzero(evaluated & (n_games > 1))
+    permutations[several] = _canonical_permutations(hands[several])
+
+    card_suits = permutations[rows, suits]
+    same_number = numbers[:, :, None] == numbers[:, None, :]
+    lowest_suits = np.where(same_number, card_suits[:, None], N_SUITS).min(axis=2)
+
+    keys = np.where(
+        in_flush,
+        card_suits * N_NUMBERS + numbers - card_lefts + 1,
+        np.where(in_same_of_a_kind, lowest_suits * N_NUMBERS + numbers, N_CARD_CODES),
+    )
+
+    # Game of every card: the number of distinct lower keys of the hand, plus one
+    equal = keys[:, :, None] == keys[:, None, :]
+    first = ~(equal & np.tri(hands.shape[1], k=-1, dtype=bool)).any(axis=2)
+    lower = (keys[:, None, :] < keys[:, :, None]) & first[:, None, :]
+    masks = np.where(in_game, lower.sum(axis=2) + 1, 0).astype(np.int8)
+
+    return scores, masks, evaluated
+
+
+def _games_mask(hand_key: Tuple[int, ...], melds: Tuple[Tuple[int, ...], ...]) -> np.ndarray:
+    # Game of every card of a sorted hand, taking the first card not used yet for every code
+    mask = np.zeros(len(hand_key), dtype=np.int8)
+
+    for game, meld in enumerate(melds, start=1):
+        for code in meld:
+            ix = hand_key.index(code)
+            while mask[ix]:
+                ix += 1
+
+            mask[ix] = game
+
+    return mask
+
+
+def evaluate_hands(hands) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluates a batch of hands, an integer array of card codes of shape (N, cards per hand)
+
+    Returns
+    -------
+    The score of every hand, of shape (N,), and the games mask of shape (N, cards per hand): the
+    game (starting at 1, in the order of `check_cards_values`) of every card, or 0 for the cards
+    that are not part of any game
+    """
+    hands = np.asarray(hands, dtype=np.int64)
+    if hands.ndim != 2:
+        raise ValueError(f"Expected an array of shape (N, cards per hand), got {hands.shape}")
+
+    scores, masks, evaluated = _evaluate_disjoint(hands)
+
+    searched = np.flatnonzero(~evaluated & may_have_games(hands))
+    if not len(searched):
+        return scores, masks
+
+    # Hands are searched once per distinct hand, as sorted card codes
+    order = np.argsort(hands[searched], axis=1, kind="stable")
+    sorted_hands = np.take_along_axis(hands[searched], order, axis=1)
+    keys, inverse = np.unique(sorted_hands, axis=0, return_inverse=True)
+
+    keys_scores = np.empty(len(keys), dtype=np.int64)
+    keys_masks = np.empty(keys.shape, dtype=np.int8)
+    for ix, key in enumerate(keys.tolist()):
+        melds, keys_scores[ix] = _best_melds(tuple(key))
+        keys_masks[ix] = _games_mask(tuple(key), melds)
+
+    inverse = inverse.reshape(-1)
+    scores[searched] = keys_scores[inverse]
+
+    # Back from the sorted hands to the order of the cards in the batch
+    searched_masks = np.empty(order.shape, dtype=np.int8)
+    np.put_along_axis(searched_masks, order, keys_masks[inverse], axis=1)
+    masks[searched] = searched_masks
+
+    return scores, masks
@@ -0,0 +1,261 @@
+"""Bot players, to fill tables short of players.
+
+Bots are players whose name starts with `BOT_PREFIX`. On their turn they decide from what their
+player can see: their hand, the top of the discard pile and the cards they haven't seen (the
+decks without their hand and the top of the discard pile).
+
+Decisions look one turn ahead. A card to throw is scored by the expected deadwood (the score left
+out of games) of the hand after the next pick, averaging over a sample of unseen cards. Every
+candidate is evaluated with the same sampled cards, in rounds, until the time budget runs out, so
+a decision returns within the budget with as many samples as it had time for. Picking from the
+discard pile is decided the same way, comparing its top card with the expected card of the deck.
+Hands are evaluated with the cached search of `check_cards_values`.
+
+`BotEngine` runs the decisions in an executor, off the event loop.
+"""
+import asyncio
+import math
+import random
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from random import Random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from conga.card import deck_cards
+from conga.game import Game, GameStatus
+from conga.player import Player, _best_melds
+
+BOT_PREFIX = "bot-"
+
+# Highest hand score a player can finish a match with (see `Player.update_state`)
+FINISH_SCORE = 5
+
+
+def is_bot(name: str) -> bool:
+    return name.startswith(BOT_PREFIX)
+
+
+@dataclass(frozen=True)
+class Situation:
+    """What a bot knows when deciding, as card codes (see `Card.code`). `hand` is in the order of
+    the player hand, so indexes are card ids"""
+
+    hand: Tuple[int, ...]
+    discard_top: Optional[int]
+    unseen: Tuple[int, ...]
+    hand_score: int
+
+    @classmethod
+    def of(cls, game: Game, player: Player) -> "Situation":
+        hand = tuple(card.code for card in player.hand)
+        discard_top = game.discard_deck.cards[0].code if game.discard_deck.cards else None
+
+        unseen = Counter(card.code for card in deck_cards(math.ceil(len(game.players) / 4)))
+        unseen.subtract(hand + ((discard_top,) if discard_top is not None else ()))
+
+        return cls(
+            hand=hand,
+            discard_top=discard_top,
+            unseen=tuple(sorted(unseen.elements())),
+            hand_score=player.hand_score,
+        )
+
+
+def _score(codes: Sequence[int]) -> int:
+    return _best_melds(tuple(sorted(codes)))[1]
+
+
+def _best_throw(codes: Sequence[int]) -> int:
+    """Score left after throwing the highest card out of the best games of a hand. It's the
+    lowest score left after throwing any card in all but a few hands in a thousand, with a single
+    search instead of one per card"""
+    melds, score = _best_melds(tuple(sorted(codes)))
+
+    deadwood = Counter(codes)
+    deadwood.subtract(code for meld in melds for code in meld)
+
+    return score - max((code % 13 for code in deadwood.elements()), default=0)
+
+
+def _sample_rounds(
+    hands: List[Tuple[int, ...]],
+    situation: Situation,
+    rng: Random,
+    deadline: float,
+    max_samples: int,
+) -> Optional[List[float]]:
+    """Expected score of every hand (of 7 cards) after picking an unseen card and throwing the
+    best one. Returns None if there was no time for a single sample"""
+    cards = list(situation.unseen)
+    rng.shuffle(cards)
+
+    totals = [0] * len(hands)
+    rounds = 0
+
+    for card in cards[:max_samples]:
+        round_scores = []
+        for hand in hands:
+            if time.perf_counter() > deadline:
+                break
+
+            round_scores.append(_best_throw(hand + (card,)))
+
+        # Rounds cut by the deadline are discarded, so every hand has the same samples
+        if len(round_scores) < len(hands):
+            break
+
+        totals = [total + score for total, score in zip(totals, round_scores)]
+        rounds += 1
+
+    return [total / rounds for total in totals] if rounds else None
+
+
+def decide_throw(
+    situation: Situation, budget: float, max_samples: int = 64, seed=None
+) -> Dict[str, int]:
+    """Parameters of `player_turn_throw`: the card leaving the lowest expected deadwood"""
+    deadline = time.perf_counter() + budget
+    hand = situation.hand
+
+    # One candidate per distinct card. Ties throw the highest card
+    card_ids = {code: ix for ix, code in enumerate(hand)}
+    candidates = sorted(card_ids, key=lambda code: -(code % 13))
+    rests = [hand[: card_ids[code]] + hand[card_ids[code] + 1 :] for code in candidates]
+
+    # Candidates are only scored while there's time left, the highest cards first
+    scores = []
+    for rest in rests:
+        if time.perf_counter() > deadline:
+            break
+        scores.append(_score(rest))
+
+    if not scores:
+        return {"card_id": card_ids[candidates[0]]}
+
+    candidates, rests = candidates[: len(scores)], rests[: len(scores)]
+
+    # A hand that can finish the match now is better than any expected hand
+    if min(scores) <= FINISH_SCORE:
+        expected = scores
+    else:
+        expected = _sample_rounds(rests, situation, Random(seed), deadline, max_samples) or scores
+
+    best = min(range(len(candidates)), key=lambda ix: (expected[ix], scores[ix]))
+    return {"card_id": card_ids[candidates[best]]}
+
+
+def decide_pick(
+    situation: Situation, budget: float, max_samples: int = 64, seed=None
+) -> Dict[str, bool]:
+    """Parameters of `player_turn_pick`: the discard pile is picked if its top card is better
+    than the expected card of the deck"""
+    if situation.discard_top is None:
+        return {"pick_discard_pile": False}
+
+    # No time for a single search
+    if budget <= 0:
+        return {"pick_discard_pile": False}
+
+    deadline = time.perf_counter() + budget
+    discard_score = _best_throw(situation.hand + (situation.discard_top,))
+    if discard_score <= FINISH_SCORE:
+        return {"pick_discard_pile": True}
+
+    expected = _sample_rounds([situation.hand], situation, Random(seed), deadline, max_samples)
+    deck_score = expected[0] if expected is not None else situation.hand_score
+
+    return {"pick_discard_pile": discard_score < deck_score}
+
+
+def decide_finish(situation: Situation) -> Dict[str, bool]:
+    """Parameters of `player_finish_attempt`. Bots finish as soon as they can: the other players
+    are charged the deadwood of their hands, and waiting gives them a turn to finish first"""
+    return {"player_finishes": True}
+
+
+def next_move(game: Game) -> Optional[str]:
+    """Action the player whose turn it is has to take, if it's a bot"""
+    if game.status != GameStatus.started:
+        return None
+
+    player = game.players[game.match_next_player]
+    if not is_bot(player.name):
+        return None
+
+    if player.can_finish and not player.finish_next_turn:
+        return "player_finish_attempt"
+
+    return "player_turn_pick" if len(player.hand) == 7 else "player_turn_throw"
+
+
+def decide(
+    action: str, situation: Situation, budget: float, max_samples: int = 64, seed=None
+) -> dict:
+    """Parameters of a bot action. Runs in the executor of the engine"""
+    if action == "player_turn_pick":
+        return decide_pick(situation, budget, max_samples, seed)
+    if action == "player_turn_throw":
+        return decide_throw(situation, budget, max_samples, seed)
+
+    return decide_finish(situation)
+
+
+def _fallback(action: str, situation: Situation) -> dict:
+    # Moves that need no search, if a decision takes too long: take from the deck and throw the
+    # highest card
+    if action == "player_turn_pick":
+        return {"pick_discard_pile": False}
+    if action == "player_turn_throw":
+        return {"card_id": max(range(len(situation.hand)), key=lambda ix: situation.hand[ix] % 13)}
+
+    return decide_finish(situation)
+
+
+class BotEngine:
+    """Decides the moves of bots in an executor (the default one of the loop if not given), so
+    searching never blocks the event loop. Decisions taking longer than `budget` plus `grace`
+    times the budget (a busy executor) fall back to a move without search. Rooms are locked while
+    their bots decide, so that's the longest a bot move delays the players"""
+
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        budget: float = 0.02,
+        grace: float = 1.0,
+        max_samples: int = 64,
+    ):
+        self.executor = executor
+        self.budget = budget
+        self.grace = grace
+        self.max_samples = max_samples
+        self.fallbacks = 0
+
+    async def move(self, game: Game) -> Optional[Tuple[str, dict]]:
+        """Next action and its parameters of the bot whose turn it is, or None if it's not the
+        turn of a bot"""
+        action = next_move(game)
+        if action is None:
+            return None
+
+        situation = Situation.of(game, game.players[game.match_next_player])
+
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(
+            self.executor,
+            decide,
+            action,
+            situation,
+            self.budget,
+            self.max_samples,
+            random.getrandbits(64),
+        )
+
+        try:
+            params = await asyncio.wait_for(future, self.budget * (1 + self.grace))
+        except asyncio.TimeoutError:
+            self.fallbacks += 1
+            params = _fallback(action, situation)
+
+        return action, params
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Optional, Union
+
+from conga.codec import dumps
+
+logger = logging.getLogger(__name__)
+
+# Encoded message: a text frame (JSON) or a bytes frame (see `conga.wire`)
+Frame = Union[str, bytes]
+
+
+def encode_message(message: dict) -> str:
+    """Encodes a message once, to be shared by every subscriber"""
+    return dumps(message).decode()
+
+
+@dataclass
+class SubscriberStats:
+    sent: int = 0
+    coalesced: int = 0
+    send_time: float = 0
+    max_send_time: float = 0
+
+
+@dataclass
+class Subscriber:
+    """A socket with its own outgoing queue, drained by its own task"""
+
+    websocket: object
+    queue: asyncio.Queue
+    task: Optional[asyncio.Task] = None
+    lagging_since: Optional[float] = None
+    stats: SubscriberStats = field(default_factory=SubscriberStats)
+
+
+class Broadcaster:
+    """Sends messages to many sockets concurrently, so a slow socket doesn't delay the others
+
+    Every socket has a bounded queue. When a queue is full, its pending messages are replaced by a
+    single full state message (the intermediate states are useless by then). Sockets that keep
+    lagging for more than `max_lag` seconds are closed.
+    """
+
+    def __init__(self, max_queue: int = 32, max_lag: float = 10):
+        self.max_queue = max_queue
+        self.max_lag = max_lag
+        self.subscribers: Dict[object, Subscriber] = {}
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def subscribe(self, websocket) -> Subscriber:
+        subscriber = Subscriber(websocket=websocket, queue=asyncio.Queue(self.max_queue))
+        subscriber.task = asyncio.ensure_future(self._drain(subscriber))
+        self.subscribers[websocket] = subscriber
+
+        return subscriber
+
+    def unsubscribe(self, websocket):
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is not None and subscriber.task is not None:
+            subscriber.task.cancel()
+
+    async def _drain(self, subscriber: Subscriber):
+        while True:
+            frame = await subscriber.queue.get()
+
+            start = time.perf_counter()
+            try:
+                if isinstance(frame, bytes):
+                    await subscriber.websocket.send_bytes(frame)
+                else:
+                    await subscriber.websocket.send_text(frame)
+            except Exception as ex:
+                logger.info("Can't send message to socket, removing it: %s", ex)
+                self.subscribers.pop(subscriber.websocket, None)
+                return
+
+            send_time = time.perf_counter() - start
+            subscriber.stats.sent += 1
+            subscriber.stats.send_time += send_time
+            subscriber.stats.max_send_time = max(subscriber.stats.max_send_time, send_time)
+
+            if subscriber.queue.empty():
+                subscriber.lagging_since = None
+
+    def _drop(self, subscriber: Subscriber):
+        logger.warning("Socket lagging for more than %ss, dropping it", self.max_lag)
+        self.unsubscribe(subscriber.websocket)
+        self.dropped += 1
+
+        asyncio.ensure_future(subscriber.websocket.close(code=1013))
+
+    def send(self, websocket, message: dict):
+        """Sends a message to a single socket, after the messages already queued for it"""
+        if websocket in self.subscribers:
+            self.send_text(websocket, encode_message(message))
+
+    def send_text(self, websocket, text: Frame):
+        """Sends an already encoded message to a single socket"""
+        subscriber = self.subscribers.get(websocket)
+        if subscriber is not None:
+            self._enqueue(subscriber, text, None)
+
+    def publish(
+        self, message: dict, snapshot: Callable[[], dict], websockets: Optional[Iterable] = None
+    ):
+        """Sends a message to every socket (or only to `websockets`). `snapshot` returns the full
+        state message, used to replace the pending messages of lagging sockets"""
+        self.publish_frame(
+            encode_message(message), lambda: encode_message(snapshot()), websockets
+        )
+
+    def publish_frame(
+        self, text: Frame, snapshot: Callable[[], Frame], websockets: Optional[Iterable] = None
+    ):
+        """Sends an already encoded message to every socket (or only to `websockets`)"""
+        snapshot_text = None
+
+        if websockets is None:
+            subscribers = list(self.subscribers.values())
+        else:
+            subscribers = [self.subscribers[ws] for ws in websockets if ws in self.subscribers]
+
+        for subscriber in subscribers:
+            if subscriber.queue.full() and snapshot_text is None:
+                snapshot_text = snapshot()
+
+            self._enqueue(subscriber, text, snapshot_text)
+
+    def _enqueue(self, subscriber: Subscriber, text: Frame, snapshot_text: Optional[Frame]):
+        if not subscriber.queue.full():
+            subscriber.queue.put_nowait(text)
+            return
+
+        now = time.monotonic()
+        if subscriber.lagging_since is None:
+            subscriber.lagging_since = now
+        elif now - subscriber.lagging_since > self.max_lag:
+            self._drop(subscriber)
+            return
+
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+            subscriber.stats.coalesced += 1
+
+        subscriber.queue.put_nowait(snapshot_text if snapshot_text is not None else text)
+
+    def metrics(self) -> dict:
+        """Queue depths and send latencies of the current sockets"""
+        stats = [subscriber.stats for subscriber in self.subscribers.values()]
+        depths = [subscriber.queue.qsize() for subscriber in self.subscribers.values()]
+        sent = sum(stat.sent for stat in stats)
+
+        return {
+            "subscribers": len(self.subscribers),
+            "queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "lagging": sum(1 for s in self.subscribers.values() if s.lagging_since is not None),
+            "sent": sent,
+            "coalesced": sum(stat.coalesced for stat in stats),
+            "dropped": self.dropped,
+            "send_time_avg": sum(stat.send_time for stat in stats) / sent if sent else 0,
+            "send_time_max": max((stat.max_send_time for stat in stats), default=0),
+        }
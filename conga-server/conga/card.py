@@ -1,7 +1,9 @@
+from collections import deque
 from dataclasses import dataclass, field
 from enum import IntEnum
-from random import shuffle
-from typing import List, Union
+from functools import lru_cache
+from random import Random, shuffle
+from typing import Deque, Iterable, Optional, Tuple, Union
 
 from dataclasses_json import dataclass_json
 
@@ -20,11 +22,13 @@ class Joker(IntEnum):
 @dataclass_json
 @dataclass
 class Card:
+    __slots__ = ("suit", "number")
+
     suit: Union[Suit, Joker]
     number: int
 
     def __hash__(self):
-        return self.suit * self.number
+        return self.code
 
     def __eq__(self, other):
         return self.suit == other.suit and self.number == other.number
@@ -59,6 +63,29 @@ class Card:
     def __rsub__(self, other):
         return self.__sub__(other)
 
+    @property
+    def code(self) -> int:
+        """Compact integer encoding of the card (`suit * 13 + number`), jokers are `JOKER_CODE`"""
+        return self.suit * 13 + self.number
+
+    @classmethod
+    def from_code(cls, code: int) -> "Card":
+        suit, number = divmod(code, 13)
+        return cls(suit=Joker(suit) if suit == Joker.joker else Suit(suit), number=number)
+
+
+JOKER_CODE = Joker.joker * 13
+N_CARD_CODES = JOKER_CODE + 1
+
+
+def hand_counts(codes: Iterable[int]) -> bytearray:
+    """Multiset of card codes, indexed by code. Membership and counting are O(1)"""
+    counts = bytearray(N_CARD_CODES)
+    for code in codes:
+        counts[code] += 1
+
+    return counts
+
 
 def build_deck(n_joker=2):
     return [Card(suit, number) for number in range(1, 13) for suit in Suit] + [
@@ -66,16 +93,61 @@ def build_deck(n_joker=2):
     ] * n_joker
 
 
+@lru_cache(maxsize=None)
+def deck_cards(n_decks: int = 1) -> Tuple[Card, ...]:
+    """Unshuffled cards of `n_decks` decks. Cards are never modified, so the same instances are
+    reused by every match instead of building new ones"""
+    return tuple(build_deck()) * n_decks
+
+
+def _shuffle_deque(cards: Deque[Card], rng: Optional[Random] = None):
+    # Shuffling a deque in place is O(n^2) (indexing the middle of a deque is O(n)), so shuffle a
+    # list with the same cards in the same order. The result is the same as shuffling a list
+    buffer = list(cards)
+    (rng.shuffle if rng is not None else shuffle)(buffer)
+
+    cards.clear()
+    cards.extend(buffer)
+
+
+#
+# Decks are deques: cards are taken from (and thrown to) the top of the piles, `cards[0]`, in O(1).
+# They are serialized as lists, the same as before
+#
 @dataclass_json
 @dataclass
 class Deck:
-    cards: List[Card] = field(default_factory=build_deck)
+    cards: Deque[Card] = field(default_factory=lambda: deque(deck_cards()))
+
+    def __post_init__(self):
+        if not isinstance(self.cards, deque):
+            self.cards = deque(self.cards)
+
+    def shuffle(self, rng: Optional[Random] = None):
+        """Shuffles the deck with `rng`, or the global random generator"""
+        _shuffle_deque(self.cards, rng)
 
-    def shuffle(self):
-        shuffle(self.cards)
+    def refill(self, cards: Iterable[Card], rng: Optional[Random] = None):
+        """Replaces the deck cards and shuffles them, reusing the deck buffer"""
+        self.cards.clear()
+        self.cards.extend(cards)
+        self.shuffle(rng)
+
+    def take(self) -> Card:
+        return self.cards.popleft()
 
 
 @dataclass_json
 @dataclass
 class DiscardDeck:
-    cards: List[Card] = field(default_factory=list)
+    cards: Deque[Card] = field(default_factory=deque)
+
+    def __post_init__(self):
+        if not isinstance(self.cards, deque):
+            self.cards = deque(self.cards)
+
+    def take(self) -> Card:
+        return self.cards.popleft()
+
+    def put(self, card: Card):
+        self.cards.appendleft(card)
@@ -0,0 +1,493 @@
+"""Scale-out mode: several server processes (nodes), each one owning a share of the rooms.
+
+Rooms are assigned to nodes by consistent hashing of the room id. A socket connected to a node
+that doesn't own its room is relayed: the node forwards its messages to the owner through the
+backplane, and the owner sees it as a `RemoteSocket`, whose messages are sent back through the
+backplane. The owner treats remote sockets like local ones, so games, views and broadcasts work
+the same.
+
+Backplanes deliver messages addressed to a node, in order, and a `down` message when a node
+stops (or dies), so the sockets it relayed leave their rooms:
+
+* `LocalBackplane`: nodes in the same process (tests)
+* `UnixSocketBackplane`: nodes on the same host, one Unix socket per node in a shared directory
+
+Nodes handle the messages of every room in order, without waiting for the other rooms. Node ids
+are stable, from 0 to the size of the cluster, and the ring is made of all of them: a restarted
+worker takes the id of the one it replaces, so it owns the same rooms.
+
+Run `CONGA_CLUSTER_DIR=/tmp/conga CONGA_CLUSTER_SIZE=4 uvicorn conga.app:app --workers 4`.
+"""
+import asyncio
+import base64
+import bisect
+import fcntl
+import hashlib
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import IO, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from conga import wire
+from conga.broadcast import Broadcaster
+from conga.codec import dumps, loads
+from conga.rooms import ROOM_ID_PATTERN, Room, RoomError, RoomRegistry
+
+logger = logging.getLogger(__name__)
+
+MessageHandler = Callable[[dict], Awaitable[None]]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing: adding or removing a node only moves the keys of that node"""
+
+    def __init__(self, nodes: List[str], replicas: int = 100):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+
+        points = sorted((_hash(f"{node}:{ix}"), node) for node in nodes for ix in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+        self.nodes = sorted(set(nodes))
+
+    def owner(self, key: str) -> str:
+        ix = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[ix]
+
+
+class Backplane:
+    async def start(self, node_id: str, on_message: MessageHandler):
+        """Starts delivering the messages sent to `node_id`, and `{"type": "down", "origin": <node
+        id>}` when a node that sent messages to it stops"""
+        raise NotImplementedError
+
+    async def nodes(self, expected: int, timeout: float = 30) -> List[str]:
+        """Waits until `expected` nodes are started and returns their ids"""
+        raise NotImplementedError
+
+    async def send(self, node_id: str, message: dict):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+    """Nodes in the same process, sharing a `hub`. Messages are encoded and decoded anyway, so
+    they are the same as with other backplanes"""
+
+    def __init__(self, hub: Dict[str, asyncio.Queue]):
+        self.hub = hub
+        self.node_id: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, node_id: str, on_message: MessageHandler):
+        self.node_id = node_id
+        queue = self.hub[node_id] = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                await on_message(await queue.get())
+
+        self._task = asyncio.ensure_future(deliver())
+
+    async def nodes(self, expected: int, timeout: float = 30) -> List[str]:
+        deadline = time.monotonic() + timeout
+        while len(self.hub) < expected:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Only {len(self.hub)} of {expected} nodes started")
+            await asyncio.sleep(0.01)
+
+        return list(self.hub)
+
+    async def send(self, node_id: str, message: dict):
+        queue = self.hub.get(node_id)
+        if queue is None:
+            raise ConnectionRefusedError(f"Node {node_id} is not running")
+
+        queue.put_nowait(loads(dumps(message)))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+        if self.hub.pop(self.node_id, None) is not None:
+            for queue in self.hub.values():
+                queue.put_nowait({"type": "down", "origin": self.node_id})
+
+
+class UnixSocketBackplane(Backplane):
+    """Nodes on the same host. Every node listens on `<directory>/<node id>.sock` and keeps one
+    connection to every other node, so messages between two nodes are delivered in order. A
+    connection starts with a `hello` line with the id of its node, and a `down` message is
+    delivered when it closes.
+
+    Node ids are slots, from 0 to the size of the cluster: a node holds the lock of
+    `<directory>/<node id>.lock` while it runs, and the lock of a dead process is released, so its
+    slot is taken by the next node that starts.
+    """
+
+    def __init__(self, directory: str, line_limit: int = 2 ** 24):
+        self.directory = directory
+        self.line_limit = line_limit
+        self.node_id: Optional[str] = None
+        self.path: Optional[str] = None
+        self._lock_file: Optional[IO] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Dict[str, asyncio.StreamWriter] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _path(self, node_id: str, extension: str = "sock") -> str:
+        return os.path.join(self.directory, f"{node_id}.{extension}")
+
+    async def claim(self, size: int, timeout: float = 30) -> str:
+        """Takes the first free node id of a cluster of `size` nodes"""
+        os.makedirs(self.directory, exist_ok=True)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            for slot in range(size):
+                lock_file = open(self._path(str(slot), "lock"), "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+
+                self._lock_file = lock_file
+                return str(slot)
+
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"All the {size} node ids are taken")
+            await asyncio.sleep(0.1)
+
+    def _is_alive(self, node_id: str) -> bool:
+        if not os.path.exists(self._path(node_id)):
+            return False
+
+        with open(self._path(node_id, "lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+    def _alive_nodes(self) -> List[str]:
+        names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        node_ids = sorted(name[: -len(".lock")] for name in names if name.endswith(".lock"))
+
+        return [node_id for node_id in node_ids if self._is_alive(node_id)]
+
+    async def start(self, node_id: str, on_message: MessageHandler):
+        os.makedirs(self.directory, exist_ok=True)
+        self.node_id = node_id
+        self.path = self._path(node_id)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            origin = None
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                message = loads(line)
+                if message["type"] == "hello":
+                    origin = message["origin"]
+                else:
+                    await on_message(message)
+
+            writer.close()
+
+            # The node stopped, the connection to its next process will be a new one
+            if origin is not None:
+                stale_writer = self._writers.pop(origin, None)
+                if stale_writer is not None:
+                    stale_writer.close()
+
+                await on_message({"type": "down", "origin": origin})
+
+        self._server = await asyncio.start_unix_server(
+            receive, path=self.path, limit=self.line_limit
+        )
+
+    async def nodes(self, expected: int, timeout: float = 30) -> List[str]:
+        deadline = time.monotonic() + timeout
+        while len(self._alive_nodes()) < expected:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Only {len(self._alive_nodes())} of {expected} nodes started")
+            await asyncio.sleep(0.1)
+
+        return self._alive_nodes()
+
+    async def send(self, node_id: str, message: dict):
+        lock = self._locks.setdefault(node_id, asyncio.Lock())
+
+        async with lock:
+            writer = self._writers.get(node_id)
+            if writer is None or writer.is_closing():
+                _, writer = await asyncio.open_unix_connection(
+                    self._path(node_id), limit=self.line_limit
+                )
+                writer.write(dumps({"type": "hello", "origin": self.node_id}) + b"\n")
+                self._writers[node_id] = writer
+
+            writer.write(dumps(message) + b"\n")
+            await writer.drain()
+
+    async def close(self):
+        for writer in self._writers.values():
+            writer.close()
+
+        if self._server is not None:
+            self._server.close()
+
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+
+class RemoteSocket:
+    """A socket connected to another node, as seen by the node owning its room"""
+
+    def __init__(self, backplane: Backplane, node_id: str, socket_id: str):
+        self.backplane = backplane
+        self.node_id = node_id
+        self.socket_id = socket_id
+
+    async def send_text(self, text: str):
+        await self.backplane.send(
+            self.node_id, {"type": "send", "socket_id": self.socket_id, "text": text}
+        )
+
+    async def send_bytes(self, data: bytes):
+        await self.backplane.send(
+            self.node_id,
+            {"type": "send", "socket_id": self.socket_id, "bytes": base64.b64encode(data).decode()},
+        )
+
+    async def close(self, code: int = 1000):
+        await self.backplane.send(
+            self.node_id, {"type": "close", "socket_id": self.socket_id, "code": code}
+        )
+
+
+class Node:
+    """A server process of the cluster
+
+    `connect` and `handle_message` are the handlers of the sockets of the rooms of this node (see
+    `conga.app`), used for remote sockets too.
+    """
+
+    def __init__(
+        self,
+        node_id: str,
+        backplane: Backplane,
+        rooms: RoomRegistry,
+        connect: Callable[[Room, object], Awaitable[None]],
+        handle_message: Callable[[Room, object, dict], Awaitable[None]],
+    ):
+        self.node_id = node_id
+        self.backplane = backplane
+        self.rooms = rooms
+        self.connect = connect
+        self.handle_message = handle_message
+        self.ring: Optional[HashRing] = None
+
+        # Sockets connected to this node whose rooms are owned by other nodes (with their owner),
+        # and their queues
+        self.relayed: Dict[str, Tuple[str, object]] = {}
+        self.relay = Broadcaster()
+
+        # Sockets connected to other nodes whose rooms are owned by this node
+        self.remote: Dict[Tuple[str, str], Tuple[Room, RemoteSocket]] = {}
+
+        # Messages to the rooms of this node waiting to be handled, and the task of every room
+        # handling them in order
+        self.inboxes: Dict[str, Deque[dict]] = {}
+        self._inbox_tasks: Set[asyncio.Task] = set()
+
+    async def start(self, expected_nodes: int, timeout: float = 30):
+        """Joins the cluster of `expected_nodes` nodes, once they are started. The ring is made of
+        every node id (`0` to `expected_nodes - 1`), not of the nodes that happen to be running,
+        so every node finds the same owner for a room"""
+        node_ids = [str(slot) for slot in range(expected_nodes)]
+        if self.node_id not in node_ids:
+            raise ValueError(f"Invalid node id {self.node_id!r}, expected one of {node_ids}")
+
+        await self.backplane.start(self.node_id, self.on_message)
+        await self.backplane.nodes(expected_nodes, timeout)
+        self.ring = HashRing(node_ids)
+
+        logger.info("Node %s joined the cluster of nodes %s", self.node_id, self.ring.nodes)
+
+    async def stop(self):
+        await self.backplane.close()
+
+        for task in self._inbox_tasks:
+            task.cancel()
+
+    def is_local(self, room_id: str) -> bool:
+        return self.ring.owner(room_id) == self.node_id
+
+    async def serve_remote(self, room_id: str, websocket):
+        """Relays a socket to the node owning its room, until it disconnects"""
+        if not ROOM_ID_PATTERN.match(room_id):
+            logger.warning("Rejecting socket connection: invalid room id %r", room_id)
+            await websocket.close(code=1008)
+            return
+
+        subprotocol = wire.negotiate(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+
+        owner = self.ring.owner(room_id)
+        socket_id = uuid.uuid4().hex
+        address = {"origin": self.node_id, "socket_id": socket_id, "room_id": room_id}
+
+        self.relayed[socket_id] = (owner, websocket)
+        self.relay.subscribe(websocket)
+
+        try:
+            binary = subprotocol is not None
+            await self.backplane.send(owner, {"type": "join", **address, "binary": binary})
+
+            # Binary frames are decoded here, the owner receives JSON messages
+            while True:
+                try:
+                    data = await wire.receive_message(websocket, binary)
+                except Exception as ex:
+                    if wire.is_disconnected(websocket, ex):
+                        logger.info("Relayed socket disconnected: %s", ex)
+                        break
+
+                    logger.warning("Ignoring invalid message of a relayed socket: %s", ex)
+                    continue
+
+                await self.backplane.send(owner, {"type": "message", **address, "data": data})
+
+        except OSError as ex:
+            # The owner is restarting, clients reconnect to its next process
+            logger.warning("Can't relay socket to node %s, closing it: %s", owner, ex)
+            await websocket.close(code=1012)
+
+        finally:
+            self.relayed.pop(socket_id, None)
+            self.relay.unsubscribe(websocket)
+
+            try:
+                await self.backplane.send(owner, {"type": "leave", **address})
+            except OSError:
+                pass
+
+    async def on_message(self, message: dict):
+        kind = message["type"]
+
+        #
+        # Messages of the owner of a room to a socket relayed by this node. They are queued, so a
+        # slow socket doesn't delay the other messages of the owner
+        #
+        if kind in ["send", "close"]:
+            _, websocket = self.relayed.get(message["socket_id"], (None, None))
+            if websocket is None:
+                return
+
+            if kind == "send" and "bytes" in message:
+                self.relay.send_text(websocket, base64.b64decode(message["bytes"]))
+            elif kind == "send":
+                self.relay.send_text(websocket, message["text"])
+            else:
+                asyncio.ensure_future(websocket.close(code=message["code"]))
+
+        #
+        # A node stopped: the sockets it relayed leave their rooms (after their pending messages)
+        # and the sockets relayed to it are closed, so their clients reconnect to its next process
+        #
+        elif kind == "down":
+            origin = message["origin"]
+            logger.warning("Node %s is down", origin)
+
+            for owner, websocket in list(self.relayed.values()):
+                if owner == origin:
+                    asyncio.ensure_future(websocket.close(code=1012))
+
+            room_ids = {
+                room.room_id for (node_id, _), (room, _) in self.remote.items() if node_id == origin
+            }
+            for room_id in room_ids | set(self.inboxes):
+                self._dispatch({"type": "down", "origin": origin, "room_id": room_id})
+
+        #
+        # Messages of a socket connected to another node, to a room owned by this node
+        #
+        else:
+            self._dispatch(message)
+
+    def _dispatch(self, message: dict):
+        room_id = message["room_id"]
+
+        inbox = self.inboxes.get(room_id)
+        if inbox is None:
+            inbox = self.inboxes[room_id] = deque()
+
+            task = asyncio.ensure_future(self._handle_inbox(room_id, inbox))
+            self._inbox_tasks.add(task)
+            task.add_done_callback(self._inbox_tasks.discard)
+
+        inbox.append(message)
+
+    async def _handle_inbox(self, room_id: str, inbox: Deque[dict]):
+        try:
+            while inbox:
+                message = inbox.popleft()
+                try:
+                    await self._handle_room_message(message)
+                except Exception as ex:
+                    logger.exception("Error handling a relayed %s message: %s", message["type"], ex)
+        finally:
+            del self.inboxes[room_id]
+
+    async def _handle_room_message(self, message: dict):
+        kind = message["type"]
+        key = (message["origin"], message.get("socket_id"))
+
+        if kind == "join":
+            socket = RemoteSocket(self.backplane, message["origin"], message["socket_id"])
+            try:
+                room = await self.rooms.join(message["room_id"], socket)
+            except RoomError as ex:
+                logger.warning("Rejecting relayed socket connection: %s", ex)
+                await socket.close(code=1008)
+                return
+
+            if message.get("binary"):
+                room.binary.add(socket)
+
+            self.remote[key] = (room, socket)
+            await self.connect(room, socket)
+
+        elif kind == "down":
+            for key, (room, socket) in list(self.remote.items()):
+                if key[0] == message["origin"] and room.room_id == message["room_id"]:
+                    del self.remote[key]
+                    self.rooms.leave(room, socket)
+
+        elif key in self.remote:
+            room, socket = self.remote[key]
+
+            if kind == "message":
+                await self.handle_message(room, socket, message["data"])
+            elif kind == "leave":
+                del self.remote[key]
+                self.rooms.leave(room, socket)
@@ -0,0 +1,144 @@
+"""Fast, hand-written game serialization
+
+`encode_game` returns the same document as `Game.to_dict` (wire version 1) without walking the
+dataclasses type hints on every call. Wire version 2 is an opt-in compact format where cards are
+encoded as their integer code (see `Card.code`). `decode_game` reads both versions and returns the
+same game as `Game.from_dict`.
+
+`dumps` encodes straight to bytes, using `orjson` if it's installed.
+"""
+import json
+from typing import List, Optional
+
+from conga.card import N_CARD_CODES, Card, Deck, DiscardDeck
+from conga.game import Game, GameStatus
+from conga.player import Player, PlayerStatus
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+WIRE_VERSIONS = (1, 2)
+
+_CARDS_BY_CODE: List[Optional[Card]] = [None] * N_CARD_CODES
+
+
+def _encode_card(card: Card) -> dict:
+    return {"suit": int(card.suit), "number": card.number}
+
+
+def _encode_card_code(card: Card) -> int:
+    return card.suit * 13 + card.number
+
+
+def _decode_card(data) -> Card:
+    """Cards are never modified, so the same instance is shared for every copy of a card"""
+    code = data if isinstance(data, int) else data["suit"] * 13 + data["number"]
+
+    card = _CARDS_BY_CODE[code]
+    if card is None:
+        card = _CARDS_BY_CODE[code] = Card.from_code(code)
+
+    return card
+
+
+def _encode_player(player: Player, encode_card) -> dict:
+    return {
+        "name": player.name,
+        "hand_score": player.hand_score,
+        "hand_candidates": [
+            [encode_card(card) for card in cand] for cand in player.hand_candidates
+        ],
+        "can_finish": player.can_finish,
+        "finish_next_turn": player.finish_next_turn,
+        "restarts": player.restarts,
+        "score": player.score,
+        "hand": [encode_card(card) for card in player.hand],
+        "hand_discarded": [encode_card(card) for card in player.hand_discarded],
+        "status": int(player.status),
+        "won_match": player.won_match,
+    }
+
+
+def _decode_player(data: dict) -> Player:
+    return Player(
+        name=data["name"],
+        hand_score=data["hand_score"],
+        hand_candidates=[
+            [_decode_card(card) for card in cand] for cand in data["hand_candidates"]
+        ],
+        can_finish=data["can_finish"],
+        finish_next_turn=data["finish_next_turn"],
+        restarts=data["restarts"],
+        score=data["score"],
+        hand=[_decode_card(card) for card in data["hand"]],
+        hand_discarded=[_decode_card(card) for card in data["hand_discarded"]],
+        status=PlayerStatus(data["status"]),
+        won_match=data["won_match"],
+    )
+
+
+def encode_game(game: Game, wire_version: int = 1) -> dict:
+    """Serializes a game, like `Game.to_dict` for the wire version 1"""
+    if wire_version not in WIRE_VERSIONS:
+        raise ValueError(f"Invalid wire version {wire_version}")
+
+    encode_card = _encode_card if wire_version == 1 else _encode_card_code
+
+    data = {
+        "status": int(game.status),
+        "deck": {"cards": [encode_card(card) for card in game.deck.cards]}
+        if game.deck is not None
+        else None,
+        "discard_deck": {"cards": [encode_card(card) for card in game.discard_deck.cards]}
+        if game.discard_deck is not None
+        else None,
+        "players": [_encode_player(player, encode_card) for player in game.players],
+        "match_id": game.match_id,
+        "match_next_player": game.match_next_player,
+        "match_start_player": game.match_start_player,
+    }
+
+    if wire_version != 1:
+        data["wire_version"] = wire_version
+
+    return data
+
+
+def decode_game(data: dict) -> Game:
+    """Deserializes a game of any wire version"""
+    deck, discard_deck = data["deck"], data["discard_deck"]
+
+    return Game(
+        status=GameStatus(data["status"]),
+        deck=Deck(cards=[_decode_card(card) for card in deck["cards"]])
+        if deck is not None
+        else None,
+        discard_deck=DiscardDeck(cards=[_decode_card(card) for card in discard_deck["cards"]])
+        if discard_deck is not None
+        else None,
+        players=[_decode_player(player) for player in data["players"]],
+        match_id=data["match_id"],
+        match_next_player=data["match_next_player"],
+        match_start_player=data["match_start_player"],
+    )
+
+
+def dumps(data) -> bytes:
+    """Encodes a JSON document to bytes, with `orjson` if available"""
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def dump_game(game: Game, wire_version: int = 1) -> bytes:
+    return dumps(encode_game(game, wire_version))
@@ -2,13 +2,26 @@ import itertools
 import math
 from dataclasses import dataclass, field
 from enum import IntEnum
-from typing import List
+from random import Random
+from typing import List, Optional
 
 from dataclasses_json import dataclass_json
-from tqdm import tqdm
 
-from conga.card import Deck, DiscardDeck
-from conga.player import Player, PlayerStatus, check_cards_values
+from conga.card import Deck, DiscardDeck, deck_cards
+from conga.metrics import UPDATE_STATE_SECONDS
+from conga.player import Player, PlayerStatus, meld_extensions
+
+
+#
+# Actions clients can apply to a game
+#
+VALID_ACTIONS = [
+    "add_player",
+    "start_match",
+    "player_turn_pick",
+    "player_turn_throw",
+    "player_finish_attempt",
+]
 
 
 class GameStatus(IntEnum):
@@ -18,6 +31,13 @@ class GameStatus(IntEnum):
     finished: int = 3
 
 
+#
+# Player fields that only the player can see while a match is being played. Their hand is never
+# shown to the other players, only how many cards they have
+#
+PRIVATE_PLAYER_FIELDS = ["hand_score", "hand_candidates", "can_finish"]
+
+
 @dataclass_json
 @dataclass
 class Game:
@@ -34,23 +54,81 @@ class Game:
     match_next_player: int = 0
     match_start_player: int = 0
 
+    def __post_init__(self):
+        # Random generator used to shuffle the decks (the global one if not set). It's not part
+        # of the game state
+        self.rng: Optional[Random] = None
+
+    @staticmethod
+    def project(state: dict, player_name: Optional[str] = None) -> dict:
+        """Builds what a player can see of a serialized game state: their own player, the number
+        of cards of the other players, the top of the discard pile and the deck size.
+
+        Works on the output of `to_dict`, so a state serialized once can be projected for every
+        player.
+        """
+        deck, discard_deck = state["deck"], state["discard_deck"]
+        showcase = state["status"] in (GameStatus.showcase, GameStatus.finished)
+
+        players = []
+        for player in state["players"]:
+            if player["name"] != player_name:
+                hidden_fields = ["hand"] + ([] if showcase else PRIVATE_PLAYER_FIELDS)
+                player = {
+                    **{key: value for key, value in player.items() if key not in hidden_fields},
+                    "hand_count": len(player["hand"]),
+                }
+
+            players.append(player)
+
+        return {
+            **state,
+            "deck": {"cards_count": len(deck["cards"])} if deck is not None else None,
+            "discard_deck": {
+                "cards": discard_deck["cards"][:1],
+                "cards_count": len(discard_deck["cards"]),
+            }
+            if discard_deck is not None
+            else None,
+            "players": players,
+        }
+
+    def player_view(self, player_name: Optional[str] = None) -> dict:
+        """What a player (or a spectator, if no name is given) can see of the game"""
+        return self.project(self.to_dict(), player_name)
+
+    def dispatch(self, action: str, params: dict):
+        """Applies a client action the way the server does: players state is updated before the
+        action, and players hands are sorted after throwing a card or starting a match. Replaying
+        the same actions on the same state results on the same state.
+        """
+        self.update_players_state()
+
+        if action in VALID_ACTIONS:
+            getattr(self, action)(**params)
+
+        if action in ["player_turn_throw", "start_match"]:
+            for player in self.players:
+                player.update_state()
+                player.sort_cards()
+
     def add_player(self, name: str):
         """Adds a new player only if the game didn't start yet"""
         if self.status == GameStatus.lobby and name not in [player.name for player in self.players]:
             self.players.append(Player(name=name))
 
     def _prepare_deck(self):
-        """Builds a deck and shuffles it. It "adds" a new deck every 4 players"""
-        self.deck = Deck()
-        self.discard_deck = DiscardDeck()
+        """Fills the deck and shuffles it. It "adds" a new deck every 4 players. The piles of the
+        previous match are reused"""
+        if self.deck is None:
+            self.deck = Deck()
+        if self.discard_deck is None:
+            self.discard_deck = DiscardDeck()
 
         n_decks = math.ceil(len(self.players) / 4)
 
-        for i in range(n_decks - 1):
-            new_deck = Deck()
-            self.deck.cards.extend(new_deck.cards)
-
-        self.deck.shuffle()
+        self.deck.refill(deck_cards(n_decks), self.rng)
+        self.discard_deck.cards.clear()
 
     def start_match(self):
         """Starts the match for the first time, or after a showcase state.
@@ -92,19 +170,19 @@ class Game:
         #
         # Pick cards from "the top" of the deck (obviously)
         #
-        new_card = self.discard_deck.cards.pop(0) if pick_discard_pile else self.deck.cards.pop(0)
+        new_card = self.discard_deck.take() if pick_discard_pile else self.deck.take()
         player.hand.append(new_card)
 
     def _reshuffle_deck(self):
         """If deck runs out of cards, reshufle the discard deck and start again"""
-        self.deck.cards = self.discard_deck.cards
-        self.deck.shuffle()
-        self.discard_deck = DiscardDeck()
+        self.deck.refill(self.discard_deck.cards, self.rng)
+        self.discard_deck.cards.clear()
 
     def update_players_state(self):
         """Updates the state for all players"""
-        for player in self.players:
-            player.update_state()
+        with UPDATE_STATE_SECONDS.time():
+            for player in self.players:
+                player.update_state()
 
     def player_turn_throw(self, card_id: int):
         """Current player discards a card from their hand"""
@@ -112,7 +190,7 @@ class Game:
 
         assert len(player.hand) == 8, "Can't throw card"
 
-        self.discard_deck.cards.insert(0, player.hand.pop(card_id))
+        self.discard_deck.put(player.hand.pop(card_id))
 
         #
         # Update state and check if player can finish in this turn
@@ -138,62 +216,50 @@ class Game:
         winning_player.won_match = True
 
         #
-        # Super complicated way of detecting if players can insert their cards in another player
-        # game.
-        #
-        # TODO: think how this should work for more than 15 minutes
-        #
-        t = tqdm()
-
+        # Players can discard the cards of their hand that extend the games of the other players.
+        # The cards that extend a game are looked up in an index (`meld_extensions`) of the game
+        # card codes, which is updated when a card is added to the game.
         #
         # Iterate through players in the expected right direction, starting from the player that
         # started the round
         #
-        for player_a in (
-            self.players[self.match_next_player :] + self.players[: self.match_next_player]
-        ):
-            for player_b in (
-                self.players[self.match_next_player :] + self.players[: self.match_next_player]
-            ):
-                if player_a == player_b:
+        players = self.players[self.match_next_player :] + self.players[: self.match_next_player]
+
+        for player_a in players:
+            for player_b in players:
+                if player_a is player_b:
                     continue
 
-                for i, candidate in enumerate(player_a.hand_candidates):
-                    # Check what player_b' cards can be used to discard points from his/her hand
+                # player_b' cards that are already used can't be discarded
+                used_codes = {
+                    card.code
+                    for card in itertools.chain(player_b.hand_discarded, *player_b.hand_candidates)
+                }
+
+                for candidate in player_a.hand_candidates:
+                    candidate_key = tuple(sorted(card.code for card in candidate))
                     cards_to_discard = [
-                        card
-                        for card in player_b.hand
-                        if card not in list(itertools.chain(*player_b.hand_candidates))
-                        and card not in player_b.hand_discarded
+                        card for card in player_b.hand if card.code not in used_codes
                     ]
 
                     for card in cards_to_discard:
-                        t.set_description(
-                            f"For {player_a.name}'s game #{i}, looking {player_b.name}'s "
-                            "cards to discard"
-                        )
-                        t.update()
+                        if card.code not in meld_extensions(candidate_key):
+                            continue
+
+                        #
+                        # Add this card to the discarded cards of the player (can't be discarded
+                        # twice)
+                        #
+                        player_b.hand_discarded.append(card)
+                        used_codes.add(card.code)
 
                         #
-                        # If we add a card to a game and the resulted score is 0 with no new game
-                        # then we can discard that card
+                        # Also, update the original candidate game. For example, in a flush game
+                        # the discarded cards of a player affect how the other players
+                        # can discard cards
                         #
-                        disc_candidates, candidate_score = check_cards_values(candidate + [card])
-                        if candidate_score == 0 and len(disc_candidates) == 1:
-                            #
-                            # Add this card to the discarded cards of the player
-                            # (can't be discarded twice)
-                            #
-                            player_b.hand_discarded.append(card)
-
-                            #
-                            # Also, update the original candidate game. For example, in a flush game
-                            # the discarded cards of a player affect how the other players
-                            # can discard cards
-                            #
-                            candidate.append(card)
-
-        t.close()
+                        candidate.append(card)
+                        candidate_key = tuple(sorted(candidate_key + (card.code,)))
 
         #
         # Reduce score for all the cards discarded
@@ -0,0 +1,271 @@
+"""Precomputed best games for 7 and 8 card hands.
+
+Hands are normalized by permuting suits, so a table entry covers all the hands that only differ in
+their suits. The table is a binary file of fixed size records sorted by hand, memory-mapped and
+binary searched on lookup:
+
+* header: magic bytes and number of records
+* record: hand card codes (padded with `0xFF`), score, card codes of the games in order and the
+  length of each game (4 bits each)
+
+Build it with `python -m conga.meld_table build <path>` and point the `CONGA_MELD_TABLE`
+environment variable to it. Hands that are not in the table are computed as usual.
+"""
+import argparse
+import itertools
+import mmap
+import os
+import random
+import struct
+import sys
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from conga.card import JOKER_CODE, build_deck
+
+MAGIC = b"CONGAMT1"
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<8sB8sB")
+EMPTY_CODE = 0xFF
+HAND_SIZES = (7, 8)
+
+ENV_VAR = "CONGA_MELD_TABLE"
+
+HandKey = Tuple[int, ...]
+Melds = Tuple[Tuple[int, ...], ...]
+
+# Suit permutations, indexed by suit (there's no suit 0)
+SUIT_PERMUTATIONS = [(0,) + perm for perm in itertools.permutations(range(1, 5))]
+
+
+def _permute(codes: Iterable[int], permutation: Tuple[int, ...]) -> Iterator[int]:
+    return (
+        code if code == JOKER_CODE else permutation[code // 13] * 13 + code % 13 for code in codes
+    )
+
+
+def canonical_hand(hand_key: HandKey) -> Tuple[HandKey, Tuple[int, ...]]:
+    """Returns the suit-normalized hand and the suit permutation that maps the hand to it"""
+    return min(
+        (tuple(sorted(_permute(hand_key, permutation))), permutation)
+        for permutation in SUIT_PERMUTATIONS
+    )
+
+
+def canonical_meld(meld: Tuple[int, ...], permutation: Tuple[int, ...]) -> Tuple[int, ...]:
+    """A game with its suits permuted. The cards of a same-of-a-kind game are sorted (their order
+    is given by the suits), flushes keep the order of their run"""
+    codes = tuple(_permute(meld, permutation))
+    if len({code % 13 for code in codes if code != JOKER_CODE}) > 1:
+        return codes
+
+    return tuple(sorted(codes))
+
+
+def _inverse(permutation: Tuple[int, ...]) -> Tuple[int, ...]:
+    inverse = [0] * len(permutation)
+    for suit, new_suit in enumerate(permutation):
+        inverse[new_suit] = suit
+
+    return tuple(inverse)
+
+
+def _encode_key(hand_key: HandKey) -> bytes:
+    return bytes(hand_key) + bytes([EMPTY_CODE] * (8 - len(hand_key)))
+
+
+def _encode_record(hand_key: HandKey, melds: Melds, score: int) -> bytes:
+    melds_codes = bytes(itertools.chain(*melds))
+    lengths = [len(meld) for meld in melds] + [0, 0]
+
+    return RECORD.pack(_encode_key(hand_key), score, melds_codes, lengths[0] << 4 | lengths[1])
+
+
+def _decode_record(record: bytes) -> Tuple[HandKey, Melds, int]:
+    key, score, melds_codes, lengths = RECORD.unpack(record)
+    hand_key = tuple(code for code in key if code != EMPTY_CODE)
+
+    first_length, second_length = lengths >> 4, lengths & 0x0F
+    melds = (
+        tuple(melds_codes[:first_length]),
+        tuple(melds_codes[first_length : first_length + second_length]),
+    )
+
+    return hand_key, tuple(meld for meld in melds if meld), score
+
+
+class MeldTable:
+    """Read-only, memory-mapped meld table"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a meld table")
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[Tuple[HandKey, Melds, int]]:
+        for ix in range(self.size):
+            yield _decode_record(self._record(ix))
+
+    def _record(self, ix: int) -> bytes:
+        offset = HEADER.size + ix * RECORD.size
+        return self._mmap[offset : offset + RECORD.size]
+
+    def lookup_canonical(self, hand_key: HandKey) -> Optional[Tuple[Melds, int]]:
+        """Binary search of a suit-normalized hand"""
+        key = _encode_key(hand_key)
+        low, high = 0, self.size
+
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            middle_key = self._mmap[offset : offset + 8]
+
+            if middle_key == key:
+                _, melds, score = _decode_record(self._record(middle))
+                return melds, score
+            elif middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def lookup(self, hand_key: HandKey) -> Optional[Tuple[Melds, int]]:
+        """Best games (as card codes of the given hand) and score, or None if the hand is not in
+        the table"""
+        if len(hand_key) not in HAND_SIZES:
+            return None
+
+        canonical_key, permutation = canonical_hand(hand_key)
+        found = self.lookup_canonical(canonical_key)
+        if found is None:
+            return None
+
+        melds, score = found
+        inverse = _inverse(permutation)
+
+        return tuple(canonical_meld(meld, inverse) for meld in melds), score
+
+    def close(self):
+        self._mmap.close()
+
+
+def write_meld_table(path: str, entries: Iterable[Tuple[HandKey, Melds, int]]):
+    """Writes a table from `(canonical hand, games, score)` entries. The file is replaced
+    atomically"""
+    records = sorted(_encode_record(*entry) for entry in entries)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records)))
+        f.writelines(records)
+
+    os.replace(tmp_path, path)
+
+
+_meld_table: Optional[MeldTable] = None
+_meld_table_loaded = False
+
+
+def get_meld_table() -> Optional[MeldTable]:
+    """Lazily loads the table pointed by `CONGA_MELD_TABLE`, if any"""
+    global _meld_table, _meld_table_loaded
+
+    if not _meld_table_loaded:
+        _meld_table_loaded = True
+
+        path = os.environ.get(ENV_VAR)
+        if path and os.path.exists(path):
+            _meld_table = MeldTable(path)
+
+    return _meld_table
+
+
+def set_meld_table(table: Optional[MeldTable]):
+    global _meld_table, _meld_table_loaded
+
+    _meld_table = table
+    _meld_table_loaded = True
+
+
+def deal_hands(n_deals: int, n_decks: int = 1, seed: int = 0) -> List[HandKey]:
+    """Suit-normalized 7 and 8 card hands of random deals"""
+    rng = random.Random(seed)
+    deck_codes = [card.code for card in build_deck()] * n_decks
+    hands = set()
+
+    for _ in range(n_deals):
+        cards = rng.sample(deck_codes, 8)
+        hands.add(canonical_hand(tuple(sorted(cards[:7])))[0])
+        hands.add(canonical_hand(tuple(sorted(cards)))[0])
+
+    return sorted(hands)
+
+
+def build(args) -> int:
+    # Imported here since the player module consults this one
+    from conga.player import _search_melds
+
+    hands = deal_hands(args.deals, n_decks=args.decks, seed=args.seed)
+    entries = [(hand, *_search_melds(hand)) for hand in tqdm(hands, desc="Building meld table")]
+
+    write_meld_table(args.path, entries)
+    print(f"Wrote {len(entries)} hands to {args.path}")
+
+    return 0
+
+
+def verify(args) -> int:
+    from conga.player import _search_melds
+
+    table = MeldTable(args.path)
+    errors = 0
+
+    for hand_key, melds, score in tqdm(table, total=len(table), desc="Verifying meld table"):
+        remaining = list(hand_key)
+        for code in itertools.chain(*melds):
+            remaining.remove(code)
+
+        if (
+            canonical_hand(hand_key)[0] != hand_key
+            or sum(code % 13 for code in remaining) != score
+            or _search_melds(hand_key) != (melds, score)
+        ):
+            print(f"Invalid entry for hand {hand_key}: {melds}, {score}")
+            errors += 1
+
+    print(f"Verified {len(table)} hands, {errors} errors")
+
+    return 1 if errors else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m conga.meld_table", description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build a table from random deals")
+    build_parser.add_argument("path")
+    build_parser.add_argument("--deals", type=int, default=100000)
+    build_parser.add_argument("--decks", type=int, default=1)
+    build_parser.add_argument("--seed", type=int, default=0)
+    build_parser.set_defaults(func=build)
+
+    verify_parser = subparsers.add_parser("verify", help="Check every entry of a table")
+    verify_parser.add_argument("path")
+    verify_parser.set_defaults(func=verify)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""In-process metrics, exported in the Prometheus text format on the `/metrics` route.
+
+Hot paths are timed into histograms (`with ACTION_SECONDS.time(action): ...`). Recording a value
+is a couple of additions, so metrics are always on. Gauges are computed when metrics are
+collected.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(header + list(self.samples()))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help, label_names)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+
+
+class Histogram(Metric):
+    """Distribution of values (durations, in seconds) in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+        # Labels -> [count per bucket (the last one is +Inf), sum]
+        self.series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        series = self.series.get(labels)
+        return sum(series[0]) if series is not None else 0
+
+    def samples(self) -> Iterator[str]:
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _format_labels(self.label_names, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+
+            label_text = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{label_text} {total[0]}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Gauge(Metric):
+    """A value computed when metrics are collected"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        super().__init__(name, help)
+        self.callback = callback
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {self.callback()}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float]) -> Gauge:
+        """Registers a gauge, replacing the previous one with the same name (gauges read the state
+        of objects that might be created again, like the app)"""
+        self.metrics.pop(name, None)
+        return self._register(Gauge(name, help, callback))
+
+    def render(self) -> str:
+        """All the metrics, in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+#
+# Hot paths. Actions are labeled with their name (only the valid ones, the others are "other")
+#
+ACTION_SECONDS = REGISTRY.histogram(
+    "conga_action_seconds", "Time to apply a client action to a game", ["action"]
+)
+ACTION_ERRORS = REGISTRY.counter(
+    "conga_action_errors_total", "Client actions that raised an error", ["action"]
+)
+ACTION_TIMEOUTS = REGISTRY.counter(
+    "conga_action_timeouts_total",
+    "Offloaded actions that took longer than their timeout (threads keep running them, process "
+    "pools are replaced)",
+    ["action"],
+)
+ACTION_REJECTIONS = REGISTRY.counter(
+    "conga_action_rejections_total",
+    "Offloaded actions rejected because too many actions were still running",
+    ["action"],
+)
+UPDATE_STATE_SECONDS = REGISTRY.histogram(
+    "conga_update_players_state_seconds", "Time to update the state of every player of a game"
+)
+SERIALIZE_SECONDS = REGISTRY.histogram("conga_serialize_seconds", "Time to serialize a game")
+PATCH_SECONDS = REGISTRY.histogram(
+    "conga_patch_seconds", "Time to project and diff the views of a game state change"
+)
+BROADCAST_SECONDS = REGISTRY.histogram(
+    "conga_broadcast_seconds", "Time to serialize, diff and queue the messages of a state change"
+)
+PERSISTENCE_SECONDS = REGISTRY.histogram(
+    "conga_persistence_write_seconds", "Time to write a batch of actions and snapshots to disk"
+)
+PERSISTENCE_WRITES = REGISTRY.counter(
+    "conga_persistence_writes_total", "Log lines and snapshots written to disk", ["kind"]
+)
@@ -0,0 +1,180 @@
+"""Runs the CPU heavy actions of games off the event loop.
+
+Showcases (`player_finish_attempt` looks up the games of every pair of players) and starting
+matches (dealing and evaluating every hand) take milliseconds. Applied on the event loop, they
+delay every other table of the process. `ActionRunner` applies them in an executor instead:
+
+* `thread`: a thread pool. The event loop keeps running between the bytecodes of the action
+* `process`: a process pool, so actions of different rooms run in parallel
+
+Actions are applied to a copy of the game (encoded with the codec, which is also what is sent to
+worker processes) and the room game is replaced by the result, so an action that fails or times
+out leaves the game as it was. Actions of a room are applied holding its lock, so they are still
+applied one at a time and in order. Cheap actions are applied inline, since copying the game
+costs more than applying them.
+
+Threads can't be stopped: an action that times out keeps running in its thread until it ends,
+holding a worker. Process pools are replaced instead, killing their workers. No more than
+`max_pending` actions are in flight, more fail right away instead of queueing behind stuck ones.
+
+Configure it with `CONGA_ACTION_EXECUTOR` (`inline`, `thread` or `process`),
+`CONGA_ACTION_WORKERS`, `CONGA_ACTION_TIMEOUT_MS` and `CONGA_OFFLOAD_ACTIONS` (comma separated).
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from random import Random
+from typing import Callable, Collection, Optional
+
+from conga.codec import decode_game, encode_game
+from conga.game import Game
+from conga.metrics import ACTION_REJECTIONS, ACTION_TIMEOUTS
+
+OFFLOADED_ACTIONS = ("start_match", "player_finish_attempt")
+
+
+class ActionTimeoutError(Exception):
+    pass
+
+
+def _run_action(state: dict, rng: Optional[Random], action: str, params: dict) -> dict:
+    # Runs in the executor
+    game = decode_game(state)
+    game.rng = rng
+    game.dispatch(action, params)
+
+    return encode_game(game, wire_version=2)
+
+
+def _process_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _shutdown(executor: Executor):
+    # `cancel_futures` is new in Python 3.9
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        executor.shutdown(wait=False)
+
+
+def _kill_workers(executor: ProcessPoolExecutor):
+    # Workers of process pools are only public since Python 3.14
+    if hasattr(executor, "terminate_workers"):
+        executor.terminate_workers()
+    else:
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+
+    _shutdown(executor)
+
+
+class ActionRunner:
+    """Applies actions to games, running `actions` in `executor` (all of them inline if there's no
+    executor). Offloaded actions taking more than `timeout` seconds fail with
+    `ActionTimeoutError`, and so do actions offloaded while `max_pending` actions are in flight.
+
+    If there's an `executor_factory`, an executor with a timed out action is replaced by a new one,
+    and killed if it's a process pool. Otherwise timed out actions keep running until they end."""
+
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        timeout: float = 10,
+        actions: Collection[str] = OFFLOADED_ACTIONS,
+        max_pending: int = 4,
+        executor_factory: Optional[Callable[[], Executor]] = None,
+    ):
+        self.executor = executor
+        self.timeout = timeout
+        self.actions = frozenset(actions)
+        self.max_pending = max_pending
+        self.executor_factory = executor_factory
+
+        # Offloaded actions submitted and not finished yet, timed out ones included. Updated from
+        # the threads of the executors
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "ActionRunner":
+        kind = os.environ.get("CONGA_ACTION_EXECUTOR", "thread")
+        workers = int(os.environ.get("CONGA_ACTION_WORKERS", 2))
+
+        factory = None
+        if kind == "thread":
+            executor = ThreadPoolExecutor(workers, thread_name_prefix="conga-actions")
+        elif kind == "process":
+            factory = partial(_process_pool, workers)
+            executor = factory()
+        elif kind == "inline":
+            executor = None
+        else:
+            raise ValueError(f"Invalid action executor {kind!r}")
+
+        actions = os.environ.get("CONGA_OFFLOAD_ACTIONS")
+
+        return cls(
+            executor,
+            timeout=float(os.environ.get("CONGA_ACTION_TIMEOUT_MS", 10_000)) / 1000,
+            actions=actions.split(",") if actions else OFFLOADED_ACTIONS,
+            max_pending=workers * 2,
+            executor_factory=factory,
+        )
+
+    def _release(self, future: Optional[Future]):
+        with self._pending_lock:
+            self.pending -= 1
+
+    def _recycle(self):
+        executor, self.executor = self.executor, self.executor_factory()
+
+        if isinstance(executor, ProcessPoolExecutor):
+            _kill_workers(executor)
+        else:
+            _shutdown(executor)
+
+    async def dispatch(self, game: Game, action: str, params: dict, inline: bool = False) -> Game:
+        """Applies an action to a game (see `Game.dispatch`) and returns the game after it, which
+        is a new game if the action was offloaded"""
+        if inline or self.executor is None or action not in self.actions:
+            game.dispatch(action, params)
+            return game
+
+        with self._pending_lock:
+            if self.pending >= self.max_pending:
+                ACTION_REJECTIONS.inc(action)
+                raise ActionTimeoutError(
+                    f"Action {action} can't run, {self.pending} actions are still running"
+                )
+
+            self.pending += 1
+
+        try:
+            future = self.executor.submit(
+                _run_action, encode_game(game, wire_version=2), game.rng, action, params
+            )
+        except Exception:
+            self._release(None)
+            raise
+
+        future.add_done_callback(self._release)
+
+        try:
+            state = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            ACTION_TIMEOUTS.inc(action)
+            if self.executor_factory is not None:
+                self._recycle()
+
+            raise ActionTimeoutError(f"Action {action} took more than {self.timeout}s")
+
+        return decode_game(state)
+
+    def shutdown(self):
+        if self.executor is not None:
+            _shutdown(self.executor)
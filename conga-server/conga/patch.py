@@ -0,0 +1,109 @@
+"""Minimal JSON Patch (RFC 6902) support to broadcast game state changes instead of full states.
+
+Only the `add`, `remove` and `replace` operations are generated. Lists are diffed after trimming
+their common prefix and suffix, so taking or putting a card on top of a deck is a single
+`remove`/`add` operation instead of replacing the whole deck.
+"""
+import copy
+from typing import Any, Dict, List
+
+Patch = List[Dict[str, Any]]
+
+
+def _escape(key: str) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(key: str) -> str:
+    return key.replace("~1", "/").replace("~0", "~")
+
+
+def _diff_list(old: list, new: list, path: str, patch: Patch):
+    common = min(len(old), len(new))
+
+    prefix = 0
+    while prefix < common and old[prefix] == new[prefix]:
+        prefix += 1
+
+    suffix = 0
+    while suffix < common - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+
+    old_middle = old[prefix : len(old) - suffix]
+    new_middle = new[prefix : len(new) - suffix]
+
+    for ix, (old_value, new_value) in enumerate(zip(old_middle, new_middle)):
+        _diff(old_value, new_value, f"{path}/{prefix + ix}", patch)
+
+    ix = prefix + min(len(old_middle), len(new_middle))
+
+    for _ in range(len(old_middle) - len(new_middle)):
+        patch.append({"op": "remove", "path": f"{path}/{ix}"})
+
+    for offset, value in enumerate(new_middle[len(old_middle) :]):
+        patch.append({"op": "add", "path": f"{path}/{ix + offset}", "value": value})
+
+
+def _diff(old: Any, new: Any, path: str, patch: Patch):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                patch.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+
+        for key, value in new.items():
+            if key not in old:
+                patch.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": value})
+            else:
+                _diff(old[key], value, f"{path}/{_escape(key)}", patch)
+
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_list(old, new, path, patch)
+
+    elif type(old) is not type(new) or old != new:
+        patch.append({"op": "replace", "path": path, "value": new})
+
+
+def diff(old: Any, new: Any) -> Patch:
+    """Returns the operations that transform the `old` JSON document into the `new` one"""
+    patch = []
+    _diff(old, new, "", patch)
+
+    return patch
+
+
+def apply_patch(document: Any, patch: Patch) -> Any:
+    """Applies a patch to a copy of a JSON document"""
+    return apply_patch_in_place(copy.deepcopy(document), copy.deepcopy(patch))
+
+
+def apply_patch_in_place(document: Any, patch: Patch) -> Any:
+    """Applies a patch to a JSON document, changing it, and returns it (a new one if the patch
+    replaces the whole document). The values of the patch end up in the document, so clients
+    that decode every message can apply them without copying"""
+    for operation in patch:
+        value = operation.get("value")
+
+        if operation["path"] == "":
+            document = value
+            continue
+
+        *parents, last = [_unescape(key) for key in operation["path"].split("/")[1:]]
+
+        target = document
+        for key in parents:
+            target = target[int(key)] if isinstance(target, list) else target[key]
+
+        if isinstance(target, list):
+            if operation["op"] == "add":
+                target.insert(len(target) if last == "-" else int(last), value)
+            elif operation["op"] == "remove":
+                del target[int(last)]
+            else:
+                target[int(last)] = value
+        else:
+            if operation["op"] == "remove":
+                del target[last]
+            else:
+                target[last] = value
+
+    return document
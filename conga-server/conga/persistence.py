@@ -0,0 +1,178 @@
+"""Crash-safe game persistence: an append-only action log plus periodic snapshots per room.
+
+Actions are buffered in memory and written in batches from an executor (group commit), with one
+`fsync` per room per batch, so the event loop never waits on the disk. Snapshots are written to a
+temporary file and atomically renamed, and appended to the snapshots history.
+
+Shuffles are seeded per match and action (see `prepare`), so the log is enough to rebuild a game
+and snapshots are only taken every `snapshot_every` actions. Loading a room reads its latest
+snapshot and replays the actions logged after it, see `conga.replay`.
+"""
+import asyncio
+import json
+import os
+import random
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from random import Random
+from typing import Dict, List, Optional, Tuple
+
+from conga.game import Game
+from conga.metrics import PERSISTENCE_SECONDS, PERSISTENCE_WRITES
+from conga.replay import replay, shuffle_seed
+
+
+@dataclass
+class PendingWrites:
+    """Log lines and snapshot of a room waiting for the next batch. The snapshot covers the first
+    `snapshot_lines` lines"""
+
+    lines: List[str] = field(default_factory=list)
+    snapshot: Optional[dict] = None
+    snapshot_lines: int = 0
+
+
+class GameStore:
+    def __init__(
+        self,
+        directory: str = "games",
+        snapshot_every: int = 100,
+        flush_interval: float = 0.05,
+        executor: Optional[Executor] = None,
+    ):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+
+        self._seqs: Dict[str, int] = {}
+        self._seeds: Dict[str, Optional[int]] = {}
+        self._since_snapshot: Dict[str, int] = {}
+        self._pending: Dict[str, PendingWrites] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, room_id: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{room_id}.{extension}")
+
+    def load(self, room_id: str) -> Optional[Game]:
+        """Rebuilds a room game from its latest snapshot and the actions logged after it"""
+        state = replay(self.directory, room_id)
+        if state is None:
+            self._seqs[room_id] = 0
+            return None
+
+        self._seqs[room_id], self._seeds[room_id] = state.seq, state.seed
+
+        # Actions are appended after the last complete line, not after a torn one
+        log_path = self._path(room_id, "log")
+        if os.path.exists(log_path) and os.path.getsize(log_path) > state.offset:
+            os.truncate(log_path, state.offset)
+
+        return state.game
+
+    def prepare(
+        self, room_id: str, game: Game, action: str
+    ) -> Tuple[Optional[int], Optional[str]]:
+        """Seeds the shuffles of the next action of a room game, so replaying it shuffles the
+        same. Starting a match draws a new seed, which is only saved by `record`, once the action
+        succeeded. Returns the seed of the match and the seed of the action"""
+        seed = random.getrandbits(63) if action == "start_match" else self._seeds.get(room_id)
+
+        action_seed = shuffle_seed(seed, self._seqs.get(room_id, 0) + 1)
+        game.rng = Random(action_seed) if action_seed is not None else None
+
+        return seed, action_seed
+
+    def record(
+        self, room_id: str, action: str, params: dict, state: dict, seed: Optional[int] = None
+    ):
+        """Logs an action applied to a room game, after `prepare`. `state` is the game state after
+        the action, used if a snapshot is due. `seed` is the seed of the match returned by
+        `prepare`, saved if the action started a match"""
+        seq = self._seqs[room_id] = self._seqs.get(room_id, 0) + 1
+        since_snapshot = self._since_snapshot[room_id] = self._since_snapshot.get(room_id, 0) + 1
+
+        entry = {"seq": seq, "action": action, "params": params}
+        if action == "start_match":
+            self._seeds[room_id] = entry["seed"] = seed
+
+        pending = self._pending.setdefault(room_id, PendingWrites())
+        pending.lines.append(json.dumps(entry) + "\n")
+
+        if since_snapshot >= self.snapshot_every:
+            self.snapshot(room_id, state)
+        else:
+            self._schedule()
+
+    def snapshot(self, room_id: str, state: dict):
+        """Schedules a snapshot of a room game state. The state is encoded when written, so it
+        must not be modified afterwards"""
+        seq = self._seqs.get(room_id, 0)
+        self._since_snapshot[room_id] = 0
+
+        # The snapshot covers the actions waiting to be logged
+        pending = self._pending.setdefault(room_id, PendingWrites())
+        pending.snapshot = {"seq": seq, "seed": self._seeds.get(room_id), "game": state}
+        pending.snapshot_lines = len(pending.lines)
+
+        self._schedule()
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        # Wait a bit so the actions of every room arriving meanwhile are written in one batch
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Writes the pending actions and snapshots. Batches are written one at a time, in order"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+
+            if pending:
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(self.executor, self._write_batch, pending)
+
+    def _write_batch(self, pending: Dict[str, PendingWrites]):
+        with PERSISTENCE_SECONDS.time():
+            for room_id, writes in pending.items():
+                self._write_room(room_id, writes)
+
+    def _write_room(self, room_id: str, writes: PendingWrites):
+        # The log is written first, so a snapshot never points past its end
+        with open(self._path(room_id, "log"), "ab") as f:
+            f.writelines(line.encode() for line in writes.lines[: writes.snapshot_lines])
+            offset = f.tell()
+            f.writelines(line.encode() for line in writes.lines[writes.snapshot_lines :])
+            f.flush()
+            os.fsync(f.fileno())
+
+        PERSISTENCE_WRITES.inc("log_line", value=len(writes.lines))
+
+        if writes.snapshot is not None:
+            snapshot = json.dumps({**writes.snapshot, "offset": offset})
+
+            snapshot_path = self._path(room_id, "json")
+            tmp_path = f"{snapshot_path}.tmp"
+
+            with open(tmp_path, "w") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_path, snapshot_path)
+
+            # The history is only read to replay past actions, it doesn't need to be synced
+            with open(self._path(room_id, "snapshots"), "a") as f:
+                f.write(snapshot + "\n")
+
+            PERSISTENCE_WRITES.inc("snapshot")
@@ -1,134 +1,336 @@
 import itertools
 from collections import Counter
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from enum import IntEnum
-from typing import List, Tuple
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Tuple
 
 from dataclasses_json import dataclass_json
 
-from conga.card import Card, Joker
+from conga.card import JOKER_CODE, Card, Suit, deck_cards, hand_counts
+from conga.meld_table import canonical_hand, canonical_meld, get_meld_table
 
+NUMBERS = range(1, 13)
 
-def _check_flush_joker(comb: List[Card], j: int) -> bool:
-    comb = list(comb)
+#
+# How many times players state was evaluated from scratch ("full"), from the previous state
+# ("incremental"), from the meld table ("table") or not evaluated at all because their hand didn't
+# change ("unchanged"). States are only evaluated when they are read (see `Player.update_state`)
+#
+state_updates = Counter()
 
-    try:
-        prev_ix = j - 1 - [c.suit for c in comb[:j]][::-1].index(Joker.joker)
-    except ValueError:
-        prev_ix = None
 
-    if prev_ix is None or j - prev_ix > 1:
-        prev_ix = j - 1
+def _flush_runs(numbers: List[int], joker_count: int) -> List[List[int]]:
+    """Walks the sorted numbers of a suit and returns every valid flush as a list of numbers,
+    where `0` stands for a joker.
 
-    ix_diff_to_next = j - prev_ix + 1
+    A flush starts with a real card and every following card is either the next number, a joker
+    filling a one-number gap (`5, J, 7`) or a trailing joker (`5, 6, J`). Jokers can't be
+    adjacent unless they close the flush, a 12 can only be the last card, and there can't be more
+    jokers than real cards.
+    """
+    available = set(numbers)
+    runs = []
+
+    def extend(run: List[int], last: int, jokers: int):
+        if 3 <= len(run) and jokers <= len(run) - jokers:
+            runs.append(run)
+
+        if len(run) == 6 or last == 12:
+            return
+
+        if last + 1 in available:
+            extend(run + [last + 1], last + 1, jokers)
+
+        if jokers < joker_count:
+            # Jokers at the end of the flush
+            extend_jokers = run + [0]
+            for n_jokers in range(jokers + 1, joker_count + 1):
+                if len(extend_jokers) > 6:
+                    break
+
+                if 3 <= len(extend_jokers) and n_jokers <= len(extend_jokers) - n_jokers:
+                    runs.append(extend_jokers)
+
+                extend_jokers = extend_jokers + [0]
+
+            # Joker replacing a missing card (12 is the highest number)
+            gap_number = min(12, last + 2)
+            if len(run) < 5 and gap_number in available:
+                extend(run + [0, gap_number], gap_number, jokers + 1)
+
+    for number in sorted(available):
+        extend([number], number, 0)
 
-    return j > 0 and comb[j].suit == Joker.joker and comb[prev_ix] + ix_diff_to_next == comb[j + 1]
+    return runs
 
 
-def _check_flush_joker_count(comb: List[Card]) -> bool:
-    no_joker_count = len([card for card in comb if card.suit != Joker.joker])
-    joker_count = len([card for card in comb if card.suit == Joker.joker])
+def _flush_codes(counts: bytearray, suits: Iterable[int] = Suit) -> List[Tuple[int, ...]]:
+    """Flush candidates, as tuples of card codes, within a hand given as a multiset of codes"""
+    joker_count = counts[JOKER_CODE]
+    candidate_hands = []
+
+    for suit in suits:
+        base = suit * 13
+        runs = _flush_runs([n for n in range(1, 13) if counts[base + n]], joker_count)
+        runs.sort(key=lambda run: (len(run), [n or 13 for n in run]))
 
-    return not joker_count > no_joker_count
+        candidate_hands.extend(tuple(base + n if n else JOKER_CODE for n in run) for run in runs)
 
+    return candidate_hands
 
-def _check_flush(cards):
-    """Check for possible flush candidates within a hand of cards"""
-    suit_sorted_hand = sorted(cards, key=lambda card: (card.suit, card.number))
+
+def _same_of_a_kind_codes(
+    counts: bytearray, numbers: Iterable[int] = NUMBERS
+) -> List[Tuple[int, ...]]:
+    """Same-of-a-kind candidates, as tuples of card codes, within a hand given as a multiset of
+    codes"""
+    joker_count = counts[JOKER_CODE]
     candidate_hands = []
 
-    for suit, suit_cards in itertools.groupby(suit_sorted_hand, lambda card: card.suit):
-        suit_cards = list(suit_cards) + [card for card in cards if card.suit == Joker.joker]
-
-        for i in range(3, 7):
-            for comb in itertools.permutations(suit_cards, i):
-                if all(
-                    comb[j].number != 12
-                    and _check_flush_joker_count(comb)
-                    and (
-                        comb[j] + 1 == comb[j + 1]  # consecutive numbers
-                        or comb[j + 1].suit == Joker.joker  # next card is joker
-                        or _check_flush_joker(comb, j)
-                    )
-                    for j in range(i - 1)
-                ):
-                    candidate_hands.append(comb)
+    for number in numbers:
+        hand_codes = [
+            suit * 13 + number for suit in Suit for _ in range(counts[suit * 13 + number])
+        ] + [JOKER_CODE] * joker_count
+
+        for i in range(3, len(hand_codes) + 1):
+            #
+            # Filter games that have more jokers than cards
+            #
+            candidate_hands.extend(
+                comb
+                for comb in sorted(set(itertools.combinations(hand_codes, i)))
+                if comb.count(JOKER_CODE) < i / 2
+            )
 
     return candidate_hands
 
 
+#
+# Candidates are grouped by the flush suit or the same-of-a-kind number, so only the groups
+# touched by a card need to be recomputed when the card is added or removed from a hand
+#
+FLUSH_GROUP = 0
+SAME_OF_A_KIND_GROUP = 1
+
+CandidateGroups = Dict[Tuple[int, int], List[Tuple[int, ...]]]
+
+ALL_GROUPS = [(FLUSH_GROUP, suit) for suit in Suit] + [
+    (SAME_OF_A_KIND_GROUP, number) for number in NUMBERS
+]
+
+
+def _touched_groups(code: int) -> List[Tuple[int, int]]:
+    """Candidate groups that might change if a card is added or removed"""
+    if code == JOKER_CODE:
+        return ALL_GROUPS
+
+    return [(FLUSH_GROUP, code // 13), (SAME_OF_A_KIND_GROUP, code % 13)]
+
+
+def _candidate_groups(counts: bytearray, groups: Iterable[Tuple[int, int]]) -> CandidateGroups:
+    return {
+        (kind, value): _flush_codes(counts, [value])
+        if kind == FLUSH_GROUP
+        else _same_of_a_kind_codes(counts, [value])
+        for kind, value in groups
+    }
+
+
+def _codes_to_cards(candidates: List[Tuple[int, ...]], cards: List[Card]) -> List[List[Card]]:
+    cards_by_code = {card.code: card for card in cards}
+    return [[cards_by_code[code] for code in cand] for cand in candidates]
+
+
+def _check_flush(cards: List[Card]) -> List[List[Card]]:
+    """Check for possible flush candidates within a hand of cards
+
+    Only one candidate is returned for each distinct flush (repeated cards and jokers are
+    interchangeable).
+    """
+    return _codes_to_cards(_flush_codes(hand_counts(card.code for card in cards)), cards)
+
+
 def _check_same_of_a_kind(cards: List[Card]) -> List[List[Card]]:
     """Check for possible same-of-a-kind candidates within a hand of cards"""
-    counter = Counter([card.number for card in cards])
-    candidate_hands = []
-    joker_count = len([card for card in cards if card.suit == Joker.joker])
-
-    for number, count in counter.items():
-        if count + joker_count >= 3:
-            hand_cards = [
-                card for card in cards if card.number == number or card.suit == Joker.joker
-            ]
-
-            for i in range(3, count + joker_count + 1):
-                candidate_hands.extend(
-                    [list(comb) for comb in itertools.combinations(hand_cards, i)]
-                )
-
-    #
-    # Filter games that have more jokers than cards
-    #
-    candidate_hands = [
-        cand
-        for cand in candidate_hands
-        if len([card for card in cand if card.suit == Joker.joker]) < len(cand) / 2
+    return _codes_to_cards(_same_of_a_kind_codes(hand_counts(card.code for card in cards)), cards)
+
+
+@lru_cache(maxsize=16384)
+def _best_melds(hand_key: Tuple[int, ...]) -> Tuple[Tuple[Tuple[int, ...], ...], int]:
+    """Best candidate games for a canonical hand (the sorted card codes). The precomputed meld
+    table is consulted first, if there's one available"""
+    table = get_meld_table()
+    if table is not None:
+        found = table.lookup(hand_key)
+        if found is not None:
+            return found
+
+    return _search_melds(hand_key)
+
+
+def _search_melds(hand_key: Tuple[int, ...]) -> Tuple[Tuple[Tuple[int, ...], ...], int]:
+    counts = hand_counts(hand_key)
+    return _search_candidates(hand_key, _flush_codes(counts) + _same_of_a_kind_codes(counts))
+
+
+def _search_candidates(
+    hand_key: Tuple[int, ...], candidates: List[Tuple[int, ...]]
+) -> Tuple[Tuple[Tuple[int, ...], ...], int]:
+    """Finds the set of disjoint candidate games leaving the minimum score for a canonical hand
+    (the sorted card codes).
+
+    Cards are positions of a bitmask. Equal cards are contiguous in the canonical hand, so a
+    candidate game always takes the lowest remaining positions of each of its cards, keeping the
+    mask a canonical encoding of the remaining cards. A candidate can be used more than once if
+    the hand has the cards for it. Ties are broken by the number of games and then by the order of
+    the candidates with their suits normalized as in the meld table, so hands that only differ in
+    their suits get the same games (and the table returns what the search would).
+    """
+    _, permutation = canonical_hand(hand_key)
+    candidates = sorted(candidates, key=lambda cand: canonical_meld(cand, permutation))
+
+    blocks = {}
+    for ix, code in enumerate(hand_key):
+        blocks[code] = blocks.get(code, 0) | 1 << ix
+
+    candidates_blocks = [
+        [(blocks[code], count) for code, count in Counter(cand).items()] for cand in candidates
     ]
+    candidates_values = [sum(code % 13 for code in cand) for cand in candidates]
 
-    return candidate_hands
+    def take(mask: int, cand_blocks: List[Tuple[int, int]]) -> int:
+        for block, count in cand_blocks:
+            available = mask & block
+            for _ in range(count):
+                if not available:
+                    return -1
+
+                lowest = available & -available
+                available ^= lowest
+                mask ^= lowest
+
+        return mask
+
+    total_score = sum(code % 13 for code in hand_key)
+    best = (total_score, 0, ())
+
+    def search(mask: int, start: int, chosen: Tuple[int, ...], score: int):
+        nonlocal best
+
+        for ix in range(start, len(candidates)):
+            new_mask = take(mask, candidates_blocks[ix])
+            if new_mask < 0:
+                continue
+
+            new_chosen = chosen + (ix,)
+            new_score = score - candidates_values[ix]
+            best = min(best, (new_score, len(new_chosen), new_chosen))
+
+            # Only games that fit in the remaining cards are explored
+            if new_mask:
+                search(new_mask, ix, new_chosen, new_score)
+
+    search((1 << len(hand_key)) - 1, 0, (), total_score)
+
+    return tuple(candidates[ix] for ix in best[2]), best[0]
 
 
 def check_cards_values(cards: List[Card]) -> Tuple[List[List[Card]], int]:
     """Giving a bunch of cards, it generates the best card candidates to get the minimum
     possible score
 
+    Results are cached by the canonical encoding of the hand, since the same hands are evaluated
+    over and over across turns and players.
+
     Returns
     -------
     A tuple of candidate games and the best possible score
     """
-    better_candidates = []
-    better_hand_score = sum([card.number for card in cards])
+    melds, score = _best_melds(tuple(sorted(card.code for card in cards)))
+
+    return _codes_to_cards(melds, cards), score
+
+
+CARD_CODES = sorted({card.code for card in deck_cards()})
+
+
+def _is_single_game(hand_key: Tuple[int, ...]) -> bool:
+    """Whether the best candidate games of a hand (the sorted card codes) are a single game with a
+    score of 0, without searching them.
+
+    Jokers score 0, so that's the case if a single candidate game has every card but the jokers.
+    Only flush candidates of the suit, or same-of-a-kind candidates of the number, of all the
+    cards can have them.
+    """
+    cards = Counter(code for code in hand_key if code != JOKER_CODE)
+    if not cards:
+        return False
+
+    counts = hand_counts(hand_key)
+    suits = {code // 13 for code in cards}
+    numbers = {code % 13 for code in cards}
+
+    candidates = []
+    if len(suits) == 1:
+        candidates.extend(_flush_codes(counts, suits))
+    if len(numbers) == 1:
+        candidates.extend(_same_of_a_kind_codes(counts, numbers))
+
+    return any(not cards - Counter(cand) for cand in candidates)
 
-    candidates = _check_flush(cards) + _check_same_of_a_kind(cards)
-    candidates = [list(cand) for cand in candidates]
 
-    for cand in candidates:
-        current_hand = cards.copy()
-        for card in cand:
-            current_hand.remove(card)
+@lru_cache(maxsize=16384)
+def meld_extensions(meld_key: Tuple[int, ...]) -> FrozenSet[int]:
+    """Codes of the cards that can be added to a game (its sorted card codes) so the cards are
+    still a single game with a score of 0. The same as checking `check_cards_values` of the game
+    with every card"""
+    return frozenset(
+        code for code in CARD_CODES if _is_single_game(tuple(sorted(meld_key + (code,))))
+    )
 
-        current_score = sum(card.number for card in current_hand)
-        if current_score < better_hand_score:
-            better_candidates = [cand]
-            better_hand_score = current_score
 
-    for cand_a, cand_b in list(itertools.combinations(candidates, 2)):
-        current_hand = cards.copy()
+#
+# Fields of players derived from their hand. They are evaluated when they are first read after
+# `Player.update_state`, unless they are assigned (showcases adjust them, and decoded games restore
+# them)
+#
+DERIVED_FIELDS = ("hand_score", "hand_candidates", "can_finish")
 
-        for card in cand_a:
-            current_hand.remove(card)
 
-        try:
-            for card in cand_b:
-                current_hand.remove(card)
-        except ValueError:
-            # cannot create cand_b candidate with current cards
-            continue
+def _derived_field(name: str) -> property:
+    slot = f"_{name}"
 
-        current_score = sum(card.number for card in current_hand)
-        if current_score < better_hand_score:
-            better_candidates = [cand_a, cand_b]
-            better_hand_score = current_score
+    def get(self):
+        value = getattr(self, slot)
+        if value is None:
+            self._derive_state()
+            value = getattr(self, slot)
 
-    return better_candidates, better_hand_score
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    return property(get, set)
+
+
+def _with_slots(cls):
+    """Recreates a dataclass with `__slots__` for its fields (what `dataclass(slots=True)` does
+    since Python 3.10), with the derived fields as properties"""
+    names = [f.name for f in fields(cls)]
+    namespace = {
+        key: value
+        for key, value in cls.__dict__.items()
+        if key not in names and key not in ("__dict__", "__weakref__")
+    }
+
+    namespace["__slots__"] = tuple(
+        f"_{name}" if name in DERIVED_FIELDS else name for name in names
+    ) + tuple(namespace.pop("_private_slots"))
+    namespace.update({name: _derived_field(name) for name in DERIVED_FIELDS})
+
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
 
 
 class PlayerStatus(IntEnum):
@@ -138,14 +340,19 @@ class PlayerStatus(IntEnum):
 
 
 @dataclass_json
+@_with_slots
 @dataclass
 class Player:
     """A player playing a Conga game
 
     Players can have their hand cards assigned by the Game class. To update the current round state
     for a player you can use the `update_state` method.
+
+    Players use slots, since servers hold thousands of them.
     """
 
+    _private_slots = ("_state", "_evaluated")
+
     name: str
     hand_score: int = 0
     hand_candidates: List[List[Card]] = field(default_factory=list)
@@ -158,8 +365,52 @@ class Player:
     status: PlayerStatus = PlayerStatus.playing
     won_match: bool = False
 
-    def _check_hand_values(self) -> Tuple[List[List[Card]], int]:
-        return check_cards_values(self.hand)
+    def __post_init__(self):
+        # Hand (sorted card codes), candidate groups, games and score of the last evaluation
+        self._state = None
+        # Hand and score the derived fields are evaluated from, as of the last `update_state`
+        self._evaluated = None
+
+    def _evaluate_hand(self, hand: Iterable[Card]) -> Tuple[Tuple[Tuple[int, ...], ...], int]:
+        """Evaluates a hand, only recomputing the candidates touched by the cards that changed
+        since the last evaluation (usually one picked or thrown card)"""
+        hand_key = tuple(sorted(card.code for card in hand))
+
+        if self._state is not None and self._state[0] == hand_key:
+            state_updates["unchanged"] += 1
+            return self._state[2], self._state[3]
+
+        counts = hand_counts(hand_key)
+        groups = None
+
+        if self._state is not None:
+            previous_key, previous_groups = self._state[0], self._state[1]
+            changed = (Counter(hand_key) - Counter(previous_key)) + (
+                Counter(previous_key) - Counter(hand_key)
+            )
+
+            if previous_groups is not None and sum(changed.values()) <= 2:
+                state_updates["incremental"] += 1
+                groups = dict(previous_groups)
+                for code in changed:
+                    groups.update(_candidate_groups(counts, _touched_groups(code)))
+
+        if groups is None:
+            table = get_meld_table()
+            found = table.lookup(hand_key) if table is not None else None
+            if found is not None:
+                state_updates["table"] += 1
+                self._state = (hand_key, None) + found
+                return found
+
+            state_updates["full"] += 1
+            groups = _candidate_groups(counts, ALL_GROUPS)
+
+        candidates = [cand for group in ALL_GROUPS for cand in groups[group]]
+        melds, score = _search_candidates(hand_key, candidates)
+        self._state = (hand_key, groups, melds, score)
+
+        return melds, score
 
     def sort_cards(self):
         """Sorts the hand cards a a regular person would do
@@ -170,12 +421,15 @@ class Player:
         for cand in sorted(self.hand_candidates, key=lambda cand: len(cand)):
             sorted_hand.extend(cand)
 
-        # For the rest of the cards, check the ones that are not in projects and sort them
-        cards_count = dict(Counter(self.hand))
+        # For the rest of the cards, check the ones that are not in projects and sort them. A
+        # card might be more than once in the hand and in the projects (jokers, multiple decks)
+        counts = hand_counts(card.code for card in sorted_hand)
         project_cards = []
 
-        for card, count in cards_count.items():
-            for i in range(1 if card in sorted_hand else 0, count):
+        for card in self.hand:
+            if counts[card.code]:
+                counts[card.code] -= 1
+            else:
                 project_cards.append(card)
 
         project_cards.sort(key=lambda card: (card.number, card.suit))
@@ -183,7 +437,22 @@ class Player:
         self.hand = project_cards + sorted_hand
 
     def update_state(self):
-        """Looks for game candidates in the player's hand and checks if player can finish the round
+        """Updates the game candidates in the player's hand and if player can finish the round.
+        They are looked for when they are read, with the hand and score of this call
         """
-        self.hand_candidates, self.hand_score = self._check_hand_values()
-        self.can_finish = self.hand_score <= 5 and self.score + self.hand_score <= 120
+        self._evaluated = (tuple(self.hand), self.score)
+        self._hand_score = self._hand_candidates = self._can_finish = None
+
+    def _derive_state(self):
+        # Fields assigned since `update_state` are kept
+        hand, score = self._evaluated
+        melds, hand_score = self._evaluate_hand(hand)
+
+        if self._hand_score is None:
+            self._hand_score = hand_score
+        if self._hand_candidates is None:
+            self._hand_candidates = _codes_to_cards(melds, hand)
+        if self._can_finish is None:
+            self._can_finish = hand_score <= 5 and score + hand_score <= 120
+
+        self._evaluated = None
@@ -0,0 +1,190 @@
+"""On-demand profiling of the actions applied to games.
+
+When enabled, the next N actions are profiled with cProfile and tracemalloc, and reports are
+written per action name to the profiles directory:
+
+* `<action>.pstats`: cProfile stats of every profiled action with that name, merged. Read them
+  with `python -m pstats profiles/player_turn_throw.pstats`
+* `<action>.alloc.txt`: memory allocated by every profiled action, by line
+
+Actions slower than the latency budget are always reported (profiling enabled or not), to
+`slow/<time>-<room>-<action>.json`, with the action, its parameters, the game state before it and
+the seed of its shuffles, so they can be replayed with `replay_report`.
+
+Reports are written in order by a background thread, so the slowest actions don't wait on the
+disk too.
+
+Profiling is enabled with `CONGA_PROFILE_ACTIONS=<N>` when the server starts, or at runtime by
+sending `{"action": "profile", "action_params": {"actions": N, "token": ...}}` through a socket,
+with the token of `CONGA_ADMIN_TOKEN`.
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
+from random import Random
+from typing import Dict, Optional
+
+from conga.codec import decode_game
+from conga.game import Game
+
+logger = logging.getLogger(__name__)
+
+
+def _log_write_error(future):
+    if future.exception() is not None:
+        logger.error("Can't write profiling report: %s", future.exception())
+
+
+class ActionProfiler:
+    def __init__(
+        self,
+        directory: str = "profiles",
+        budget: float = 0.1,
+        actions: int = 0,
+        top_allocations: int = 25,
+        executor: Optional[Executor] = None,
+    ):
+        self.directory = directory
+        self.budget = budget
+        self.remaining = actions
+        self.top_allocations = top_allocations
+        self.slow_actions = 0
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._stats: Dict[str, pstats.Stats] = {}
+
+    @classmethod
+    def from_env(cls) -> "ActionProfiler":
+        return cls(
+            directory=os.environ.get("CONGA_PROFILE_DIR", "profiles"),
+            budget=float(os.environ.get("CONGA_PROFILE_BUDGET_MS", 100)) / 1000,
+            actions=int(os.environ.get("CONGA_PROFILE_ACTIONS", 0)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.remaining > 0
+
+    def enable(self, actions: int):
+        """Profiles the next `actions` actions"""
+        logger.info("Profiling the next %d actions to %s", actions, self.directory)
+        self.remaining = actions
+
+    def wait(self):
+        """Waits until the reports of the actions done so far are written"""
+        self.executor.submit(lambda: None).result()
+
+    @contextmanager
+    def profile(
+        self,
+        room_id: str,
+        action: str,
+        params: dict,
+        state: Optional[dict],
+        seed: Optional[str] = None,
+    ):
+        """Times an action (profiling it, if enabled). `state` is the serialized game before the
+        action and `seed` the seed of its shuffles, reported if the action is slower than the
+        budget"""
+        report = {"room_id": room_id, "action": action, "params": params, "seed": seed}
+
+        if not self.enabled:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._check_budget(time.perf_counter() - start, report, state)
+            return
+
+        self.remaining -= 1
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+
+            after = tracemalloc.take_snapshot()
+            if not tracing:
+                tracemalloc.stop()
+
+            allocations = after.compare_to(before, "lineno")
+            self._submit(self._write_reports, action, elapsed, profile, allocations)
+            self._check_budget(elapsed, report, state)
+
+    def _submit(self, write, *args):
+        self.executor.submit(write, *args).add_done_callback(_log_write_error)
+
+    def _write_reports(self, action: str, elapsed: float, profile: cProfile.Profile, allocations):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if action in self._stats:
+            self._stats[action].add(profile)
+        else:
+            self._stats[action] = pstats.Stats(profile)
+
+        self._stats[action].dump_stats(os.path.join(self.directory, f"{action}.pstats"))
+
+        with open(os.path.join(self.directory, f"{action}.alloc.txt"), "a") as f:
+            f.write(f"# {action} at {time.strftime('%Y-%m-%d %H:%M:%S')}, {elapsed * 1000:.2f}ms\n")
+            for stat in allocations[: self.top_allocations]:
+                f.write(f"{stat}\n")
+            f.write("\n")
+
+    def _check_budget(self, elapsed: float, report: dict, state: Optional[dict]):
+        if elapsed <= self.budget:
+            return
+
+        self.slow_actions += 1
+
+        room_id, action = report["room_id"], report["action"]
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.slow_actions}-{room_id}-{action}.json"
+        path = os.path.join(self.directory, "slow", name)
+        self._submit(self._write_slow_report, path, {**report, "elapsed": elapsed}, state)
+
+        logger.warning(
+            "Action %s in room %s took %.1fms (budget %.1fms), reported to %s",
+            action,
+            room_id,
+            elapsed * 1000,
+            self.budget * 1000,
+            path,
+        )
+
+    def _write_slow_report(self, path: str, report: dict, state: Optional[dict]):
+        # The hand of the player whose turn it was, which is usually what made the action slow
+        hand = None
+        if state is not None and state["players"]:
+            hand = state["players"][state["match_next_player"]]["hand"]
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({**report, "hand": hand, "game": state}, f)
+
+
+def replay_report(path: str) -> Game:
+    """Applies the action of a slow action report again, to the game it was reported with"""
+    with open(path) as f:
+        report = json.load(f)
+
+    game = decode_game(report["game"])
+    if report.get("seed") is not None:
+        game.rng = Random(report["seed"])
+
+    game.dispatch(report["action"], report["params"])
+
+    return game
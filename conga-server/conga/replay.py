@@ -0,0 +1,175 @@
+"""Deterministic re-execution of room games from their action logs.
+
+Every room has three files in the data directory (see `conga.persistence`):
+
+* `<room>.log`: every action applied to the game, one JSON line each, in order. `start_match`
+  entries also have the `seed` of the shuffles of the match
+* `<room>.json`: the latest snapshot of the game, with the number of the last action it covers
+  (`seq`), the seed of its match and the `offset` of the next action in the log
+* `<room>.snapshots`: every snapshot, one JSON line each, to fast-forward to any action
+
+Shuffles are seeded with the seed of the match and the number of the action, so applying the same
+actions to the same snapshot always results on the same game.
+
+    python -m conga.replay games table                  # the game after the last action
+    python -m conga.replay games table --seq 120        # the game after the action 120
+    python -m conga.replay games table --profile replay.pstats
+"""
+import argparse
+import cProfile
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from random import Random
+from typing import Iterator, List, Optional, Tuple
+
+from conga.codec import decode_game
+from conga.game import Game
+
+
+def shuffle_seed(seed: Optional[int], seq: int) -> Optional[str]:
+    """Seed of the shuffles of the action `seq` of a match (None for games logged without seeds,
+    which are shuffled with the global random generator)"""
+    return f"{seed}:{seq}" if seed is not None else None
+
+
+def shuffle_rng(seed: Optional[int], seq: int) -> Optional[Random]:
+    action_seed = shuffle_seed(seed, seq)
+    return Random(action_seed) if action_seed is not None else None
+
+
+def read_lines(path: str, offset: int = 0) -> Iterator[Tuple[dict, int]]:
+    """JSON lines of a file from a byte offset, with the offset after every line. A torn write of
+    the last line before a crash is ignored"""
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in iter(f.readline, b""):
+            if not line.endswith(b"\n"):
+                break
+
+            try:
+                data = json.loads(line)
+            except ValueError:
+                break
+
+            yield data, f.tell()
+
+
+@dataclass
+class Replay:
+    """A game being rebuilt, after the action `seq`. `offset` is the position of the next action
+    in the log"""
+
+    game: Game = field(default_factory=Game)
+    seq: int = 0
+    seed: Optional[int] = None
+    offset: int = 0
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "Replay":
+        return cls(
+            game=decode_game(snapshot["game"]),
+            seq=snapshot["seq"],
+            seed=snapshot.get("seed"),
+            offset=snapshot.get("offset", 0),
+        )
+
+    def apply(self, entry: dict):
+        """Applies a log entry the way the server did"""
+        if "seed" in entry:
+            self.seed = entry["seed"]
+
+        self.game.rng = shuffle_rng(self.seed, entry["seq"])
+        self.game.dispatch(entry["action"], entry["params"])
+        self.seq = entry["seq"]
+
+
+def _path(directory: str, room_id: str, extension: str) -> str:
+    return os.path.join(directory, f"{room_id}.{extension}")
+
+
+def _last_snapshot(directory: str, room_id: str, seq: Optional[int]) -> Optional[dict]:
+    if seq is None:
+        path = _path(directory, room_id, "json")
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            return json.load(f)
+
+    snapshot = None
+    for candidate, _ in read_lines(_path(directory, room_id, "snapshots")):
+        if candidate["seq"] > seq:
+            break
+        snapshot = candidate
+
+    return snapshot
+
+
+def replay(directory: str, room_id: str, seq: Optional[int] = None) -> Optional[Replay]:
+    """Rebuilds the game of a room after the action `seq` (the last one by default), from the
+    last snapshot before it. Returns None if the room has no files"""
+    snapshot = _last_snapshot(directory, room_id, seq)
+    if snapshot is None and not os.path.exists(_path(directory, room_id, "log")):
+        return None
+
+    state = Replay.from_snapshot(snapshot) if snapshot is not None else Replay()
+
+    for entry, offset in read_lines(_path(directory, room_id, "log"), state.offset):
+        if seq is not None and entry["seq"] > seq:
+            break
+
+        # Logs written before offsets were saved start at the snapshot
+        if entry["seq"] > state.seq:
+            state.apply(entry)
+
+        state.offset = offset
+
+    return state
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m conga.replay", description=__doc__)
+    parser.add_argument("directory", help="Data directory of the server (CONGA_DATA_DIR)")
+    parser.add_argument("room_id")
+    parser.add_argument("--seq", type=int, help="Replay up to this action (default: the last)")
+    parser.add_argument("--profile", help="Write the cProfile stats of the replay to this file")
+    parser.add_argument("--state", action="store_true", help="Print the game state")
+
+    args = parser.parse_args(argv)
+
+    profile = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+
+    if profile is not None:
+        profile.enable()
+
+    state = replay(args.directory, args.room_id, args.seq)
+
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile)
+
+    if state is None:
+        print(f"Room {args.room_id} not found in {args.directory}", file=sys.stderr)
+        return 1
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Room {args.room_id} after action {state.seq} (match {state.game.match_id}, "
+        f"status {state.game.status.name}), replayed in {elapsed * 1000:.1f}ms"
+    )
+
+    if args.state:
+        print(json.dumps(state.game.to_dict(), indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+from conga.broadcast import Broadcaster
+from conga.codec import encode_game
+from conga.game import Game
+from conga.metrics import PATCH_SECONDS, SERIALIZE_SECONDS
+from conga.persistence import GameStore
+from conga.patch import diff
+from conga.wire import encode_view
+
+DEFAULT_ROOM_ID = "default"
+ROOM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class RoomError(Exception):
+    pass
+
+
+@dataclass
+class Room:
+    """A table: a game and the sockets subscribed to it
+
+    Actions on the game must be done holding the room `lock`, so they are applied (and broadcasted)
+    one at a time. The game is serialized once per change into `state`, and every socket receives
+    the patch from its previous view of the game, tagged with the state `version`, through the
+    room broadcaster.
+
+    Sockets of players (`viewers`) see their own hand, other sockets see the game as spectators.
+    Only the socket that added a player sees it, or sockets reconnecting with its `tokens`.
+    Views are projected once per version and player. Sockets using the binary protocol (`binary`)
+    receive the whole view of every version instead of patches, see `conga.wire`.
+    """
+
+    room_id: str
+    game: Game = field(default_factory=Game)
+    sockets: Set = field(default_factory=set)
+    viewers: Dict[object, str] = field(default_factory=dict)
+    tokens: Dict[str, str] = field(default_factory=dict)
+    binary: Set = field(default_factory=set)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    broadcaster: Broadcaster = field(default_factory=Broadcaster)
+    last_activity: float = field(default_factory=time.monotonic)
+    state: Optional[dict] = None
+    version: int = 0
+    # Task playing the turns of the bots of the room (see `conga.bots`)
+    bots_task: Optional[asyncio.Task] = None
+    _views: Dict[Optional[str], dict] = field(default_factory=dict, init=False, repr=False)
+    _binary_views: Dict[Optional[str], bytes] = field(default_factory=dict, init=False, repr=False)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def view(self, player_name: Optional[str] = None) -> dict:
+        """What a player (or a spectator) can see of the current state"""
+        if self.state is None:
+            self.state = encode_game(self.game)
+
+        if player_name not in self._views:
+            self._views[player_name] = Game.project(self.state, player_name)
+
+        return self._views[player_name]
+
+    def snapshot(self, player_name: Optional[str] = None) -> dict:
+        """Full view message, sent when a client connects or asks to resync"""
+        return {"game": self.view(player_name), "version": self.version}
+
+    def binary_snapshot(self, player_name: Optional[str] = None) -> bytes:
+        """Full view message of the binary protocol, encoded once per version and player"""
+        if player_name not in self._binary_views:
+            self._binary_views[player_name] = encode_view(self.view(player_name), self.version)
+
+        return self._binary_views[player_name]
+
+    def update_state(self) -> Optional[Dict[Optional[str], dict]]:
+        """Serializes the game and returns the patch message from the previous view for every
+        player watching the room with JSON sockets (`None` for spectators), or None if nothing
+        changed"""
+        with SERIALIZE_SECONDS.time():
+            state = encode_game(self.game)
+
+        if state == self.state:
+            return None
+
+        with PATCH_SECONDS.time():
+            previous_views = {
+                player_name: self.view(player_name)
+                for player_name in {
+                    self.viewers.get(socket) for socket in self.sockets if socket not in self.binary
+                }
+            }
+
+            self.state, self._views, self._binary_views = state, {}, {}
+            self.version += 1
+
+            return {
+                player_name: {
+                    "patch": diff(previous_view, self.view(player_name)),
+                    "version": self.version,
+                }
+                for player_name, previous_view in previous_views.items()
+            }
+
+
+class RoomRegistry:
+    """Rooms hosted by this process
+
+    Rooms without sockets are evicted after `idle_timeout` seconds, and no more than `max_rooms`
+    rooms are hosted at the same time. If there's a `store`, rooms games are loaded from it when
+    created, in its executor (after the writes in progress) so replaying a long log doesn't block
+    the other rooms. Sockets joining a room that is being loaded wait for the same load.
+    """
+
+    def __init__(
+        self,
+        max_rooms: int = 500,
+        idle_timeout: float = 30 * 60,
+        store: Optional[GameStore] = None,
+    ):
+        self.max_rooms = max_rooms
+        self.idle_timeout = idle_timeout
+        self.store = store
+        self.rooms: Dict[str, Room] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self.rooms)
+
+    def evict_idle(self, now: Optional[float] = None) -> List[str]:
+        """Removes the rooms nobody is connected to that have been idle for too long"""
+        now = time.monotonic() if now is None else now
+
+        evicted = [
+            room_id
+            for room_id, room in self.rooms.items()
+            if not room.sockets and now - room.last_activity > self.idle_timeout
+        ]
+        for room_id in evicted:
+            del self.rooms[room_id]
+
+        return evicted
+
+    async def get(self, room_id: str) -> Room:
+        """Returns a room, creating it if it doesn't exist"""
+        if room_id in self.rooms:
+            return self.rooms[room_id]
+
+        if not ROOM_ID_PATTERN.match(room_id):
+            raise RoomError(f"Invalid room id {room_id!r}")
+
+        loading = self._loading.get(room_id)
+        if loading is None:
+            self.evict_idle()
+
+            if len(self.rooms) + len(self._loading) >= self.max_rooms:
+                raise RoomError(f"Can't host more than {self.max_rooms} rooms")
+
+            loading = self._loading[room_id] = asyncio.ensure_future(self._create(room_id))
+            loading.add_done_callback(lambda _: self._loading.pop(room_id, None))
+
+        return await asyncio.shield(loading)
+
+    async def _create(self, room_id: str) -> Room:
+        game = None
+        if self.store is not None:
+            loop = asyncio.get_event_loop()
+            game = await loop.run_in_executor(self.store.executor, self.store.load, room_id)
+
+        room = self.rooms[room_id] = Room(room_id=room_id, game=game or Game())
+        return room
+
+    async def join(self, room_id: str, socket) -> Room:
+        room = await self.get(room_id)
+        room.sockets.add(socket)
+        room.touch()
+
+        return room
+
+    def leave(self, room: Room, socket):
+        room.sockets.discard(socket)
+        room.viewers.pop(socket, None)
+        room.binary.discard(socket)
+        room.broadcaster.unsubscribe(socket)
+        room.touch()
@@ -0,0 +1,294 @@
+"""Headless self-play: bots play full games against each other, to tune rules and to stress the hand
+evaluator.
+
+Every seat is played by a policy, which decides whether to pick from the discard pile, which card
+to throw and whether to finish the match when possible. Games are played through `Game.dispatch`,
+the same as the server does, with seeded shuffles, so a simulation with the same seed always
+returns the same results, no matter how many worker processes play it.
+
+Run it with `python -m conga.simulation --games 10000 --players 4 --policies greedy,random`.
+"""
+import argparse
+import math
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from random import Random
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from conga.bots import Situation, decide_pick, decide_throw
+from conga.card import Card
+from conga.game import Game, GameStatus
+from conga.player import Player, check_cards_values
+
+
+class Policy:
+    """Decisions of a bot. The base policy plays randomly"""
+
+    name = "random"
+
+    def __init__(self, rng: Random):
+        self.rng = rng
+
+    def pick_discard_pile(self, game: Game, player: Player) -> bool:
+        return bool(game.discard_deck.cards) and self.rng.random() < 0.5
+
+    def throw(self, game: Game, player: Player) -> int:
+        """Index of the hand card to throw"""
+        return self.rng.randrange(len(player.hand))
+
+    def finish(self, game: Game, player: Player) -> bool:
+        return True
+
+
+class GreedyPolicy(Policy):
+    """Throws the card that leaves the lowest hand score, and picks from the discard pile if its
+    top card lowers the score"""
+
+    name = "greedy"
+
+    def _best_throw(self, hand: List[Card]) -> Tuple[int, int]:
+        """Lowest score left after throwing a card of the hand, and the index of the card. The
+        highest card is thrown on ties"""
+        options = [
+            (check_cards_values(hand[:ix] + hand[ix + 1 :])[1], -card.number, ix)
+            for ix, card in enumerate(hand)
+        ]
+        score, _, ix = min(options)
+
+        return score, ix
+
+    def pick_discard_pile(self, game: Game, player: Player) -> bool:
+        if not game.discard_deck.cards:
+            return False
+
+        score, _ = self._best_throw(player.hand + [game.discard_deck.cards[0]])
+        return score < player.hand_score
+
+    def throw(self, game: Game, player: Player) -> int:
+        return self._best_throw(player.hand)[1]
+
+
+class LookaheadPolicy(Policy):
+    """The decisions of the server bots (see `conga.bots`), with a fixed number of samples instead
+    of a time budget, so simulations stay deterministic"""
+
+    name = "lookahead"
+    samples = 16
+
+    def pick_discard_pile(self, game: Game, player: Player) -> bool:
+        situation = Situation.of(game, player)
+        params = decide_pick(situation, math.inf, self.samples, self.rng.getrandbits(64))
+
+        return params["pick_discard_pile"]
+
+    def throw(self, game: Game, player: Player) -> int:
+        situation = Situation.of(game, player)
+        return decide_throw(situation, math.inf, self.samples, self.rng.getrandbits(64))["card_id"]
+
+
+POLICIES: Dict[str, type] = {
+    policy.name: policy for policy in [Policy, GreedyPolicy, LookaheadPolicy]
+}
+
+
+@dataclass
+class SimulationResult:
+    """Aggregated results of many games. Results of different workers are merged with `merge`"""
+
+    games: int = 0
+    unfinished_games: int = 0
+    matches: int = 0
+    stalled_matches: int = 0
+    turns: int = 0
+    # Won games and matches by policy name and by seat
+    game_wins: Counter = field(default_factory=Counter)
+    match_wins: Counter = field(default_factory=Counter)
+    seat_wins: Counter = field(default_factory=Counter)
+    # Distributions of the hand scores at the end of every match, and of the final game scores
+    hand_scores: Counter = field(default_factory=Counter)
+    final_scores: Counter = field(default_factory=Counter)
+    elapsed: float = 0
+
+    def merge(self, other: "SimulationResult"):
+        self.games += other.games
+        self.unfinished_games += other.unfinished_games
+        self.matches += other.matches
+        self.stalled_matches += other.stalled_matches
+        self.turns += other.turns
+        self.game_wins.update(other.game_wins)
+        self.match_wins.update(other.match_wins)
+        self.seat_wins.update(other.seat_wins)
+        self.hand_scores.update(other.hand_scores)
+        self.final_scores.update(other.final_scores)
+        self.elapsed += other.elapsed
+
+    def win_rates(self) -> Dict[str, float]:
+        finished = self.games - self.unfinished_games
+        return {name: wins / finished for name, wins in self.game_wins.items()} if finished else {}
+
+
+def play_match(
+    game: Game, policies: Sequence[Policy], result: SimulationResult, max_turns: int = 500
+):
+    """Plays a match until a player finishes it. Matches lasting more than `max_turns` turns are
+    abandoned (the game stays in the started status)"""
+    game.dispatch("start_match", {})
+
+    for _ in range(max_turns):
+        seat = game.match_next_player
+        player, policy = game.players[seat], policies[seat]
+
+        pick_discard_pile = policy.pick_discard_pile(game, player)
+        game.dispatch("player_turn_pick", {"pick_discard_pile": pick_discard_pile})
+        game.dispatch("player_turn_throw", {"card_id": policy.throw(game, player)})
+        result.turns += 1
+
+        # The player keeps the turn after throwing if they can finish the match
+        if game.match_next_player == seat and player.can_finish:
+            finishes = policy.finish(game, player)
+            game.dispatch("player_finish_attempt", {"player_finishes": finishes})
+
+            if finishes:
+                result.matches += 1
+                result.match_wins[policy.name] += 1
+                result.hand_scores.update(player.hand_score for player in game.players)
+                return
+
+    result.stalled_matches += 1
+
+
+def play_game(
+    n_players: int,
+    policy_names: Sequence[str],
+    seed,
+    result: SimulationResult,
+    max_matches: int = 100,
+):
+    """Plays a game until it finishes. Seats are given the policies in order, cycling them"""
+    rng = Random(seed)
+
+    game = Game()
+    game.rng = rng
+    for ix in range(n_players):
+        game.dispatch("add_player", {"name": f"bot_{ix}"})
+
+    policies = [POLICIES[policy_names[ix % len(policy_names)]](rng) for ix in range(n_players)]
+
+    for _ in range(max_matches):
+        play_match(game, policies, result)
+        if game.status == GameStatus.finished:
+            break
+
+    result.games += 1
+    if game.status != GameStatus.finished:
+        result.unfinished_games += 1
+        return
+
+    result.game_wins[policies[game.match_next_player].name] += 1
+    result.seat_wins[game.match_next_player] += 1
+    result.final_scores.update(player.score for player in game.players)
+
+
+def _simulate_chunk(
+    n_games: int, n_players: int, policy_names: Sequence[str], seed: str
+) -> SimulationResult:
+    start = time.perf_counter()
+    rng = Random(seed)
+    result = SimulationResult()
+
+    for _ in range(n_games):
+        play_game(n_players, policy_names, rng.getrandbits(64), result)
+
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _chunks(n_games: int, chunk_size: int, seed: int) -> Iterator[Tuple[int, str]]:
+    # Every chunk has its own seed, so results don't depend on which worker plays it
+    for ix, start in enumerate(range(0, n_games, chunk_size)):
+        yield min(chunk_size, n_games - start), f"{seed}:{ix}"
+
+
+def simulate(
+    n_games: int,
+    n_players: int = 4,
+    policy_names: Sequence[str] = ("greedy",),
+    seed: int = 0,
+    workers: Optional[int] = None,
+    chunk_size: int = 100,
+) -> SimulationResult:
+    """Plays `n_games` games in chunks of `chunk_size` games, with a pool of `workers` processes
+    (all the CPUs by default). A single worker plays them in this process"""
+    for name in policy_names:
+        if name not in POLICIES:
+            raise ValueError(f"Unknown policy {name!r}, valid policies are {list(POLICIES)}")
+
+    arguments = [
+        (chunk_games, n_players, tuple(policy_names), chunk_seed)
+        for chunk_games, chunk_seed in _chunks(n_games, chunk_size, seed)
+    ]
+    result = SimulationResult()
+
+    if workers == 1 or not arguments:
+        for chunk_arguments in arguments:
+            result.merge(_simulate_chunk(*chunk_arguments))
+
+        return result
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_result in executor.map(_simulate_chunk, *zip(*arguments)):
+            result.merge(chunk_result)
+
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m conga.simulation", description=__doc__)
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--policies", default="greedy", help=f"Comma separated {list(POLICIES)}")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=100)
+
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    result = simulate(
+        args.games,
+        n_players=args.players,
+        policy_names=args.policies.split(","),
+        seed=args.seed,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+    )
+    wall_time = time.perf_counter() - start
+
+    print(
+        f"Played {result.games} games, {result.matches} matches, {result.turns} turns "
+        f"in {wall_time:.1f}s ({result.matches / wall_time:.1f} matches/s, "
+        f"{result.elapsed:.1f}s in workers)"
+    )
+    print(
+        f"Unfinished games: {result.unfinished_games}, stalled matches: {result.stalled_matches}"
+    )
+
+    for name, rate in sorted(result.win_rates().items()):
+        print(f"{name} win rate: {rate:.1%}")
+
+    hand_scores = sorted(result.hand_scores.elements())
+    if hand_scores:
+        print(
+            "Hand scores at the end of matches: "
+            f"median {hand_scores[len(hand_scores) // 2]}, "
+            f"p90 {hand_scores[int(len(hand_scores) * 0.9)]}, max {hand_scores[-1]}"
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+"""Compact binary protocol, an alternative to JSON messages for clients that ask for it.
+
+Clients negotiate it with the `conga.bin` websocket subprotocol, otherwise messages are JSON text
+frames. In binary mode every frame is bytes:
+
+* Client actions: a byte with the action code (its index in `ACTION_NAMES`) and its parameters
+  (a byte for booleans and card ids, UTF-8 for names, followed by a NUL byte and the token of the
+  player when reconnecting)
+* Server messages: a byte with the message kind and the state version (`uint32`), followed by:
+
+  - `KIND_STATE`: the full view of the game of the player. A binary view is a tenth of a JSON
+    view, about the size of the JSON patch of a turn, so every version is sent whole and clients
+    don't apply patches
+  - `KIND_ERROR`: the UTF-8 error message
+  - `KIND_PLAYER_STATE`: a state sent to the socket that added a player, followed by the UTF-8
+    token to reconnect as that player
+
+Cards are one byte, their code (see `Card.code`), and lists of cards are a length byte and the
+codes. The cards of players (hands, games and discarded cards) are bit-packed instead: codes are
+below 128, so every card takes 7 bits, in the order of the list (hands can have repeated cards in
+games of several decks, and clients throw cards by their position). Flags of players are packed in
+a byte. Integers are little endian.
+
+`decode_message` returns the same messages (and views) as the JSON protocol.
+"""
+import struct
+from typing import List, Optional, Tuple
+
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+
+from conga.game import VALID_ACTIONS
+
+BINARY_SUBPROTOCOL = "conga.bin"
+
+# Game actions, then the messages handled by the app
+ACTION_NAMES = VALID_ACTIONS + ["resync", "add_bot", "profile"]
+ACTION_CODES = {name: code for code, name in enumerate(ACTION_NAMES)}
+
+# Parameter of the actions with a single byte parameter
+_BYTE_PARAMS = {
+    "player_turn_pick": ("pick_discard_pile", bool),
+    "player_turn_throw": ("card_id", int),
+    "player_finish_attempt": ("player_finishes", bool),
+}
+
+KIND_STATE = 0
+KIND_ERROR = 1
+KIND_PLAYER_STATE = 2
+
+_HEADER = struct.Struct("<BI")
+# Status, match id, next player, start player, deck and discard pile flags and sizes, players
+_GAME = struct.Struct("<BHBBBHHB")
+# Flags, status, restarts, score
+_PLAYER = struct.Struct("<BBBh")
+_SCORE = struct.Struct("<h")
+_PROFILE = struct.Struct("<BH")
+
+_HAS_DECK = 1
+_HAS_DISCARD_DECK = 2
+
+_HAS_HAND = 1
+_HAS_PRIVATE = 2
+_CAN_FINISH = 4
+_FINISH_NEXT_TURN = 8
+_WON_MATCH = 16
+
+
+def negotiate(websocket) -> Optional[str]:
+    """Subprotocol to accept a socket with: the binary one if the client asked for it"""
+    scope = getattr(websocket, "scope", None) or {}
+    return BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in scope.get("subprotocols", []) else None
+
+
+#
+# Client actions
+#
+def encode_action(action: str, params: Optional[dict] = None) -> bytes:
+    params = params or {}
+    code = ACTION_CODES[action]
+
+    if action == "add_player":
+        token = b"\0" + params["token"].encode() if "token" in params else b""
+        return bytes([code]) + params["name"].encode() + token
+
+    if action == "profile":
+        return _PROFILE.pack(code, params.get("actions", 100)) + params["token"].encode()
+
+    if action in _BYTE_PARAMS:
+        name, _ = _BYTE_PARAMS[action]
+        return bytes([code, int(params.get(name, 0))])
+
+    return bytes([code])
+
+
+def decode_action(frame: bytes) -> dict:
+    """Decodes an action frame into the message of the JSON protocol"""
+    if not frame or frame[0] >= len(ACTION_NAMES):
+        raise ValueError(f"Invalid action frame {frame[:8]!r}")
+
+    action = ACTION_NAMES[frame[0]]
+    params = {}
+
+    if action == "add_player":
+        name, separator, token = frame[1:].partition(b"\0")
+        params["name"] = name.decode()
+        if separator:
+            params["token"] = token.decode()
+    elif action == "profile":
+        _, actions = _PROFILE.unpack_from(frame)
+        params = {"actions": actions, "token": frame[_PROFILE.size :].decode()}
+    elif action in _BYTE_PARAMS:
+        name, kind = _BYTE_PARAMS[action]
+        if len(frame) != 2:
+            raise ValueError(f"Invalid {action} frame {frame!r}")
+
+        params[name] = kind(frame[1])
+
+    return {"action": action, "action_params": params}
+
+
+async def receive_message(websocket, binary: bool) -> dict:
+    """Receives the next message of a socket, as a JSON message"""
+    if binary:
+        return decode_action(await websocket.receive_bytes())
+
+    return await websocket.receive_json()
+
+
+def is_disconnected(websocket, ex: Exception) -> bool:
+    """Whether a receive error means the socket is gone. Sockets closed by the server (lagging
+    ones, see `Broadcaster`) raise `RuntimeError` on every receive"""
+    state = getattr(websocket, "application_state", WebSocketState.CONNECTED)
+    return isinstance(ex, (WebSocketDisconnect, RuntimeError)) or state != WebSocketState.CONNECTED
+
+
+#
+# Server messages
+#
+CARD_BITS = 7
+
+
+def _card_code(card: dict) -> int:
+    return card["suit"] * 13 + card["number"]
+
+
+def _card(code: int) -> dict:
+    return {"suit": code // 13, "number": code % 13}
+
+
+def _pack_cards(out: bytearray, cards: List[dict]):
+    out.append(len(cards))
+    out.extend(_card_code(card) for card in cards)
+
+
+def _unpack_cards(data: bytes, offset: int) -> Tuple[List[dict], int]:
+    size = data[offset]
+    codes = data[offset + 1 : offset + 1 + size]
+    return [_card(code) for code in codes], offset + 1 + size
+
+
+def _pack_hand(out: bytearray, cards: List[dict]):
+    bits = 0
+    for ix, card in enumerate(cards):
+        bits |= _card_code(card) << (ix * CARD_BITS)
+
+    out.append(len(cards))
+    out += bits.to_bytes((len(cards) * CARD_BITS + 7) // 8, "little")
+
+
+def _unpack_hand(data: bytes, offset: int) -> Tuple[List[dict], int]:
+    size = data[offset]
+    end = offset + 1 + (size * CARD_BITS + 7) // 8
+    bits = int.from_bytes(data[offset + 1 : end], "little")
+
+    mask = (1 << CARD_BITS) - 1
+    return [_card(bits >> (ix * CARD_BITS) & mask) for ix in range(size)], end
+
+
+def _pack_player(out: bytearray, player: dict):
+    has_hand, has_private = "hand" in player, "hand_score" in player
+
+    flags = (
+        (_HAS_HAND if has_hand else 0)
+        | (_HAS_PRIVATE if has_private else 0)
+        | (_CAN_FINISH if player.get("can_finish") else 0)
+        | (_FINISH_NEXT_TURN if player["finish_next_turn"] else 0)
+        | (_WON_MATCH if player["won_match"] else 0)
+    )
+    out += _PLAYER.pack(flags, player["status"], player["restarts"], player["score"])
+
+    # Names are cut to 255 bytes
+    name = player["name"].encode()[:255]
+    out.append(len(name))
+    out += name
+
+    if has_private:
+        out += _SCORE.pack(player["hand_score"])
+        out.append(len(player["hand_candidates"]))
+        for candidate in player["hand_candidates"]:
+            _pack_hand(out, candidate)
+
+    if has_hand:
+        _pack_hand(out, player["hand"])
+    else:
+        out.append(player["hand_count"])
+
+    _pack_hand(out, player["hand_discarded"])
+
+
+def _unpack_player(data: bytes, offset: int) -> Tuple[dict, int]:
+    flags, status, restarts, score = _PLAYER.unpack_from(data, offset)
+    offset += _PLAYER.size
+
+    size = data[offset]
+    player = {
+        "name": data[offset + 1 : offset + 1 + size].decode(errors="ignore"),
+        "finish_next_turn": bool(flags & _FINISH_NEXT_TURN),
+        "restarts": restarts,
+        "score": score,
+        "status": status,
+        "won_match": bool(flags & _WON_MATCH),
+    }
+    offset += 1 + size
+
+    if flags & _HAS_PRIVATE:
+        (player["hand_score"],) = _SCORE.unpack_from(data, offset)
+        player["can_finish"] = bool(flags & _CAN_FINISH)
+
+        n_candidates, offset = data[offset + _SCORE.size], offset + _SCORE.size + 1
+        player["hand_candidates"] = []
+        for _ in range(n_candidates):
+            candidate, offset = _unpack_hand(data, offset)
+            player["hand_candidates"].append(candidate)
+
+    if flags & _HAS_HAND:
+        player["hand"], offset = _unpack_hand(data, offset)
+    else:
+        player["hand_count"], offset = data[offset], offset + 1
+
+    player["hand_discarded"], offset = _unpack_hand(data, offset)
+
+    return player, offset
+
+
+def encode_view(view: dict, version: int, kind: int = KIND_STATE) -> bytes:
+    """Encodes a view of a game (see `Game.project`) as a state message"""
+    deck, discard_deck = view["deck"], view["discard_deck"]
+
+    out = bytearray(_HEADER.pack(kind, version))
+    out += _GAME.pack(
+        view["status"],
+        view["match_id"],
+        view["match_next_player"],
+        view["match_start_player"],
+        (_HAS_DECK if deck is not None else 0)
+        | (_HAS_DISCARD_DECK if discard_deck is not None else 0),
+        deck["cards_count"] if deck is not None else 0,
+        discard_deck["cards_count"] if discard_deck is not None else 0,
+        len(view["players"]),
+    )
+    _pack_cards(out, discard_deck["cards"] if discard_deck is not None else [])
+
+    for player in view["players"]:
+        _pack_player(out, player)
+
+    return bytes(out)
+
+
+def encode_message(message: dict) -> bytes:
+    """Encodes a state (`{"game": ..., "version": ...}`, with the `token` of the player it was
+    added for, if any) or error message"""
+    if "token" in message:
+        frame = encode_view(message["game"], message["version"], KIND_PLAYER_STATE)
+        return frame + message["token"].encode()
+
+    if "game" in message:
+        return encode_view(message["game"], message["version"])
+
+    if "error" in message:
+        return _HEADER.pack(KIND_ERROR, message["version"]) + message["error"].encode()
+
+    raise ValueError(f"Can't encode message with keys {list(message)}")
+
+
+def decode_message(frame: bytes) -> dict:
+    """Decodes a server message into the message of the JSON protocol"""
+    kind, version = _HEADER.unpack_from(frame)
+    offset = _HEADER.size
+
+    if kind == KIND_ERROR:
+        return {"error": frame[offset:].decode(), "version": version}
+
+    status, match_id, next_player, start_player, flags, deck_count, discard_count, n_players = (
+        _GAME.unpack_from(frame, offset)
+    )
+    discard_top, offset = _unpack_cards(frame, offset + _GAME.size)
+
+    players = []
+    for _ in range(n_players):
+        player, offset = _unpack_player(frame, offset)
+        players.append(player)
+
+    game = {
+        "status": status,
+        "deck": {"cards_count": deck_count} if flags & _HAS_DECK else None,
+        "discard_deck": {"cards": discard_top, "cards_count": discard_count}
+        if flags & _HAS_DISCARD_DECK
+        else None,
+        "players": players,
+        "match_id": match_id,
+        "match_next_player": next_player,
+        "match_start_player": start_player,
+    }
+
+    if kind == KIND_PLAYER_STATE:
+        return {"game": game, "version": version, "token": frame[offset:].decode()}
+
+    return {"game": game, "version": version}
@@ -1,10 +1,48 @@
+import asyncio
+import copy
+import itertools
+import json
+import multiprocessing
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
 from conga import __version__
 
-from pytest import fixture
+from pytest import fixture, importorskip, raises
+from starlette.websockets import WebSocketDisconnect
 
 from conga.game import Game, GameStatus
-from conga.card import Card, Suit, Joker
-from conga.player import Player
+from conga.card import Card, DiscardDeck, Suit, Joker, build_deck
+from conga import player as player_module
+from conga.player import (
+    Player,
+    _best_melds,
+    _check_flush,
+    _check_same_of_a_kind,
+    _search_melds,
+    check_cards_values,
+    state_updates,
+)
+from conga import bots as bots_module
+from conga.bots import BotEngine, Situation, decide_pick, decide_throw
+from conga.broadcast import Broadcaster
+from conga.cluster import HashRing, LocalBackplane, Node, UnixSocketBackplane
+from conga.codec import decode_game, dump_game, encode_game, loads
+from conga.persistence import GameStore
+from conga.replay import replay
+from conga.patch import apply_patch, apply_patch_in_place, diff
+from conga.rooms import Room, RoomError, RoomRegistry
+from conga.simulation import simulate
+from conga.metrics import ACTION_REJECTIONS, ACTION_TIMEOUTS, Registry
+from conga import offload
+from conga import wire
+from conga.offload import ActionRunner, ActionTimeoutError
+from conga.profiling import ActionProfiler, replay_report
+from conga.meld_table import MeldTable, canonical_hand, set_meld_table, write_meld_table
 
 
 @fixture
@@ -81,6 +119,58 @@ def test_game_finishes(game_started):
     assert game.players[1].score == 186
 
 
+def _discard_pairwise(game):
+    """Reference implementation of the discards of `Game._finish_match`, checking every card of
+    every player against every game of the other players"""
+    players = game.players[game.match_next_player :] + game.players[: game.match_next_player]
+
+    for player_a in players:
+        for player_b in players:
+            if player_a is player_b:
+                continue
+
+            for candidate in player_a.hand_candidates:
+                used_codes = {
+                    card.code
+                    for card in itertools.chain(player_b.hand_discarded, *player_b.hand_candidates)
+                }
+                cards_to_discard = [card for card in player_b.hand if card.code not in used_codes]
+
+                for card in cards_to_discard:
+                    disc_candidates, candidate_score = check_cards_values(candidate + [card])
+                    if candidate_score == 0 and len(disc_candidates) == 1:
+                        player_b.hand_discarded.append(card)
+                        candidate.append(card)
+
+
+def test_finish_match_discards_match_pairwise():
+    rng = random.Random(13)
+    deck = build_deck() * 2
+    discarded = 0
+
+    for _ in range(40):
+        game = Game()
+        for i in range(rng.choice([2, 4, 8])):
+            game.add_player(f"player_{i}")
+
+        game.status = GameStatus.started
+        game.match_next_player = rng.randrange(len(game.players))
+        for player in game.players:
+            player.hand = rng.sample(deck, 7)
+            player.update_state()
+
+        expected = copy.deepcopy(game)
+        _discard_pairwise(expected)
+        game._finish_match()
+
+        for player, expected_player in zip(game.players, expected.players):
+            assert player.hand_discarded == expected_player.hand_discarded
+            assert player.hand_candidates == expected_player.hand_candidates
+            discarded += len(player.hand_discarded)
+
+    assert discarded > 0
+
+
 def test_player_update_state():
     player = Player(name="player_1")
 
@@ -144,3 +234,1369 @@ def test_player_update_state():
     assert player.hand_score == 9
     assert len(player.hand_candidates) == 1
     assert len(player.hand_candidates[0]) == 3
+
+
+def _check_flush_permutations(cards):
+    """Reference flush search (permutation based) used to validate `_check_flush`"""
+
+    def check_flush_joker(comb, j):
+        try:
+            prev_ix = j - 1 - [c.suit for c in comb[:j]][::-1].index(Joker.joker)
+        except ValueError:
+            prev_ix = None
+
+        if prev_ix is None or j - prev_ix > 1:
+            prev_ix = j - 1
+
+        ix_diff_to_next = j - prev_ix + 1
+
+        return (
+            j > 0 and comb[j].suit == Joker.joker and comb[prev_ix] + ix_diff_to_next == comb[j + 1]
+        )
+
+    def check_flush_joker_count(comb):
+        no_joker_count = len([card for card in comb if card.suit != Joker.joker])
+        joker_count = len([card for card in comb if card.suit == Joker.joker])
+
+        return not joker_count > no_joker_count
+
+    suit_sorted_hand = sorted(cards, key=lambda card: (card.suit, card.number))
+    candidate_hands = []
+
+    for suit, suit_cards in itertools.groupby(suit_sorted_hand, lambda card: card.suit):
+        suit_cards = list(suit_cards) + [card for card in cards if card.suit == Joker.joker]
+
+        for i in range(3, 7):
+            for comb in itertools.permutations(suit_cards, i):
+                if all(
+                    comb[j].number != 12
+                    and check_flush_joker_count(comb)
+                    and (
+                        comb[j] + 1 == comb[j + 1]
+                        or comb[j + 1].suit == Joker.joker
+                        or check_flush_joker(comb, j)
+                    )
+                    for j in range(i - 1)
+                ):
+                    candidate_hands.append(comb)
+
+    return candidate_hands
+
+
+def _random_hands(n_hands, seed=0):
+    rng = random.Random(seed)
+    deck = build_deck() + build_deck()
+
+    # Half of the hands come from a single suit plus jokers to stress flush detection
+    for i in range(n_hands):
+        size = rng.choice([7, 8])
+
+        if i % 2:
+            suit = rng.choice(list(Suit))
+            pool = [card for card in deck if card.suit in (suit, Joker.joker)]
+        else:
+            pool = deck
+
+        yield rng.sample(pool, size)
+
+
+def test_check_flush_matches_permutations(monkeypatch):
+    def values(candidates):
+        return {tuple((card.suit, card.number) for card in cand) for cand in candidates}
+
+    for hand in _random_hands(100):
+        expected = _check_flush_permutations(hand)
+        assert values(player_module._check_flush(hand)) == values(expected)
+
+        _, score = player_module.check_cards_values(hand)
+
+        monkeypatch.setattr(player_module, "_check_flush", _check_flush_permutations)
+        _best_melds.cache_clear()
+        _, expected_score = player_module.check_cards_values(hand)
+        monkeypatch.undo()
+        _best_melds.cache_clear()
+
+        assert score == expected_score
+
+
+def _check_cards_values_pairwise(cards):
+    """Reference search (pairs of candidates) used to validate `check_cards_values`"""
+    better_candidates = []
+    better_hand_score = sum([card.number for card in cards])
+
+    candidates = [list(cand) for cand in _check_flush(cards) + _check_same_of_a_kind(cards)]
+
+    for cand_group in itertools.chain(
+        ([cand] for cand in candidates), itertools.combinations(candidates, 2)
+    ):
+        current_hand = cards.copy()
+
+        try:
+            for card in itertools.chain(*cand_group):
+                current_hand.remove(card)
+        except ValueError:
+            continue
+
+        current_score = sum(card.number for card in current_hand)
+        if current_score < better_hand_score:
+            better_candidates = list(cand_group)
+            better_hand_score = current_score
+
+    return better_candidates, better_hand_score
+
+
+def test_check_cards_values_matches_pairwise():
+    for hand in _random_hands(300, seed=1):
+        candidates, score = check_cards_values(hand)
+        _, expected_score = _check_cards_values_pairwise(hand)
+
+        assert score == expected_score
+
+        # Candidate games are disjoint and made of the hand cards
+        remaining = list(hand)
+        for card in itertools.chain(*candidates):
+            remaining.remove(card)
+
+        assert sum(card.number for card in remaining) == score
+
+
+def test_check_cards_values_cache():
+    hand = [
+        Card(suit=Suit.clubs, number=1),
+        Card(suit=Suit.clubs, number=2),
+        Card(suit=Suit.clubs, number=3),
+        Card(suit=Suit.gold, number=5),
+        Card(suit=Suit.sword, number=5),
+        Card(suit=Joker.joker, number=0),
+        Card(suit=Suit.cups, number=9),
+    ]
+
+    candidates, score = check_cards_values(hand)
+    hits = _best_melds.cache_info().hits
+
+    # Same hand in a different order hits the cache and returns new lists
+    other_candidates, other_score = check_cards_values(hand[::-1])
+
+    assert _best_melds.cache_info().hits == hits + 1
+    assert (other_candidates, other_score) == (candidates, score)
+    assert other_candidates[0] is not candidates[0]
+    assert score == 9
+
+
+def test_card_code():
+    codes = set()
+
+    for card in build_deck():
+        assert Card.from_code(card.code) == card
+        assert hash(card) == card.code
+        codes.add(card.code)
+
+    # Every card has its own code (jokers share one)
+    assert len(codes) == 12 * 4 + 1
+    assert Card(suit=Suit.gold, number=4).code != Card(suit=Suit.clubs, number=3).code
+
+
+def test_deck_piles():
+    game = Game()
+    for name in ["a", "b", "c", "d", "e"]:
+        game.add_player(name)
+
+    game.start_match()
+    deck, discard_deck = game.deck, game.discard_deck
+
+    # Two decks for 5 players, 7 cards dealt to each of them
+    assert len(deck.cards) == 2 * len(build_deck()) - 5 * 7
+
+    # Cards are taken from and thrown to the top of the piles, serialized as lists
+    top = deck.cards[0]
+    game.player_turn_pick()
+    assert game.players[0].hand[-1] == top
+
+    game.player_turn_throw(7)
+    assert discard_deck.cards[0] == top
+    assert game.to_dict()["discard_deck"]["cards"] == [top.to_dict()]
+    assert Game.from_dict(game.to_dict()).to_dict() == game.to_dict()
+
+    # Reshuffling moves the discard pile into the same deck
+    game._reshuffle_deck()
+    assert game.deck is deck and list(deck.cards).count(top) >= 1
+    assert len(discard_deck.cards) == 0
+
+    # The piles are reused by the next match
+    game.start_match()
+    assert game.deck is deck and game.discard_deck is discard_deck
+    assert len(deck.cards) == 2 * len(build_deck()) - 5 * 7
+
+
+def test_meld_table(tmp_path):
+    path = str(tmp_path / "melds.bin")
+    hands = [tuple(sorted(card.code for card in hand)) for hand in _random_hands(50, seed=2)]
+    # Tied games, picked the same way whatever the suits
+    hands.append((30, 31, 33, 42, 43, 46, 48, 65))
+
+    write_meld_table(
+        path, [(key, *_search_melds(key)) for key in {canonical_hand(h)[0] for h in hands}]
+    )
+    table = MeldTable(path)
+
+    assert len(table) == len({canonical_hand(h)[0] for h in hands})
+
+    try:
+        set_meld_table(table)
+        _best_melds.cache_clear()
+
+        for hand_key in hands:
+            melds, score = table.lookup(hand_key)
+            assert (melds, score) == _search_melds(hand_key)
+
+            remaining = list(hand_key)
+            for code in itertools.chain(*melds):
+                remaining.remove(code)
+
+            assert sum(code % 13 for code in remaining) == score
+            assert _best_melds(hand_key) == (melds, score)
+
+        # Hands that are not in the table are computed
+        assert table.lookup((14, 15, 16, 30, 31, 32, 60, 61)) is None
+        assert _best_melds((14, 15, 16, 30, 31, 32, 60, 61))[1] == 17
+    finally:
+        set_meld_table(None)
+        _best_melds.cache_clear()
+        table.close()
+
+
+def test_player_incremental_update_state():
+    deck = build_deck() + build_deck()
+    rng = random.Random(3)
+    player = Player(name="player_1")
+    player.hand = rng.sample(deck, 7)
+
+    # States are evaluated when they are read, once per update
+    state_updates.clear()
+    player.update_state()
+    player.update_state()
+    assert state_updates == {}
+
+    assert player.hand_score == player.hand_score
+    player.update_state()
+    assert player.hand_candidates is player.hand_candidates
+
+    assert state_updates == {"full": 1, "unchanged": 1}
+
+    for i in range(200):
+        if len(player.hand) == 7:
+            player.hand.append(rng.choice(deck))
+        else:
+            player.hand.pop(rng.randrange(len(player.hand)))
+
+        player.update_state()
+
+        hand_key = tuple(sorted(card.code for card in player.hand))
+        assert (
+            tuple(tuple(card.code for card in cand) for cand in player.hand_candidates),
+            player.hand_score,
+        ) == _search_melds(hand_key)
+
+    assert state_updates == {"full": 1, "incremental": 200, "unchanged": 1}
+
+
+def test_room_registry():
+    async def run():
+        rooms = RoomRegistry(max_rooms=2, idle_timeout=60)
+
+        room = await rooms.join("table_1", "socket_1")
+        assert await rooms.get("table_1") is room
+        assert room.sockets == {"socket_1"}
+
+        await rooms.get("table_2")
+        with raises(RoomError):
+            await rooms.get("table_3")
+
+        with raises(RoomError):
+            await rooms.get("../table")
+
+        # Only rooms without sockets are evicted once they are idle
+        rooms.leave(room, "socket_1")
+        assert rooms.evict_idle(now=room.last_activity + 30) == []
+        assert sorted(rooms.evict_idle(now=room.last_activity + 120)) == ["table_1", "table_2"]
+
+        await rooms.join("table_3", "socket_3")
+        assert len(rooms) == 1
+
+    asyncio.run(run())
+
+
+def test_room_registry_loads_games_in_the_store_executor(tmp_path):
+    store = GameStore(directory=str(tmp_path))
+    game = Game()
+    game.add_player("p1")
+
+    loads = []
+    load = store.load
+
+    def slow_load(room_id):
+        loads.append(threading.current_thread())
+        time.sleep(0.05)
+        return load(room_id)
+
+    store.load = slow_load
+
+    async def run():
+        store.snapshot("table", encode_game(game))
+        await store.flush()
+        rooms = RoomRegistry(store=store)
+
+        # Sockets joining while the room loads wait for the same room
+        first, second = await asyncio.gather(
+            rooms.join("table", "socket_1"), rooms.join("table", "socket_2")
+        )
+        assert first is second and first.sockets == {"socket_1", "socket_2"}
+        assert [player.name for player in first.game.players] == ["p1"]
+
+        assert len(loads) == 1 and loads[0] is not threading.main_thread()
+        assert not rooms._loading
+
+    asyncio.run(run())
+
+
+def test_patch_game_states(game_started):
+    game = game_started
+    room = Room(room_id="table", game=game, sockets={"socket_1", "socket_2"})
+    room.viewers["socket_1"] = "player_1"
+
+    client_states = {name: room.snapshot(name)["game"] for name in ["player_1", None]}
+
+    for action, params in [
+        ("player_turn_pick", {}),
+        ("player_turn_throw", {"card_id": 0}),
+        ("player_turn_pick", {"pick_discard_pile": True}),
+        ("player_turn_throw", {"card_id": 3}),
+        ("add_player", {"name": "player_3"}),
+    ]:
+        getattr(game, action)(**params)
+
+        messages = room.update_state()
+        if messages is None:
+            continue
+
+        for name, message in messages.items():
+            client_states[name] = apply_patch(client_states[name], message["patch"])
+            assert client_states[name] == Game.project(game.to_dict(), name)
+
+    assert room.version == 4
+    assert room.update_state() is None
+
+    # Players only see their own hand
+    player_view, spectator_view = client_states["player_1"], client_states[None]
+    assert player_view["players"][0]["hand"] == [card.to_dict() for card in game.players[0].hand]
+    assert "hand" not in player_view["players"][1]
+    assert [player.get("hand_count") for player in spectator_view["players"]] == [7, 7]
+    assert spectator_view["deck"] == {"cards_count": len(game.deck.cards)}
+    assert spectator_view["discard_deck"] == {
+        "cards": [game.discard_deck.cards[0].to_dict()],
+        "cards_count": len(game.discard_deck.cards),
+    }
+
+    # Taking a card from the top of the deck only changes the deck size and the player hand
+    next_player = game.match_next_player
+    game.player_turn_pick()
+
+    messages = room.update_state()
+    deck_operation = {"op": "replace", "path": "/deck/cards_count", "value": len(game.deck.cards)}
+
+    assert messages[None]["patch"] == [
+        deck_operation,
+        {"op": "replace", "path": f"/players/{next_player}/hand_count", "value": 8},
+    ]
+    assert messages["player_1"]["patch"] == [
+        deck_operation,
+        {"op": "add", "path": "/players/0/hand/7", "value": game.players[0].hand[7].to_dict()},
+    ] if next_player == 0 else messages[None]["patch"]
+
+
+def test_patch():
+    old = {"a": [1, 2, 3, 4], "b": {"c": 1, "d/e": 2}, "f": None}
+    new = {"a": [0, 1, 3, 4, 5], "b": {"c": 2}, "f": [1], "g": "~"}
+
+    assert apply_patch(old, diff(old, new)) == new
+    assert apply_patch(new, diff(new, old)) == old
+    assert diff(old, old) == []
+
+    # Clients that own their document apply patches without copying it
+    document = copy.deepcopy(old)
+    assert apply_patch_in_place(document, diff(old, new)) is document
+    assert document == new
+    assert apply_patch_in_place(document, [{"op": "replace", "path": "", "value": 1}]) == 1
+
+
+class FakeWebSocket:
+    def __init__(self, blocked=False, subprotocols=()):
+        self.messages = []
+        self.closed = None
+        self.unblocked = asyncio.Event()
+        self.scope = {"subprotocols": list(subprotocols)}
+        self.subprotocol = None
+        # Messages received from the client, `None` disconnects it
+        self.incoming = asyncio.Queue()
+
+        if not blocked:
+            self.unblocked.set()
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def receive_json(self):
+        data = await self.incoming.get()
+        if data is None:
+            raise WebSocketDisconnect(1000)
+
+        return data
+
+    receive_bytes = receive_json
+
+    async def send_text(self, text):
+        await self.unblocked.wait()
+        self.messages.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        await self.unblocked.wait()
+        self.messages.append(wire.decode_message(data))
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+class ClosingWebSocket(FakeWebSocket):
+    # Like starlette sockets, receiving after the server closed them raises RuntimeError
+    async def receive_json(self):
+        if self.closed is not None:
+            raise RuntimeError('Unexpected ASGI message "websocket.receive"')
+
+        data = await self.incoming.get()
+        if isinstance(data, Exception):
+            raise data
+
+        return data
+
+
+def test_broadcaster_slow_consumer():
+    async def run():
+        broadcaster = Broadcaster(max_queue=2, max_lag=60)
+        fast_socket, slow_socket = FakeWebSocket(), FakeWebSocket(blocked=True)
+
+        broadcaster.subscribe(fast_socket)
+        broadcaster.subscribe(slow_socket)
+
+        for version in range(1, 6):
+            broadcaster.publish({"version": version}, lambda: {"game": {}, "version": version})
+            await asyncio.sleep(0)
+
+        # The slow socket is stuck sending the first message, its queue got full and the pending
+        # messages were replaced by the full state
+        metrics = broadcaster.metrics()
+        assert metrics["lagging"] == 1
+        assert metrics["coalesced"] > 0
+
+        slow_socket.unblocked.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+        assert fast_socket.messages == [{"version": version} for version in range(1, 6)]
+        assert slow_socket.messages[-1] == {"version": 5}
+        assert {"game": {}, "version": 4} in slow_socket.messages
+        assert broadcaster.metrics()["lagging"] == 0
+
+        # Sockets lagging for too long are dropped
+        broadcaster.max_lag = 0
+        slow_socket.unblocked.clear()
+        for version in range(6, 12):
+            broadcaster.publish({"version": version}, lambda: {"game": {}, "version": version})
+            await asyncio.sleep(0.001)
+
+        assert slow_socket.closed == 1013
+        assert list(broadcaster.subscribers) == [fast_socket]
+        assert broadcaster.metrics()["dropped"] == 1
+
+        broadcaster.unsubscribe(fast_socket)
+
+    asyncio.run(run())
+
+
+def test_game_store_replay(tmp_path):
+    async def run():
+        store = GameStore(directory=str(tmp_path), snapshot_every=3, flush_interval=0)
+        game = store.load("table") or Game()
+
+        actions = [
+            ("add_player", {"name": "player_1"}),
+            ("add_player", {"name": "player_2"}),
+            ("start_match", {}),
+            ("player_turn_pick", {}),
+            ("player_turn_throw", {"card_id": 0}),
+            ("player_turn_pick", {"pick_discard_pile": True}),
+            ("player_turn_throw", {"card_id": 7}),
+            ("player_turn_pick", {}),
+        ]
+        for action, params in actions:
+            seed, _ = store.prepare("table", game, action)
+            game.dispatch(action, params)
+            store.record("table", action, params, game.to_dict(), seed)
+
+        await store.flush()
+
+        # Every action is logged, and the last snapshot (the second throw) points after it
+        with open(tmp_path / "table.log") as f:
+            assert [json.loads(line)["seq"] for line in f] == list(range(1, 9))
+
+        with open(tmp_path / "table.json") as f:
+            snapshot = json.load(f)
+
+        with open(tmp_path / "table.log", "rb") as f:
+            f.seek(snapshot["offset"])
+            assert snapshot["seq"] == 6 and json.loads(f.readline())["seq"] == 7
+
+        loaded_game = GameStore(directory=str(tmp_path)).load("table")
+        assert loaded_game.to_dict() == game.to_dict()
+
+        # A torn write at the end of the log is ignored, and removed so the next actions follow
+        # the last complete one
+        with open(tmp_path / "table.log", "a") as f:
+            f.write('{"seq": 9, "act')
+
+        store = GameStore(directory=str(tmp_path), flush_interval=0)
+        loaded_game = store.load("table")
+        assert loaded_game.to_dict() == game.to_dict()
+
+        for same_game in [loaded_game, game]:
+            store.prepare("table", same_game, "player_turn_throw")
+            same_game.dispatch("player_turn_throw", {"card_id": 3})
+
+        store.record("table", "player_turn_throw", {"card_id": 3}, loaded_game.to_dict())
+        await store.flush()
+
+        assert GameStore(directory=str(tmp_path)).load("table").to_dict() == game.to_dict()
+
+        # Starting a match that fails keeps the seed of the logged match
+        store.prepare("table", copy.deepcopy(game), "start_match")
+        store.snapshot("table", game.to_dict())
+        await store.flush()
+
+        with open(tmp_path / "table.json") as f:
+            assert json.load(f)["seed"] == snapshot["seed"]
+
+    asyncio.run(run())
+
+
+def test_replay_any_action(tmp_path):
+    async def run():
+        store = GameStore(directory=str(tmp_path), snapshot_every=7, flush_interval=0)
+        game = Game()
+        rng = random.Random(20)
+        states = {0: game.to_dict()}
+
+        # Two matches with seeded shuffles, long enough to reshuffle the discard pile
+        actions = [("add_player", {"name": f"player_{ix}"}) for ix in range(4)]
+        for _ in range(2):
+            actions.append(("start_match", {}))
+            for _ in range(30):
+                actions.append(("player_turn_pick", {"pick_discard_pile": False}))
+                actions.append(("player_turn_throw", {"card_id": rng.randrange(8)}))
+            actions.append(("player_finish_attempt", {"player_finishes": True}))
+
+        for seq, (action, params) in enumerate(actions, start=1):
+            seed, _ = store.prepare("table", game, action)
+            game.dispatch(action, params)
+            store.record("table", action, params, game.to_dict(), seed)
+            states[seq] = game.to_dict()
+
+        await store.flush()
+
+        for seq in [0, 3, 5, 7, 40, 66, 67, len(actions)]:
+            state = replay(str(tmp_path), "table", seq)
+            assert state.seq == seq
+            assert state.game.to_dict() == states[seq]
+
+        assert replay(str(tmp_path), "table").game.to_dict() == game.to_dict()
+        assert replay(str(tmp_path), "other") is None
+
+    asyncio.run(run())
+
+
+def _played_game(n_players, turns):
+    random.seed(n_players)
+
+    game = Game()
+    for i in range(n_players):
+        game.dispatch("add_player", {"name": f"player_{i}"})
+
+    game.dispatch("start_match", {})
+    for i in range(turns):
+        pick_discard_pile = bool(i % 2 and game.discard_deck.cards)
+        game.dispatch("player_turn_pick", {"pick_discard_pile": pick_discard_pile})
+        game.dispatch("player_turn_throw", {"card_id": i % 8})
+
+        if game.players[game.match_next_player].can_finish:
+            game.dispatch("player_finish_attempt", {"player_finishes": True})
+            break
+
+    return game
+
+
+def test_codec():
+    for n_players in [2, 4, 8]:
+        game = _played_game(n_players, turns=10)
+        data = game.to_dict()
+
+        assert encode_game(game) == data
+        assert decode_game(data) == Game.from_dict(data)
+        assert decode_game(encode_game(game, wire_version=2)) == Game.from_dict(data)
+        assert loads(dump_game(game)) == json.loads(json.dumps(data))
+
+    assert encode_game(Game()) == Game().to_dict()
+    assert decode_game(Game().to_dict()) == Game()
+
+
+def test_wire(game_started):
+    game = game_started
+    room = Room(room_id="table", game=game)
+
+    def check_views():
+        for name in [None, "player_1", "player_2"]:
+            message = room.snapshot(name)
+            frame = wire.encode_message(message)
+
+            assert wire.decode_message(frame) == message
+            assert len(frame) * 5 < len(json.dumps(message))
+
+    check_views()
+
+    # Hands are 7 bits per card, repeated cards included
+    hand = [card.to_dict() for card in build_deck()[:4] * 2]
+    packed = bytearray()
+    wire._pack_hand(packed, hand)
+    assert len(packed) == 1 + 7 and wire._unpack_hand(bytes(packed), 0) == (hand, len(packed))
+
+    # Showcases have the hands and games of every player
+    game.player_turn_pick()
+    game.player_turn_throw(card_id=7)
+    for player in game.players:
+        player.update_state()
+    game._finish_match()
+    room.update_state()
+
+    assert game.status == GameStatus.showcase
+    check_views()
+
+    error = {"error": "Invalid action", "version": 3}
+    assert wire.decode_message(wire.encode_message(error)) == error
+
+    player_state = {**room.snapshot("player_1"), "token": "secret"}
+    assert wire.decode_message(wire.encode_message(player_state)) == player_state
+
+    for action, params in [
+        ("add_player", {"name": "jugador 1"}),
+        ("add_player", {"name": "jugador 1", "token": "secret"}),
+        ("start_match", {}),
+        ("player_turn_pick", {"pick_discard_pile": True}),
+        ("player_turn_throw", {"card_id": 7}),
+        ("player_finish_attempt", {"player_finishes": False}),
+        ("resync", {}),
+        ("profile", {"actions": 20, "token": "secret"}),
+    ]:
+        message = {"action": action, "action_params": params}
+        assert wire.decode_action(wire.encode_action(action, params)) == message
+
+    with raises(ValueError):
+        wire.decode_action(bytes([255]))
+    with raises(ValueError):
+        wire.decode_action(bytes([wire.ACTION_CODES["player_turn_throw"]]))
+
+
+def test_sort_cards_duplicated_cards():
+    joker = Card(suit=Joker.joker, number=0)
+    player = Player(name="test")
+    player.hand = [
+        Card(suit=Suit.cups, number=4),
+        Card(suit=Suit.gold, number=4),
+        joker,
+        Card(suit=Suit.sword, number=9),
+        Card(suit=Suit.sword, number=9),
+        Card(suit=Suit.clubs, number=4),
+        joker,
+    ]
+    hand = list(player.hand)
+
+    player.update_state()
+    player.sort_cards()
+
+    assert Counter(player.hand) == Counter(hand)
+
+
+def test_simulation():
+    policy_names = ["greedy", "random"]
+    result = simulate(6, n_players=3, policy_names=policy_names, seed=1, workers=1, chunk_size=4)
+
+    assert result.games == 6
+    assert result.matches >= result.games - result.unfinished_games
+    assert sum(result.game_wins.values()) == sum(result.seat_wins.values())
+    assert sum(result.game_wins.values()) == result.games - result.unfinished_games
+    assert sum(result.match_wins.values()) == result.matches
+    assert sum(result.hand_scores.values()) == 3 * result.matches
+
+    # Results only depend on the seed
+    other = simulate(6, n_players=3, policy_names=policy_names, seed=1, workers=2, chunk_size=4)
+    assert (other.games, other.matches, other.turns) == (result.games, result.matches, result.turns)
+    assert other.game_wins == result.game_wins
+    assert other.hand_scores == result.hand_scores
+
+    with raises(ValueError):
+        simulate(1, policy_names=["unknown"])
+
+
+def test_bot_decisions(monkeypatch):
+    hand = [Card(suit=Suit.cups, number=number) for number in [1, 2, 3, 4, 5, 6]]
+    hand += [Card(suit=Suit.gold, number=12), Card(suit=Suit.sword, number=9)]
+
+    game = Game(players=[Player(name="bot-1", hand=hand)], discard_deck=DiscardDeck())
+    game.players[0].update_state()
+    situation = Situation.of(game, game.players[0])
+
+    # The highest card out of the flush is thrown, and the unseen cards are the rest of the deck
+    assert decide_throw(situation, budget=0.02) == {"card_id": 6}
+    assert sorted(situation.unseen + situation.hand) == sorted(card.code for card in build_deck())
+
+    # The discard pile is picked when its top card can finish the match
+    game.discard_deck.put(Card(suit=Suit.cups, number=7))
+    player = Player(name="bot-1", hand=hand[:6] + [Card(suit=Suit.gold, number=12)])
+    player.update_state()
+    assert decide_pick(Situation.of(game, player), budget=0.02) == {"pick_discard_pile": True}
+
+    game.discard_deck.put(Card(suit=Suit.clubs, number=11))
+    assert decide_pick(Situation.of(game, player), budget=0.02) == {"pick_discard_pile": False}
+
+    # Decisions return within the budget, even for hands without time for a single sample
+    joker = Card(suit=Joker.joker, number=0)
+    hand = [Card(suit=Suit.cups, number=number) for number in [1, 3, 5, 8, 10, 12]] + [joker]
+    player = Player(name="bot-1", hand=hand + [Card(suit=Suit.gold, number=8)])
+    player.update_state()
+
+    for budget in [0, 0.01]:
+        start = time.perf_counter()
+        decide_throw(Situation.of(game, player), budget=budget)
+        assert time.perf_counter() - start < budget + 0.05
+
+    # Without time left no search runs, and the highest card is thrown
+    searches = []
+    monkeypatch.setattr(bots_module, "_score", searches.append)
+    monkeypatch.setattr(bots_module, "_best_throw", searches.append)
+
+    assert decide_throw(Situation.of(game, player), budget=0) == {"card_id": 5}
+    assert decide_pick(Situation.of(game, player), budget=0) == {"pick_discard_pile": False}
+    assert searches == []
+
+
+def test_bots_play_their_turns(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONGA_DATA_DIR", str(tmp_path))
+    from conga import app
+
+    random.seed(21)
+
+    # A budget long enough for a busy machine, moves must not fall back
+    monkeypatch.setattr(app, "bots", BotEngine(budget=0.1))
+
+    async def send(room, websocket, action, **params):
+        await app.handle_message(room, websocket, {"action": action, "action_params": params})
+        await asyncio.sleep(0)
+
+    async def run():
+        room = await RoomRegistry().get("bots")
+        websocket = FakeWebSocket()
+        room.sockets.add(websocket)
+        await app.connect(room, websocket)
+
+        await send(room, websocket, "add_player", name="p1")
+        await send(room, websocket, "add_bot")
+        await send(room, websocket, "add_bot")
+        assert [player.name for player in room.game.players] == ["p1", "bot-1", "bot-2"]
+
+        # Humans can't take the names of bots
+        await send(room, websocket, "add_player", name="bot-3")
+        assert "error" in websocket.messages[-1]
+
+        await send(room, websocket, "start_match")
+
+        # Bots play after every human turn, until it's the human's turn again
+        for _ in range(3):
+            version = room.version
+            await send(room, websocket, "player_turn_pick")
+            await send(room, websocket, "player_turn_throw", card_id=7)
+            await room.bots_task
+
+            # Every player picked and threw a card
+            assert room.game.status == GameStatus.started
+            assert room.game.match_next_player == 0
+            assert room.version == version + 6
+            assert [len(player.hand) for player in room.game.players] == [7, 7, 7]
+
+        assert app.bots.fallbacks == 0
+
+    asyncio.run(run())
+
+
+def test_evaluate_hands_matches_check_cards_values():
+    np = importorskip("numpy")
+    from conga.batch import _evaluate_disjoint, evaluate_hands
+
+    rng = random.Random(15)
+    deck = build_deck() * 2
+    hands = [rng.sample(deck, 8) for _ in range(2000)]
+
+    # Jokers and duplicated cards
+    hands.append([Card(suit=Joker.joker, number=0)] * 2 + deck[:6])
+    hands.append(deck[:4] * 2)
+
+    # Several games, ordered by their suit-normalized cards, a run too long for a single flush and
+    # a repeated card in a run
+    codes = [
+        (58, 59, 60, 18, 31, 44, 40, 15),
+        (14, 15, 16, 30, 31, 32, 33, 61),
+        (14, 15, 16, 17, 18, 19, 20, 40),
+        (14, 15, 15, 16, 30, 43, 56, 50),
+    ]
+    hands.extend([Card.from_code(code) for code in hand] for hand in codes)
+
+    hands_codes = np.array([[card.code for card in hand] for hand in hands])
+    evaluated = _evaluate_disjoint(hands_codes)[2]
+    assert evaluated.any() and not evaluated.all()
+    assert evaluated[-4:].tolist() == [True, True, False, False]
+
+    scores, masks = evaluate_hands(hands_codes)
+    assert scores.shape == (len(hands),) and masks.shape == (len(hands), 8)
+
+    for hand, score, mask in zip(hands, scores, masks):
+        candidates, expected_score = check_cards_values(hand)
+        games = [
+            sorted(card.code for card, game in zip(hand, mask) if game == ix)
+            for ix in range(1, len(candidates) + 1)
+        ]
+
+        assert score == expected_score
+        assert games == [sorted(card.code for card in cand) for cand in candidates]
+        assert mask.max(initial=0) == len(candidates)
+
+
+def test_metrics_registry():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test", ["action"], buckets=(0.1, 1))
+    counter = registry.counter("test_total", "Test", ["kind"])
+    registry.gauge("test_gauge", "Test", lambda: 3)
+
+    histogram.observe(0.05, "pick")
+    histogram.observe(0.5, "pick")
+    histogram.observe(5, "pick")
+    with histogram.time("throw"):
+        pass
+    counter.inc("snapshot", value=2)
+
+    text = registry.render()
+    assert histogram.count("pick") == 3 and histogram.count("throw") == 1
+    assert 'test_seconds_bucket{action="pick",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{action="pick",le="1"} 2' in text
+    assert 'test_seconds_bucket{action="pick",le="+Inf"} 3' in text
+    assert 'test_seconds_count{action="pick"} 3' in text
+    assert 'test_total{kind="snapshot"} 2' in text
+    assert "# TYPE test_gauge gauge\ntest_gauge 3" in text
+
+    with raises(ValueError):
+        registry.counter("test_total", "Test")
+
+
+def test_app_metrics(tmp_path, monkeypatch):
+    importorskip("httpx")
+    monkeypatch.setenv("CONGA_DATA_DIR", str(tmp_path))
+
+    from fastapi.testclient import TestClient
+
+    from conga.app import app
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws/metrics-test") as ws:
+            ws.receive_json()
+            ws.send_json({"action": "add_player", "action_params": {"name": "a"}})
+            ws.receive_json()
+
+        text = client.get("/metrics").text
+
+    assert 'conga_action_seconds_count{action="add_player"}' in text
+    assert "conga_broadcast_seconds_count" in text
+    assert "conga_serialize_seconds_count" in text
+    assert "# TYPE conga_rooms gauge" in text
+
+
+def test_app_binary_protocol(tmp_path, monkeypatch):
+    importorskip("httpx")
+    monkeypatch.setenv("CONGA_DATA_DIR", str(tmp_path))
+
+    from fastapi.testclient import TestClient
+
+    from conga.app import app
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws/binary-test", subprotocols=["conga.bin"]) as ws:
+            assert ws.accepted_subprotocol == "conga.bin"
+            assert wire.decode_message(ws.receive_bytes())["version"] == 0
+
+            ws.send_bytes(wire.encode_action("add_player", {"name": "a"}))
+            state = wire.decode_message(ws.receive_bytes())
+            assert state["version"] == 1
+            assert "hand" not in state["game"]["players"][0]
+
+            # The player view, once the socket is bound to the player
+            state = wire.decode_message(ws.receive_bytes())
+            assert state["game"]["players"][0]["name"] == "a"
+            assert "hand" in state["game"]["players"][0]
+
+            ws.send_bytes(wire.encode_action("add_player", {"name": "bot-1"}))
+            assert "error" in wire.decode_message(ws.receive_bytes())
+
+        # Clients not asking for the subprotocol use JSON
+        with client.websocket_connect("/ws/binary-test") as ws:
+            assert ws.accepted_subprotocol is None
+            assert ws.receive_json()["version"] == 1
+
+
+def test_app_binds_sockets_to_the_players_they_add(tmp_path, monkeypatch):
+    importorskip("httpx")
+    monkeypatch.setenv("CONGA_DATA_DIR", str(tmp_path))
+
+    from fastapi.testclient import TestClient
+
+    from conga import app as app_module
+    from conga.app import app
+
+    # Other app tests shut the executors down, actions run inline here
+    monkeypatch.setattr(app_module, "runner", ActionRunner())
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws/claim-test") as ws:
+            ws.receive_json()
+            ws.send_json({"action": "add_player", "action_params": {"name": "a"}})
+            ws.receive_json()
+            player_state = ws.receive_json()
+            assert "hand" in player_state["game"]["players"][0]
+
+            token = player_state["token"]
+
+            ws.send_json({"action": "add_player", "action_params": {"name": "b"}})
+            ws.receive_json()
+            ws.receive_json()
+            ws.send_json({"action": "start_match"})
+            assert ws.receive_json()["version"] == 3
+
+        # Adding a player that already joined doesn't show its hand
+        with client.websocket_connect("/ws/claim-test") as ws:
+            ws.receive_json()
+            ws.send_json({"action": "add_player", "action_params": {"name": "a"}})
+            ws.send_json({"action": "resync"})
+
+            state = ws.receive_json()
+            assert "token" not in state
+            assert all("hand" not in player for player in state["game"]["players"])
+
+            # Unless the player reconnects with its token
+            claim = {"name": "a", "token": "not-the-token"}
+            ws.send_json({"action": "add_player", "action_params": claim})
+            assert "error" in ws.receive_json()
+
+            ws.send_json({"action": "add_player", "action_params": {"name": "a", "token": token}})
+            state = ws.receive_json()
+            assert "hand" in state["game"]["players"][0]
+            assert "hand" not in state["game"]["players"][1]
+
+
+def test_app_removes_sockets_closed_by_the_server(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONGA_DATA_DIR", str(tmp_path))
+    from conga import app
+
+    snapshots = []
+    monkeypatch.setattr(app.store, "snapshot", lambda *args: snapshots.append(args))
+
+    async def run():
+        websocket = ClosingWebSocket()
+        endpoint = asyncio.ensure_future(app.websocket_endpoint(websocket, "closed-test"))
+        await _wait_for(lambda: websocket.messages)
+
+        room = app.rooms.rooms["closed-test"]
+        version = room.version
+
+        # Invalid messages are reported to their socket only
+        websocket.incoming.put_nowait(ValueError("Expecting value"))
+        await _wait_for(lambda: len(websocket.messages) == 2)
+        assert websocket.messages[-1] == {
+            "error": "Invalid message: Expecting value",
+            "version": version,
+        }
+
+        # Lagging sockets are closed by the broadcaster, the endpoint stops receiving
+        await websocket.close(code=1013)
+        websocket.incoming.put_nowait({"action": "resync"})
+        await asyncio.wait_for(endpoint, 1)
+
+        assert websocket not in room.sockets
+        assert room.version == version and not snapshots
+
+    asyncio.run(run())
+
+
+def test_action_profiler(tmp_path, game_started):
+    game = game_started
+    profiler = ActionProfiler(directory=str(tmp_path), budget=0, actions=1)
+
+    # Profiled action, and reported since it's over the budget
+    state = game.to_dict()
+    with profiler.profile("room", "player_turn_pick", {}, state):
+        game.dispatch("player_turn_pick", {})
+
+    assert not profiler.enabled
+    profiler.wait()
+    assert (tmp_path / "player_turn_pick.pstats").exists()
+    assert (tmp_path / "player_turn_pick.alloc.txt").read_text().startswith("# player_turn_pick")
+
+    (report,) = (tmp_path / "slow").iterdir()
+    hand = state["players"][game.match_next_player]["hand"]
+    assert json.loads(report.read_text())["hand"] == hand
+    assert replay_report(str(report)).to_dict() == game.to_dict()
+
+    # Not profiled, but still checked against the budget
+    with profiler.profile("room", "player_turn_throw", {"card_id": 0}, game.to_dict()):
+        game.dispatch("player_turn_throw", {"card_id": 0})
+
+    profiler.wait()
+    assert not (tmp_path / "player_turn_throw.pstats").exists()
+    assert profiler.slow_actions == 2 and len(list((tmp_path / "slow").iterdir())) == 2
+
+    # Shuffles are replayed with the seed of the action
+    state = game.to_dict()
+    game.rng = random.Random("1:5")
+    with profiler.profile("room", "start_match", {}, state, seed="1:5"):
+        game.dispatch("start_match", {})
+
+    profiler.wait()
+    (report,) = [path for path in (tmp_path / "slow").iterdir() if "start_match" in path.name]
+    assert replay_report(str(report)).to_dict() == game.to_dict()
+
+
+def test_action_runner(monkeypatch):
+    async def run(runner):
+        games = {}
+        for kind, action_runner in [("inline", ActionRunner()), ("offloaded", runner)]:
+            game = _played_game(4, turns=12)
+            for action, params in [
+                ("player_finish_attempt", {"player_finishes": True}),
+                ("start_match", {}),
+                ("player_turn_pick", {}),
+            ]:
+                game.rng = random.Random(action)
+                game = await action_runner.dispatch(game, action, params)
+
+            games[kind] = game
+
+        # Offloaded actions are applied to a copy of the game, with the same result
+        assert games["offloaded"].to_dict() == games["inline"].to_dict()
+
+    process_executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+    for executor in [ThreadPoolExecutor(1), process_executor]:
+        with executor:
+            asyncio.run(run(ActionRunner(executor)))
+
+    # Process pools with a timed out action are replaced, killing the worker. The game is left as
+    # it was (spawning the worker takes longer than the timeout)
+    async def run_recycled(runner):
+        game = _played_game(2, turns=2)
+        state = game.to_dict()
+
+        executor = runner.executor
+        with raises(ActionTimeoutError):
+            await runner.dispatch(game, "player_finish_attempt", {"player_finishes": True})
+
+        assert game.to_dict() == state
+        assert runner.executor is not executor
+
+        runner.timeout = 30
+        game = await runner.dispatch(game, "player_finish_attempt", {"player_finishes": True})
+        assert game.status == GameStatus.showcase
+
+        await _wait_for(lambda: runner.pending == 0)
+
+    runner = ActionRunner(
+        offload._process_pool(1),
+        timeout=0.001,
+        executor_factory=partial(offload._process_pool, 1),
+    )
+    asyncio.run(run_recycled(runner))
+    runner.shutdown()
+
+    # Threads with a timed out action go on until it ends. Meanwhile they count as in flight
+    def slow_action(state, rng, action, params):
+        time.sleep(0.2)
+        return state
+
+    monkeypatch.setattr(offload, "_run_action", slow_action)
+
+    async def run_slow(runner):
+        game = _played_game(2, turns=2)
+        state = game.to_dict()
+        timeouts = ACTION_TIMEOUTS.values.get(("player_finish_attempt",), 0)
+        rejections = ACTION_REJECTIONS.values.get(("start_match",), 0)
+
+        with raises(ActionTimeoutError, match="more than"):
+            await runner.dispatch(game, "player_finish_attempt", {"player_finishes": True})
+
+        assert game.to_dict() == state
+        assert runner.pending == 1
+
+        with raises(ActionTimeoutError, match="still running"):
+            await runner.dispatch(game, "start_match", {})
+
+        # Timeouts and rejections are counted apart
+        assert ACTION_TIMEOUTS.values[("player_finish_attempt",)] == timeouts + 1
+        assert ACTION_REJECTIONS.values[("start_match",)] == rejections + 1
+
+        await _wait_for(lambda: runner.pending == 0)
+
+    with ThreadPoolExecutor(1) as executor:
+        asyncio.run(run_slow(ActionRunner(executor, timeout=0.05, max_pending=1)))
+
+
+def test_hash_ring():
+    rooms = [f"room-{ix}" for ix in range(1000)]
+    ring = HashRing(["a", "b", "c"])
+    owners = {room_id: ring.owner(room_id) for room_id in rooms}
+
+    # Rooms are spread across nodes, and only the rooms of a removed node move
+    assert all(200 < list(owners.values()).count(node) < 470 for node in "abc")
+
+    smaller_ring = HashRing(["a", "b"])
+    for room_id, owner in owners.items():
+        if owner != "c":
+            assert smaller_ring.owner(room_id) == owner
+
+
+async def _wait_for(condition, timeout=5):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_event_loop().time() < deadline, "Timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_cluster_relays_rooms_to_their_owner(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONGA_DATA_DIR", str(tmp_path))
+    from conga import app
+
+    async def run():
+        hub = {}
+        nodes = {
+            node_id: Node(
+                node_id, LocalBackplane(hub), RoomRegistry(), app.connect, app.handle_message
+            )
+            for node_id in ["0", "1"]
+        }
+        await asyncio.gather(*[node.start(expected_nodes=2) for node in nodes.values()])
+
+        room_id = next(
+            room_id
+            for room_id in (f"room-{ix}" for ix in range(100))
+            if nodes["0"].ring.owner(room_id) == "0"
+        )
+        assert nodes["0"].is_local(room_id) and not nodes["1"].is_local(room_id)
+
+        # A socket connected to the other node plays in the room of the owner
+        websocket = FakeWebSocket()
+        relay = asyncio.ensure_future(nodes["1"].serve_remote(room_id, websocket))
+        websocket.incoming.put_nowait({"action": "add_player", "action_params": {"name": "p1"}})
+
+        await _wait_for(lambda: len(websocket.messages) == 3)
+        snapshot, patch, player_snapshot = websocket.messages
+
+        room = nodes["0"].rooms.rooms[room_id]
+        assert room_id not in nodes["1"].rooms.rooms
+        assert [player.name for player in room.game.players] == ["p1"]
+        assert snapshot["version"] == 0 and patch["version"] == 1
+        assert player_snapshot["game"]["players"][0]["name"] == "p1"
+        assert "hand" in player_snapshot["game"]["players"][0]
+
+        # Binary sockets are relayed too
+        binary_socket = FakeWebSocket(subprotocols=[wire.BINARY_SUBPROTOCOL])
+        binary_relay = asyncio.ensure_future(nodes["1"].serve_remote(room_id, binary_socket))
+        binary_socket.incoming.put_nowait(wire.encode_action("add_player", {"name": "p2"}))
+
+        await _wait_for(lambda: len(binary_socket.messages) == 3)
+        assert binary_socket.subprotocol == wire.BINARY_SUBPROTOCOL
+        assert [player.name for player in room.game.players] == ["p1", "p2"]
+        assert binary_socket.messages[-1] == {**room.snapshot("p2"), "token": room.tokens["p2"]}
+
+        # Disconnecting leaves the room of the owner
+        websocket.incoming.put_nowait(None)
+        binary_socket.incoming.put_nowait(None)
+        await asyncio.gather(relay, binary_relay)
+        await _wait_for(lambda: not room.sockets)
+        assert not nodes["0"].remote and not nodes["1"].relayed
+
+        # The sockets of a node that stops leave the rooms of the owner
+        websocket = FakeWebSocket()
+        relay = asyncio.ensure_future(nodes["1"].serve_remote(room_id, websocket))
+        await _wait_for(lambda: room.sockets)
+
+        await nodes["1"].stop()
+        await _wait_for(lambda: not room.sockets)
+        assert not nodes["0"].remote
+
+        websocket.incoming.put_nowait(None)
+        await relay
+        await nodes["0"].stop()
+
+    asyncio.run(run())
+
+
+def test_cluster_handles_rooms_concurrently():
+    handled = []
+    unblocked = asyncio.Event()
+
+    async def connect(room, socket):
+        pass
+
+    async def handle_message(room, socket, data):
+        if data.get("slow"):
+            await unblocked.wait()
+        handled.append((room.room_id, data["n"]))
+
+    async def run():
+        hub = {}
+        nodes = {
+            node_id: Node(node_id, LocalBackplane(hub), RoomRegistry(), connect, handle_message)
+            for node_id in ["0", "1"]
+        }
+        await asyncio.gather(*[node.start(expected_nodes=2) for node in nodes.values()])
+
+        def owned_by(node_id):
+            room_ids = [f"room-{ix}" for ix in range(100)]
+            return [room_id for room_id in room_ids if nodes["0"].ring.owner(room_id) == node_id]
+
+        slow_room, fast_room = owned_by("0")[:2]
+
+        async def relay_message(room_id, socket_id, kind, **message):
+            address = {"origin": "1", "socket_id": socket_id, "room_id": room_id}
+            await nodes["1"].backplane.send("0", {"type": kind, **address, **message})
+
+        # A slow message only delays the messages of its room, which are handled in order
+        await relay_message(slow_room, "slow", "join")
+        await relay_message(fast_room, "fast", "join")
+        await relay_message(slow_room, "slow", "message", data={"slow": True, "n": 1})
+        await relay_message(slow_room, "slow", "message", data={"n": 2})
+        await relay_message(fast_room, "fast", "message", data={"n": 3})
+
+        await _wait_for(lambda: handled)
+        assert handled == [(fast_room, 3)]
+
+        unblocked.set()
+        await _wait_for(lambda: len(handled) == 3)
+        assert handled == [(fast_room, 3), (slow_room, 1), (slow_room, 2)]
+        assert len(nodes["0"].remote) == 2 and not nodes["0"].inboxes
+
+        # A socket closed by the owner stops being relayed
+        websocket = ClosingWebSocket()
+        room_id = owned_by("1")[0]
+        relay = asyncio.ensure_future(nodes["0"].serve_remote(room_id, websocket))
+        await _wait_for(lambda: nodes["1"].remote)
+
+        (_, socket_id), (_, socket) = next(iter(nodes["1"].remote.items()))
+        await socket.close(code=1013)
+        await _wait_for(lambda: websocket.closed == 1013)
+
+        websocket.incoming.put_nowait({"n": 4})
+        await asyncio.wait_for(relay, 1)
+        await _wait_for(lambda: not nodes["1"].remote)
+        assert handled[-1] == (room_id, 4) and not nodes["0"].relayed
+
+        # When a node stops, the sockets relayed to it are closed and its sockets leave the rooms
+        websocket = ClosingWebSocket()
+        relay = asyncio.ensure_future(nodes["0"].serve_remote(room_id, websocket))
+        await _wait_for(lambda: nodes["1"].remote)
+
+        await nodes["1"].stop()
+        await _wait_for(lambda: websocket.closed == 1012)
+        await _wait_for(lambda: not nodes["0"].remote)
+        assert all(not room.sockets for room in nodes["0"].rooms.rooms.values())
+
+        websocket.incoming.put_nowait({"n": 5})
+        await asyncio.wait_for(relay, 1)
+        assert not nodes["0"].relayed
+
+        # A restarted node finds the same owners, and ids out of the cluster are rejected
+        restarted = Node("1", LocalBackplane(hub), RoomRegistry(), connect, handle_message)
+        await restarted.start(expected_nodes=2)
+        room_ids = [f"room-{ix}" for ix in range(100)]
+        assert [restarted.ring.owner(room_id) for room_id in room_ids] == [
+            nodes["0"].ring.owner(room_id) for room_id in room_ids
+        ]
+
+        with raises(ValueError):
+            await Node("2", LocalBackplane(hub), RoomRegistry(), connect, handle_message).start(2)
+
+        await restarted.stop()
+        await nodes["0"].stop()
+
+    asyncio.run(run())
+
+
+def test_unix_socket_backplane(tmp_path):
+    async def run():
+        received = {}
+
+        async def start(backplane, size=2):
+            node_id = await backplane.claim(size)
+            messages = received[node_id] = []
+
+            async def on_message(message):
+                messages.append(message)
+
+            await backplane.start(node_id, on_message)
+            return node_id
+
+        first, second = UnixSocketBackplane(str(tmp_path)), UnixSocketBackplane(str(tmp_path))
+        assert [await start(first), await start(second)] == ["0", "1"]
+        assert await first.nodes(2, timeout=1) == ["0", "1"]
+
+        # Messages are delivered in order
+        for ix in range(20):
+            await first.send("1", {"type": "message", "n": ix})
+        await second.send("0", {"type": "message", "n": 0})
+
+        await _wait_for(lambda: len(received["1"]) == 20 and received["0"])
+        assert [message["n"] for message in received["1"]] == list(range(20))
+
+        # A node that stops is reported to the nodes it sent messages to, and the next node takes
+        # its id
+        await second.close()
+        await _wait_for(lambda: len(received["0"]) == 2)
+        assert received["0"][-1] == {"type": "down", "origin": "1"}
+
+        with raises(TimeoutError):
+            await first.nodes(2, timeout=0.2)
+
+        restarted = UnixSocketBackplane(str(tmp_path))
+        assert await start(restarted) == "1" and not received["1"]
+        assert await first.nodes(2, timeout=1) == ["0", "1"]
+
+        await first.send("1", {"type": "message", "n": 20})
+        await _wait_for(lambda: received["1"])
+        assert received["1"] == [{"type": "message", "n": 20}]
+
+        # Every id is taken
+        with raises(TimeoutError):
+            await UnixSocketBackplane(str(tmp_path)).claim(2, timeout=0.2)
+
+        await first.close()
+        await restarted.close()
+
+    asyncio.run(run())